@@ -1,34 +1,599 @@
 import requests
+from requests.adapters import HTTPAdapter
 from requests.utils import quote
+import os
 import re
 import json
+import time
 from articledownloader import scrapers
+from articledownloader.keypool import APIKeyPool, QuotaExhaustedError
+from articledownloader.ratelimit import DEFAULT_DOWNLOAD_RATE_LIMIT, build_rate_limiter
+from articledownloader.records import MetadataRecord
+from articledownloader.resilience import CircuitBreaker, CircuitOpenError, RetryPolicy
+from articledownloader.resolver import DOIResolver
+from articledownloader.routing import ModeRouter
+from articledownloader.validation import InvalidPayload, validator_for
+from articledownloader.writers import DEFAULT_CHUNK_SIZE, write_body
 from autologging import logged, traced
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from collections import OrderedDict
 from csv import reader
-from time import sleep
+from datetime import datetime, timezone
+from queue import Queue, Full
+from threading import BoundedSemaphore, Event, Semaphore, Thread, local
+from urllib.parse import urlparse
+
+try:
+  from orjson import loads as _loads #Much faster on large CrossRef pages, if installed
+except ImportError:
+  from json import loads as _loads
+
+#Errors that say a host may be down, so they are retried and count towards its circuit breaker
+TRANSIENT_ERRORS = (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError)
+
+#Failures that say nothing about whether a mode works for a DOI, only that it couldn't be tried
+UNREACHABLE_ERRORS = (CircuitOpenError, QuotaExhaustedError, requests.ConnectionError, requests.Timeout)
+
+#CrossRef fields needed by each kind of harvest, sent as select= so pages only carry these
+DOI_FIELDS = ['DOI']
+METADATA_FIELDS = ['DOI', 'ISSN', 'title', 'prefix', 'container-title', 'publisher', 'volume', 'issue', 'page',
+                   'published-print', 'references-count', 'is-referenced-by-count']
+
+def _metadata_record(item):
+  '''
+  Builds a flat metadata record from a single CrossRef work item
+
+  :param item: a work item from a CrossRef API response
+  :type item: dict
+
+  :returns: the metadata record, or None if a required field is missing
+  :rtype: dict
+  '''
+
+  try:
+    if "published-print" in item:
+      year = item['published-print']['date-parts'][0][0]
+    else:
+      year = None
+
+    return {
+      "doi": item["DOI"],
+      "issn": item["ISSN"][0],
+      "title": item["title"][0],
+      "prefix": item["prefix"],
+      "journal": item["container-title"][0],
+      "publisher": item["publisher"],
+      "volume": item.get("volume"),
+      "issue": item.get("issue"),
+      "page": item.get("page"),
+      "year": year,
+      "num_references": item['references-count'],
+      "times_cited": item['is-referenced-by-count']
+    }
+  except (KeyError, IndexError, TypeError):
+    return None
+
+def _page_metadata_records(items, compact=False):
+  metadata_records = []
+  for item in items:
+    metadata_record = _metadata_record(item)
+    if metadata_record is not None:
+      metadata_records.append(MetadataRecord.from_dict(metadata_record) if compact else metadata_record)
+  return metadata_records
+
+def _prefetch(pages, depth):
+  '''
+  Runs a page generator on a background thread so that up to depth pages are fetched
+  ahead of the consumer, while the consumer is still working on the current page
+
+  :param pages: generator of pages
+  :type pages: generator
+
+  :param depth: max number of pages fetched ahead (0 to fetch inline)
+  :type depth: int
+
+  :returns: the same pages, in order
+  :rtype: generator
+  '''
+
+  if depth < 1:
+    for page in pages:
+      yield page
+    return
+
+  done = object()
+  ready = Queue()
+  slots = Semaphore(depth)
+  stop = Event()
+
+  def produce():
+    try:
+      while True:
+        slots.acquire()
+        if stop.is_set():
+          pages.close()
+          return
+        page = next(pages, done)
+        ready.put((page, None))
+        if page is done:
+          return
+    except Exception as e:
+      ready.put((done, e))
+
+  Thread(target=produce, daemon=True).start()
+  try:
+    while True:
+      page, error = ready.get()
+      if error is not None:
+        raise error
+      if page is done:
+        return
+      slots.release() #Start fetching the next page before this one is processed
+      yield page
+  finally:
+    stop.set()
+    slots.release()
+
+def _imap_unordered(func, args, max_workers):
+  '''
+  Calls func on each of args from a thread pool, yielding results as they finish. Only a
+  bounded number of calls are queued at a time, so args can be a huge or lazy iterable.
+  '''
+
+  args = iter(args)
+  max_pending = max_workers * 2
+  pending = set()
+  with ThreadPoolExecutor(max_workers=max_workers) as pool:
+    try:
+      while True:
+        for arg in args:
+          pending.add(pool.submit(func, arg))
+          if len(pending) >= max_pending:
+            break
+        if not pending:
+          return
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+          yield future.result()
+    finally:
+      for future in pending:
+        future.cancel()
 
 @logged
 class ArticleDownloader:
 
-  def __init__(self, els_api_key=None, sleep_sec=1, timeout_sec=30):
+  def __init__(self, els_api_key=None, sleep_sec=None, timeout_sec=30, pool_size=10, max_retries=3, rate_limits=None,
+               download_rate_limit=DEFAULT_DOWNLOAD_RATE_LIMIT, prefetch_pages=1, cache=None, resolver=None, manifest=None, chunk_size=DEFAULT_CHUNK_SIZE, validate=True,
+               router=None, retry_policy=None, circuit_breaker=None):
     '''
     Initialize and set up API keys
 
-    :param els_api_key: API key for Elsevier (for Elsevier's API)
-    :type els_api_key: str
-    :param sleep_sec: Sleep time between API calls (default = 1s)
-    :type sleep_sec: int
+    :param els_api_key: API key for Elsevier (for Elsevier's API), or several keys to rotate over by remaining quota
+    :type els_api_key: str or list or articledownloader.keypool.APIKeyPool
+    :param sleep_sec: Min time between CrossRef API calls (default = CrossRef's limit of 10 requests/s, burst 10)
+    :type sleep_sec: float
     :param timeout_sec: Max time before timeout (default = 30s)
     :type timeout_sec: int
+    :param pool_size: Max number of keep-alive connections kept open per host (default = 10)
+    :type pool_size: int
+    :param max_retries: Retries for failed connections, timeouts, 429 and 5xx responses (default = 3)
+    :type max_retries: int
+    :param rate_limits: (requests/sec, burst) per host or domain, e.g. {'nature.com': (2, 5)}
+    :type rate_limits: dict
+    :param download_rate_limit: (requests/sec, burst) for doi.org and each publisher host without its own
+      entry in rate_limits (default = (5, 5); None for no limit)
+    :type download_rate_limit: tuple
+    :param prefetch_pages: CrossRef cursor pages fetched ahead while the current one is processed (default = 1)
+    :type prefetch_pages: int
+    :param cache: persistent cache for CrossRef/Elsevier metadata lookups (default = no caching)
+    :type cache: articledownloader.cache.HTTPCache
+    :param resolver: cache of DOI landing page URLs (default = an in-memory DOIResolver)
+    :type resolver: articledownloader.resolver.DOIResolver
+    :param manifest: checkpoints CrossRef sweeps and download outcomes so runs can be resumed (default = none)
+    :type manifest: articledownloader.manifest.CrawlManifest
+    :param chunk_size: Bytes copied per read when writing downloaded articles (default = 1MB)
+    :type chunk_size: int
+    :param validate: Check the first bytes of each article and abort paywall/error pages (default = True)
+    :type validate: bool
+    :param router: picks and orders the modes tried for mode='auto' (default = an in-memory ModeRouter)
+    :type router: articledownloader.routing.ModeRouter
+    :param retry_policy: backoff and Retry-After handling between retries (default = RetryPolicy(max_retries))
+    :type retry_policy: articledownloader.resilience.RetryPolicy
+    :param circuit_breaker: fails requests to hosts that keep failing at once, until a cooldown passes
+      (default = CircuitBreaker() with 5 failures and a 60s cooldown)
+    :type circuit_breaker: articledownloader.resilience.CircuitBreaker
     '''
     self.els_api_key = els_api_key
+    if els_api_key is None or isinstance(els_api_key, APIKeyPool):
+      self.els_keys = els_api_key
+    else:
+      self.els_keys = APIKeyPool([els_api_key] if isinstance(els_api_key, str) else els_api_key)
     self.sleep_sec = sleep_sec
     self.timeout_sec = timeout_sec
+    self.prefetch_pages = prefetch_pages
+    self.cache = cache
+    self.resolver = resolver if resolver is not None else DOIResolver()
+    self.manifest = manifest
+    self.router = router if router is not None else ModeRouter()
+    self.chunk_size = chunk_size
+    self.validate = validate
+    self.local = local()
+
+    #Every request waits on its host's token bucket, and only when the bucket is empty
+    self.rate_limiter = build_rate_limiter(sleep_sec, download_rate_limit, rate_limits)
+
+    #Retries happen in _get, where they can honour Retry-After and feed the circuit breakers
+    self.retry_policy = retry_policy if retry_policy is not None else RetryPolicy(max_retries=max_retries)
+    self.circuit_breaker = circuit_breaker if circuit_breaker is not None else CircuitBreaker()
+
+    #One session shared by every method, so connections to each host are reused
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+    self.session = requests.Session()
+    self.session.mount('http://', adapter)
+    self.session.mount('https://', adapter)
+
+  def close(self):
+    '''
+    Closes all pooled connections held by this downloader, and saves the DOI resolver cache
+    and the mode routing statistics
+    '''
+    self.session.close()
+    self.resolver.save()
+    self.router.save()
+
+  def _get(self, url, retry_statuses=None, **kwargs):
+    '''
+    Sends a GET request through the shared session, once the host's rate limit allows it.
+    Connection errors, timeouts, broken transfers, 429s and 5xx responses are retried after a
+    backoff (or the server's Retry-After), and count towards opening the host's circuit
+    breaker, after which requests to the host raise CircuitOpenError without being sent.
+    Other errors, such as redirect loops or invalid URLs, are raised without counting.
+
+    :param retry_statuses: HTTP statuses to retry instead of the retry policy's; any other status is returned
+      as it is, without counting as a failure of the host
+    :type retry_statuses: tuple
+    '''
+    if retry_statuses is None:
+      retry_statuses = self.retry_policy.retry_statuses
+    host = urlparse(url).hostname
+    kwargs.setdefault('timeout', self.timeout_sec)
+    attempt = 0
+    while True:
+      try:
+        self.circuit_breaker.before(host)
+      except CircuitOpenError as e:
+        self.local.last_error = e
+        raise
+      self.rate_limiter.wait(host)
+
+      try:
+        r = self.session.get(url, **kwargs)
+      except TRANSIENT_ERRORS as e:
+        self.circuit_breaker.failure(host)
+        delay = self.retry_policy.delay(attempt)
+        if delay is None:
+          self.local.last_error = e
+          raise
+      except Exception:
+        #A redirect loop or a bad URL says nothing about the host, but a half-open trial still has to end
+        self.circuit_breaker.release(host)
+        raise
+      else:
+        if r.status_code not in retry_statuses:
+          self.circuit_breaker.success(host)
+          return r
+        self.circuit_breaker.failure(host)
+        delay = self.retry_policy.delay(attempt, r)
+        if delay is None:
+          return r
+        r.close()
+
+      time.sleep(delay)
+      attempt += 1
+
+  def _write_body(self, r, writefile, fmt, mode):
+    '''
+    Writes a streamed response body to a file object, atomically to a path, or into a store,
+    after checking that its first bytes look like an article of this format
+    '''
+    check = validator_for(fmt, mode) if self.validate else None
+    try:
+      write_body(r, writefile, self.chunk_size, check)
+    except InvalidPayload as e:
+      self.local.last_error = e
+      raise
+
+  def _get_auto(self, getter, doi, writefile, fmt):
+    '''
+    Tries the modes the router suggests for a DOI, most likely first, until one succeeds
+    '''
+    if hasattr(writefile, 'writer') and writefile.has(doi, fmt):
+      return True
+
+    #Rewind seekable files between attempts; paths and stores only keep a finished article anyway
+    start = writefile.tell() if hasattr(writefile, 'seekable') and writefile.seekable() else None
+    skip = () if self.els_api_key else ('elsevier',)
+    for mode in self.router.chain(doi, fmt, skip):
+      if start is not None:
+        writefile.seek(start)
+        writefile.truncate()
+      try:
+        success = getter(doi, writefile, mode)
+        error = None if success else self.last_error
+      except Exception as e:
+        success, error = False, e
+      #An outage or an exhausted key isn't held against the mode
+      if not isinstance(error, UNREACHABLE_ERRORS):
+        self.router.record(doi, fmt, mode, success)
+      if success:
+        return True
+    return False
+
+  @property
+  def last_error(self):
+    '''
+    The InvalidPayload, CircuitOpenError, QuotaExhaustedError, or connection error or timeout (after retries)
+    that made the last get_*_from_doi call in this thread fail, or None
+    '''
+    return getattr(self.local, 'last_error', None)
+
+  @staticmethod
+  def _open_sink(writefile, doi, fmt):
+    '''
+    Turns an article store (anything with a writer(doi, fmt) method) into a writer for this article
+
+    :returns: the writer, or None if the store already has the article
+    '''
+    if not hasattr(writefile, 'writer'):
+      return writefile
+    if writefile.has(doi, fmt):
+      return None
+    return writefile.writer(doi, fmt)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()
+
+  def _resolve(self, doi, headers=None):
+    '''
+    Returns the landing page URL for a DOI, asking doi.org
+    '''
+    r = self._get('https://doi.org/' + doi, headers=headers, stream=True)
+    r.close() #Only the final URL is needed, not the page itself
+    if r.history:
+      self.resolver.learn(doi, r.url)
+    return r.url
+
+  def _get_from_landing(self, doi, headers, download_url):
+    '''
+    Fetches download_url(landing URL) for a DOI. A landing URL known to the resolver is tried
+    first; if what is built from it doesn't work, the resolver forgets it and the DOI is
+    resolved through doi.org again.
+    '''
+    url = self.resolver.lookup(doi)
+    if url is not None:
+      r = self._get(download_url(url), stream=True, headers=headers)
+      if r.status_code == 200:
+        return r
+      r.close()
+      self.resolver.forget(doi)
+
+    return self._get(download_url(self._resolve(doi, headers)), stream=True, headers=headers)
+
+  def _get_landing(self, doi, headers=None, stream=False):
+    '''
+    Fetches the landing page for a DOI, going straight to the publisher when the URL is known
+    '''
+    url = self.resolver.lookup(doi)
+    if url is not None:
+      r = self._get(url, headers=headers, stream=stream)
+      if r.status_code == 200:
+        return r
+      r.close()
+      self.resolver.forget(doi)
+
+    r = self._get('https://doi.org/' + doi, headers=headers, stream=stream)
+    if r.history:
+      self.resolver.learn(doi, r.url)
+    return r
+
+  def _get_cached(self, url, headers, retry_statuses=None):
+    '''
+    Sends a metadata GET request, answering it from self.cache when a fresh copy is stored
+    and revalidating stale copies with the server
+    '''
+    if self.cache is None:
+      return self._get(url, headers=headers, retry_statuses=retry_statuses)
+
+    entry = self.cache.lookup(url, headers)
+    if entry is not None and self.cache.is_fresh(entry):
+      return self.cache.response(entry)
+
+    request_headers = dict(headers)
+    if entry is not None:
+      request_headers.update(self.cache.revalidation_headers(entry))
+
+    r = self._get(url, headers=request_headers, retry_statuses=retry_statuses)
+    if r.status_code == 304 and entry is not None:
+      self.cache.refresh(entry)
+      return self.cache.response(entry)
+
+    self.cache.store(url, headers, r)
+    return r
+
+  def _get_elsevier(self, url, accept, stream=False, cached=False):
+    '''
+    Sends a request to Elsevier's API with the key that has the most quota left, and moves
+    on to the next key if that one turns out to be out of quota
+    '''
+    #Cached answers don't depend on the key, so they don't use up any key's quota
+    if cached and self.cache is not None:
+      entry = self.cache.lookup(url, {'Accept': accept})
+      if entry is not None and self.cache.is_fresh(entry):
+        return self.cache.response(entry)
+
+    #A 429 means the key is out of quota or throttled, not that the host is failing: it goes to the next key
+    #rather than being retried, and doesn't count towards the host's circuit breaker
+    retry_statuses = tuple(status for status in self.retry_policy.retry_statuses if status != 429)
+    r = None
+    for _ in range(len(self.els_keys) if self.els_keys is not None else 1):
+      try:
+        key = self.els_keys.acquire() if self.els_keys is not None else None
+      except QuotaExhaustedError as e:
+        self.local.last_error = e
+        if r is not None:
+          return r
+        raise
+
+      headers = {
+        'X-ELS-APIKEY': key,
+        'Accept': accept
+      }
+      if cached:
+        r = self._get_cached(url, headers, retry_statuses)
+      else:
+        r = self._get(url, stream=stream, headers=headers, retry_statuses=retry_statuses)
+      if key is not None and not getattr(r, 'from_cache', False):
+        self.els_keys.update(key, r.status_code, r.headers)
+      if r.status_code != 429:
+        return r
+      r.close()
+    return r
+
+  def _get_json(self, url, headers, cached=False):
+    #Each response is decoded exactly once
+    if cached:
+      return _loads(self._get_cached(url, headers).content)
+    return _loads(self._get(url, headers=headers).content)
+
+  def _iter_crossref_pages(self, base_url, rows, headers, select=None, replay=True):
+    '''
+    Yields the items of a CrossRef works query one page at a time, following cursors when
+    more rows are requested than fit on a single page
+
+    :param rows: the maximum number of items to find, or None for all of them
+    :type rows: int
+
+    :param select: CrossRef fields to return for each item (default = all fields)
+    :type select: list
+
+    :param replay: when resuming from a manifest, yield the pages the interrupted run already got
+    :type replay: bool
+    '''
+
+    max_rows = 1000 #Defined by CrossRef API
+
+    if select is not None:
+      base_url = base_url + '&select=' + ','.join(select)
+
+    if rows is not None and rows <= max_rows: #No multi-query needed
+      yield self._get_json(base_url + '&rows=' + str(rows), headers)['message']['items']
+      return
+
+    #With a manifest, replay the pages an interrupted run already got and carry on from its cursor
+    cursor = '*'
+    if self.manifest is not None:
+      cursor = self.manifest.start_sweep(base_url, replay)
+      if replay:
+        for items in self.manifest.iter_sweep_pages(base_url):
+          yield items
+
+    #The next cursor is known as soon as a page is decoded, so later pages can be fetched ahead
+    pages = self._iter_crossref_cursor(base_url, max_rows, headers, cursor, lambda: self._swept(base_url, replay))
+    for items, next_cursor in _prefetch(pages, self.prefetch_pages):
+      yield items
+      if self.manifest is not None: #The page has been consumed by now; its items are only kept for replaying
+        self.manifest.checkpoint(base_url, items if replay else None, next_cursor)
+
+    if self.manifest is not None:
+      self.manifest.finish_sweep(base_url)
+
+  def _iter_crossref_cursor(self, base_url, max_rows, headers, cursor='*', swept=None):
+    '''
+    Follows CrossRef's deep-paging cursors from cursor. CrossRef drops cursors that go unused
+    for a few minutes, so a cursor resumed from the manifest may be rejected; the sweep then
+    starts over from the first page, leaving out what swept() returns: the DOIs already had
+    and the number of pages to skip.
+    '''
+    resumed = cursor != '*'
+    seen, skip_pages = set(), 0
+    while True:
+      r = self._get(base_url + '&rows=' + str(max_rows) + '&cursor=' + cursor, headers=headers)
+      if resumed and 400 <= r.status_code < 500 and r.status_code != 429:
+        cursor, (seen, skip_pages) = '*', swept()
+        resumed = False
+        continue
+      resumed = False
+      message = _loads(r.content)['message']
+      if len(message['items']) == 0:
+        return
+      cursor = quote(message['next-cursor'], safe='')
+      items = message['items']
+      if skip_pages > 0:
+        skip_pages -= 1
+        continue
+      if seen:
+        items = [item for item in items if item.get('DOI') not in seen]
+        if len(items) == 0:
+          continue
+      yield items, cursor
+
+  def _swept(self, key, replay):
+    #A replayed sweep has its pages stored, so their DOIs are known; otherwise only how many pages there were
+    if not replay:
+      return set(), self.manifest.swept_pages(key)
+    return set(item.get('DOI') for items in self.manifest.iter_sweep_pages(key) for item in items) - {None}, 0
+
+  def _iter_issn_pages(self, issn, rows, pub_after, mailto, select, incremental, replay=True):
+    '''
+    Pages through a journal's works. In incremental mode every work indexed since the last
+    completed incremental run is fetched (rows is ignored), and the high-water mark kept in
+    the manifest is moved forward once the sweep finishes.
+    '''
+
+    if incremental and self.manifest is None:
+      raise ValueError('incremental harvesting needs a manifest to keep its high-water marks in')
+
+    base_url = 'https://api.crossref.org/journals/' + issn + '/works?filter=from-pub-date:' + str(pub_after)
+
+    headers = {
+      'Accept': 'application/json',
+      'User-agent': 'mailto:' + mailto
+    }
+
+    if not incremental:
+      return self._iter_crossref_pages(base_url, rows, headers, select=select, replay=replay)
+
+    return self._iter_crossref_delta(base_url, headers, select, replay)
+
+  def _iter_crossref_delta(self, base_url, headers, select, replay=True):
+    key = 'index-date:' + base_url + '&select=' + ','.join(select)
+    #CrossRef index dates are whole days, so the next run re-reads today's records, which merge harmlessly
+    started = datetime.now(timezone.utc).strftime('%Y-%m-%d')
+
+    since = self.manifest.get_watermark(key)
+    if since is not None:
+      base_url = base_url + ',from-index-date:' + since
+
+    for items in self._iter_crossref_pages(base_url, None, headers, select=select, replay=replay):
+      yield items
+    self.manifest.set_watermark(key, started)
+
+  def _iter_unique_dois(self, pages):
+    #Only the DOI strings are kept around for de-duplication, not the page items
+    seen = set()
+    for items in pages:
+      for item in items:
+        if item['DOI'] not in seen:
+          seen.add(item['DOI'])
+          yield item['DOI']
 
   @traced
-  def get_dois_from_search(self, query, rows=500, mailto="null@null.com"):
+  def iter_dois_from_search(self, query, rows=500, mailto="null@null.com"):
     '''
-    Grabs a set of unique DOIs based on a search query using the CrossRef API
+    Yields unique DOIs based on a search query using the CrossRef API, page by page
 
     :param query: the search string
     :type query: str
@@ -39,46 +604,139 @@ class ArticleDownloader:
     :param mailto: mailto address for API
     :type rows: str
 
-    :returns: the unique set of DOIs as a list
-    :rtype: list
+    :returns: each unique DOI, as soon as its page arrives
+    :rtype: generator
     '''
 
-    dois = []
-    base_url = 'https://api.crossref.org/works?query='
-    max_rows = 1000 #Defined by CrossRef API
+    base_url = 'https://api.crossref.org/works?query=' + query
 
     headers = {
       'Accept': 'application/json',
       'User-agent': 'mailto:' + mailto
     }
 
-    if rows <= max_rows: #No multi-query needed
-      search_url = base_url + query + '&rows=' + str(rows)
-      response = requests.get(search_url, headers=headers, timeout=self.timeout_sec).json()
+    return self._iter_unique_dois(self._iter_crossref_pages(base_url, rows, headers, select=DOI_FIELDS))
 
-      for item in response["message"]["items"]:
-        dois.append(item["DOI"])
+  @traced
+  def get_dois_from_search(self, query, rows=500, mailto="null@null.com"):
+    '''
+    Grabs a set of unique DOIs based on a search query using the CrossRef API
 
-    else: #Need to split queries
-      cursor = "*"
-      keep_paging = True
-      while (keep_paging):
-        sleep(self.sleep_sec)
-        r = requests.get(base_url + query + "&rows=" + str(max_rows) + "&cursor=" + cursor,
-                         headers=headers, timeout=self.timeout_sec)
-        cursor = quote(r.json()['message']['next-cursor'], safe='')
-        if len(r.json()['message']['items']) == 0:
-          keep_paging = False
+    :param query: the search string
+    :type query: str
 
-        for item in r.json()['message']['items']:
-          dois.append(item['DOI'])
+    :param rows: the maximum number of DOIs to find
+    :type rows: int
+
+    :param mailto: mailto address for API
+    :type rows: str
+
+    :returns: the unique set of DOIs as a list
+    :rtype: list
+    '''
 
-    return list(set(dois))
+    return list(self.iter_dois_from_search(query, rows=rows, mailto=mailto))
 
   @traced
-  def get_dois_from_journal_issn(self, issn, rows=500, pub_after=2000, mailto="null@null.com"):
+  def iter_dois_from_queries(self, queries, rows=500, mailto="null@null.com", max_workers=4):
     '''
-    Grabs a set of unique DOIs based on a journal ISSN using the CrossRef API
+    Runs many search queries concurrently using the CrossRef API, de-duplicating DOIs across
+    all of them as they come in. Requests still go through the shared per-host rate limits.
+
+    :param queries: search strings, e.g. from load_queries_from_csv
+    :type queries: iterable
+
+    :param rows: the maximum number of DOIs to find per query
+    :type rows: int
+
+    :param mailto: mailto address for API
+    :type rows: str
+
+    :param max_workers: number of queries run at the same time
+    :type max_workers: int
+
+    :returns: (doi, query, first_seen) for every query that found a DOI; first_seen is True
+              only the first time a DOI turns up in any query
+    :rtype: generator
+    '''
+
+    results = Queue(maxsize=10000)
+    stop = Event()
+    finished = object()
+
+    def put(result):
+      #Give up if the consumer has gone away, rather than blocking on a full queue forever
+      while not stop.is_set():
+        try:
+          results.put(result, timeout=0.1)
+          return True
+        except Full:
+          pass
+      return False
+
+    def sweep(query):
+      #Queries that only start after the consumer has gone away don't send any requests
+      if stop.is_set():
+        return
+      try:
+        for doi in self.iter_dois_from_search(query, rows=rows, mailto=mailto):
+          if not put((doi, query, None)):
+            return
+        put((finished, query, None))
+      except Exception as e:
+        put((finished, query, e))
+
+    queries = list(queries)
+    seen = set()
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+      for query in queries:
+        pool.submit(sweep, query)
+      try:
+        remaining = len(queries)
+        while remaining:
+          doi, query, error = results.get()
+          if error is not None:
+            raise error
+          if doi is finished:
+            remaining -= 1
+            continue
+          first_seen = doi not in seen
+          seen.add(doi)
+          yield doi, query, first_seen
+      finally:
+        stop.set()
+        pool.shutdown(cancel_futures=True)
+
+  @traced
+  def get_dois_from_queries(self, queries, rows=500, mailto="null@null.com", max_workers=4):
+    '''
+    Runs many search queries concurrently using the CrossRef API and merges their DOIs
+
+    :param queries: search strings, e.g. from load_queries_from_csv
+    :type queries: iterable
+
+    :param rows: the maximum number of DOIs to find per query
+    :type rows: int
+
+    :param mailto: mailto address for API
+    :type rows: str
+
+    :param max_workers: number of queries run at the same time
+    :type max_workers: int
+
+    :returns: maps each unique DOI to the list of queries that found it, in the order DOIs were found
+    :rtype: collections.OrderedDict
+    '''
+
+    found = OrderedDict()
+    for doi, query, first_seen in self.iter_dois_from_queries(queries, rows=rows, mailto=mailto, max_workers=max_workers):
+      found.setdefault(doi, []).append(query)
+    return found
+
+  @traced
+  def iter_dois_from_journal_issn(self, issn, rows=500, pub_after=2000, mailto="null@null.com", incremental=False):
+    '''
+    Yields unique DOIs based on a journal ISSN using the CrossRef API, page by page
 
     :param issn: The ISSN of the journal
     :type issn: str
@@ -92,41 +750,42 @@ class ArticleDownloader:
     :param mailto: mailto address for API
     :type rows: str
 
-    :returns: the unique set of DOIs as a list
-    :rtype: list
+    :param incremental: only find DOIs indexed since the last incremental run (needs a manifest)
+    :type incremental: bool
+
+    :returns: each unique DOI, as soon as its page arrives
+    :rtype: generator
     '''
 
-    dois = []
-    base_url = 'https://api.crossref.org/journals/' + issn + '/works?filter=from-pub-date:' + str(pub_after)
-    max_rows = 1000 #Defined by CrossRef API
+    pages = self._iter_issn_pages(issn, rows, pub_after, mailto, DOI_FIELDS, incremental)
+    return self._iter_unique_dois(pages)
 
-    headers = {
-      'Accept': 'application/json',
-      'User-agent': 'mailto:' + mailto
-    }
+  @traced
+  def get_dois_from_journal_issn(self, issn, rows=500, pub_after=2000, mailto="null@null.com", incremental=False):
+    '''
+    Grabs a set of unique DOIs based on a journal ISSN using the CrossRef API
 
-    if rows <= max_rows: #No multi-query needed
-      search_url = str(base_url) + '&rows=' + str(rows)
-      response = requests.get(search_url, headers=headers, timeout=self.timeout_sec).json()
+    :param issn: The ISSN of the journal
+    :type issn: str
+
+    :param rows: the maximum number of DOIs to find
+    :type rows: int
+
+    :param pub_after: the minimum publication year for DOIs returned
+    :type pub_after: int
 
-      for item in response["message"]["items"]:
-        dois.append(item["DOI"])
+    :param mailto: mailto address for API
+    :type rows: str
 
-    else: #Need to split queries
-      cursor = "*"
-      keep_paging = True
-      while (keep_paging):
-        sleep(self.sleep_sec)
-        r = requests.get(base_url + "&rows=" + str(max_rows) + "&cursor=" + cursor,
-                         headers=headers, timeout=self.timeout_sec)
-        cursor = quote(r.json()['message']['next-cursor'], safe='')
-        if len(r.json()['message']['items']) == 0:
-          keep_paging = False
+    :param incremental: only find DOIs indexed since the last incremental run (needs a manifest)
+    :type incremental: bool
 
-        for item in r.json()['message']['items']:
-          dois.append(item['DOI'])
+    :returns: the unique set of DOIs as a list
+    :rtype: list
+    '''
 
-    return list(set(dois))
+    return list(self.iter_dois_from_journal_issn(issn, rows=rows, pub_after=pub_after, mailto=mailto,
+                                                 incremental=incremental))
 
   @traced
   def get_metadata_from_doi(self, doi, mailto="null@null.com"):
@@ -138,60 +797,57 @@ class ArticleDownloader:
     }
 
     search_url = str(base_url)
-    response = requests.get(search_url, headers=headers, timeout=self.timeout_sec).json()
+    response = self._get_json(search_url, headers, cached=True)
 
-    item = response["message"]
-    metadata_record = None
-    try:
-      if "volume" in item: 
-        volume = item["volume"]
-      else:
-        volume = None
+    return _metadata_record(response["message"])
 
-      if "published-print" in item: 
-        year = item['published-print']['date-parts'][0][0] 
-      else:
-        year = None
+  @traced
+  def iter_metadata_from_journal_issn(self, issn, rows=500, pub_after=2000, mailto="null@null.com", incremental=False,
+                                      compact=False):
+    '''
+    Yields metadata records based on a journal ISSN using the CrossRef API, page by page
 
-      if "issue" in item: 
-        issue = item["issue"]
-      else:
-        issue = None
+    :param issn: The ISSN of the journal
+    :type issn: str
 
-      if "page" in item: 
-        page = item["page"]
-      else:
-        page = None
-
-      metadata_record = {
-        "doi": item["DOI"],
-        "issn": item["ISSN"][0],
-        "title": item["title"][0],
-        "prefix": item["prefix"],
-        "journal": item["container-title"][0],
-        "publisher": item["publisher"],
-        "volume": volume,
-        "issue": issue,
-        "page": page,
-        "year": year,
-        "num_references": item['references-count'],
-        "times_cited": item['is-referenced-by-count']
-      }
-    except:
-      pass
+    :param rows: the maximum number of DOIs to find
+    :type rows: int
+
+    :param pub_after: the minimum publication year for DOIs returned
+    :type pub_after: int
+
+    :param mailto: mailto address for API
+    :type rows: str
+
+    :param incremental: only find records indexed or updated since the last incremental run (needs a manifest)
+    :type incremental: bool
+
+    :param compact: yield MetadataRecord objects instead of dicts, to save memory
+    :type compact: bool
+
+    :returns: the metadata for each article, as soon as its page arrives
+    :rtype: generator
+    '''
 
-    return metadata_record
+    pages = self._iter_issn_pages(issn, rows, pub_after, mailto, METADATA_FIELDS, incremental)
+    return self._iter_metadata_records(pages, compact)
+
+  def _iter_metadata_records(self, pages, compact=False):
+    for items in pages:
+      for metadata_record in _page_metadata_records(items, compact):
+        yield metadata_record
 
   @traced
-  def get_metadata_from_journal_issn(self, issn, rows=500, pub_after=2000, mailto="null@null.com"):
+  def refresh_metadata_from_journal_issn(self, issn, store, pub_after=2000, mailto="null@null.com"):
     '''
-    Grabs metadata based on a journal ISSN using the CrossRef API
+    Brings an existing store of a journal's metadata up to date, fetching only the records
+    indexed or updated since the last refresh (the first refresh fetches everything)
 
     :param issn: The ISSN of the journal
     :type issn: str
 
-    :param rows: the maximum number of DOIs to find
-    :type rows: int
+    :param store: maps each DOI to its metadata record, e.g. a dict or a shelve; updated in place
+    :type store: dict
 
     :param pub_after: the minimum publication year for DOIs returned
     :type pub_after: int
@@ -199,112 +855,128 @@ class ArticleDownloader:
     :param mailto: mailto address for API
     :type rows: str
 
-    :returns: the metadata for the articles according to this ISSN
-    :rtype: list
+    :returns: the number of records added or replaced
+    :rtype: int
     '''
 
-    metadata_records = []
-    base_url = 'https://api.crossref.org/journals/' + issn + '/works?filter=from-pub-date:' + str(pub_after)
-    max_rows = 1000 #Defined by CrossRef API
+    merged = 0
+    for metadata_record in self.iter_metadata_from_journal_issn(issn, pub_after=pub_after, mailto=mailto, incremental=True):
+      store[metadata_record['doi']] = metadata_record
+      merged += 1
+    return merged
+
+  @traced
+  def get_metadata_for_dois(self, dois, batch_size=100, max_workers=4, mailto="null@null.com"):
+    '''
+    Grabs metadata for many DOIs using the CrossRef API, looking up batch_size DOIs per request
+
+    :param dois: DOI strings for the articles we want to grab metadata for
+    :type dois: iterable
+
+    :param batch_size: number of DOIs looked up by each request (max 1000)
+    :type batch_size: int
+
+    :param max_workers: number of batches fetched at the same time
+    :type max_workers: int
+
+    :param mailto: mailto address for API
+    :type rows: str
+
+    :returns: the metadata record for each DOI found, yielded as each batch finishes; DOIs that
+              can't be looked up are left out
+    :rtype: generator
+    '''
 
     headers = {
       'Accept': 'application/json',
       'User-agent': 'mailto:' + mailto
     }
 
-    if rows <= max_rows: #No multi-query needed
-      search_url = str(base_url) + '&rows=' + str(rows)
-      response = requests.get(search_url, headers=headers, timeout=self.timeout_sec).json()
+    def fetch_one(doi):
+      try:
+        return self.get_metadata_from_doi(doi, mailto=mailto)
+      except Exception:
+        return None
+
+    def fetch(batch):
+      #Commas separate filter values, so DOIs containing one have to be looked up on their own
+      single = [doi for doi in batch if ',' in doi]
+      batch = [doi for doi in batch if ',' not in doi]
 
-      for item in response["message"]["items"]:
+      metadata_records = [fetch_one(doi) for doi in single]
+      if batch:
+        search_url = ('https://api.crossref.org/works?filter=' + ','.join('doi:' + quote(doi, safe='/') for doi in batch) +
+                      '&select=' + ','.join(METADATA_FIELDS) + '&rows=' + str(len(batch)))
         try:
-          if "volume" in item: 
-            volume = item["volume"]
-          else:
-            volume = None
-
-          if "published-print" in item: 
-            year = item['published-print']['date-parts'][0][0] 
-          else:
-            year = None
-
-          if "issue" in item: 
-            issue = item["issue"]
-          else:
-            issue = None
-
-          if "page" in item: 
-            page = item["page"]
-          else:
-            page = None
-
-          metadata_records.append({
-            "doi": item["DOI"],
-            "issn": item["ISSN"][0],
-            "title": item["title"][0],
-            "prefix": item["prefix"],
-            "journal": item["container-title"][0],
-            "publisher": item["publisher"],
-            "volume": volume,
-            "issue": issue,
-            "page": page,
-            "year": year,
-            "num_references": item['references-count'],
-            "times_cited": item['is-referenced-by-count']
-          })
-        except:
-          pass
-    else: #Need to split queries
-      cursor = "*"
-      keep_paging = True
-      while (keep_paging):
-        sleep(self.sleep_sec)
-        r = requests.get(base_url + "&rows=" + str(max_rows) + "&cursor=" + cursor,
-                         headers=headers, timeout=self.timeout_sec)
-        cursor = quote(r.json()['message']['next-cursor'], safe='')
-        if len(r.json()['message']['items']) == 0:
-          keep_paging = False
-
-        for item in r.json()['message']['items']:
-          try:
-            if "volume" in item: 
-              volume = item["volume"]
-            else:
-              volume = None
-
-            if "published-print" in item: 
-              year = item['published-print']['date-parts'][0][0] 
-            else:
-              year = None
-
-            if "issue" in item: 
-              issue = item["issue"]
-            else:
-              issue = None
-
-            if "page" in item: 
-              page = item["page"]
-            else:
-              page = None
-
-            metadata_records.append({
-              "doi": item["DOI"],
-              "issn": item["ISSN"][0],
-              "title": item["title"][0],
-              "prefix": item["prefix"],
-              "journal": item["container-title"][0],
-              "publisher": item["publisher"],
-              "volume": volume,
-              "issue": issue,
-              "page": page,
-              "year": year,
-              "num_references": item['references-count'],
-              "times_cited": item['is-referenced-by-count']
-            })
-          except:
-            pass
-
-    return metadata_records
+          items = self._get_json(search_url, headers)['message']['items']
+        except Exception:
+          #One malformed DOI fails the whole filter, so look the batch up DOI by DOI instead
+          items = None
+        if items is not None:
+          metadata_records.extend(_metadata_record(item) for item in items)
+        else:
+          metadata_records.extend(fetch_one(doi) for doi in batch)
+      return [metadata_record for metadata_record in metadata_records if metadata_record is not None]
+
+    def batches():
+      batch = []
+      for doi in dois:
+        batch.append(doi)
+        if len(batch) == batch_size:
+          yield batch
+          batch = []
+      if batch:
+        yield batch
+
+    for metadata_records in _imap_unordered(fetch, batches(), max_workers):
+      for metadata_record in metadata_records:
+        yield metadata_record
+
+  @traced
+  def get_metadata_from_journal_issn(self, issn, rows=500, pub_after=2000, mailto="null@null.com", incremental=False,
+                                     compact=False, sink=None):
+    '''
+    Grabs metadata based on a journal ISSN using the CrossRef API
+
+    :param issn: The ISSN of the journal
+    :type issn: str
+
+    :param rows: the maximum number of DOIs to find
+    :type rows: int
+
+    :param pub_after: the minimum publication year for DOIs returned
+    :type pub_after: int
+
+    :param mailto: mailto address for API
+    :type rows: str
+
+    :param incremental: only find records indexed or updated since the last incremental run (needs a manifest)
+    :type incremental: bool
+
+    :param compact: return MetadataRecord objects instead of dicts, to save memory
+    :type compact: bool
+
+    :param sink: writer that is handed each page's records as soon as the page is parsed, e.g. a
+      JSONLMetadataWriter; nothing is kept in memory and the number of records written is returned.
+      When a manifest resumes an interrupted sweep, the pages the sink already got are not written
+      again, so resume with the same output opened with append=True
+    :type sink: object with a write(records) method
+
+    :returns: the metadata for the articles according to this ISSN (the record count when writing to a sink)
+    :rtype: list
+    '''
+
+    if sink is not None:
+      written = 0
+      pages = self._iter_issn_pages(issn, rows, pub_after, mailto, METADATA_FIELDS, incremental, replay=False)
+      for items in pages:
+        metadata_records = _page_metadata_records(items, compact)
+        sink.write(metadata_records)
+        written += len(metadata_records)
+      return written
+
+    return list(self.iter_metadata_from_journal_issn(issn, rows=rows, pub_after=pub_after, mailto=mailto,
+                                                     incremental=incremental, compact=compact))
 
   @traced
   def get_xml_from_doi(self, doi, writefile, mode):
@@ -314,30 +986,33 @@ class ArticleDownloader:
     :param doi: DOI string for the article we want to download
     :type doi: str
 
-    :param writefile: file object to write to
-    :type writefile: file
+    :param writefile: file object to write to, a path to write atomically, or an ArticleStore/ShardWriter
+    :type writefile: file or str or articledownloader.store.ArticleStore
 
-    :param mode: choose from {'elsevier' | 'aps'}, depending on how we wish to access the file
+    :param mode: choose from {'auto' | 'elsevier' | 'aps'}, depending on how we wish to access the file
     :type mode: str
 
     :returns: True on successful write, False otherwise
     :rtype: bool
     '''
 
+    self.local.last_error = None
+    if mode == 'auto':
+      return self._get_auto(self.get_xml_from_doi, doi, writefile, 'xml')
+
+    #Articles already in a store aren't fetched again
+    writefile = self._open_sink(writefile, doi, 'xml')
+    if writefile is None:
+      return True
+
     if mode == 'elsevier':
       try:
         xml_url='https://api.elsevier.com/content/article/doi/' + doi + '?view=FULL'
-        headers = {
-          'X-ELS-APIKEY': self.els_api_key,
-          'Accept': 'text/xml'
-        }
-
-        r = requests.get(xml_url, stream=True, headers=headers, timeout=self.timeout_sec)
+        r = self._get_elsevier(xml_url, 'text/xml', stream=True)
         if r.status_code == 200:
-          for chunk in r.iter_content(2048):
-            writefile.write(chunk)
+          self._write_body(r, writefile, 'xml', mode)
           return True
-      except:
+      except Exception:
         # API download limit exceeded
         return False
       return False
@@ -349,12 +1024,11 @@ class ArticleDownloader:
           'Accept': 'text/xml'
         }
 
-        r = requests.get(xml_url, stream=True, headers=headers, timeout=self.timeout_sec)
+        r = self._get(xml_url, stream=True, headers=headers, timeout=self.timeout_sec)
         if r.status_code == 200:
-          for chunk in r.iter_content(2048):
-            writefile.write(chunk)
+          self._write_body(r, writefile, 'xml', mode)
           return True
-      except:
+      except Exception:
         # API download limit exceeded
         return False
       return False
@@ -369,16 +1043,25 @@ class ArticleDownloader:
     :param doi: DOI string for the article we want to download
     :type doi: str
 
-    :param writefile: file object to write to
-    :type writefile: file
+    :param writefile: file object to write to, a path to write atomically, or an ArticleStore/ShardWriter
+    :type writefile: file or str or articledownloader.store.ArticleStore
 
-    :param mode: choose from {'elsevier' | 'springer' | 'acs' | 'ecs' | 'rsc' | 'nature' | 'wiley' | 'aaas' | 'emerald'}, depending on how we wish to access the file
+    :param mode: choose from {'auto' | 'elsevier' | 'springer' | 'acs' | 'ecs' | 'rsc' | 'nature' | 'wiley' | 'aaas' | 'emerald'}, depending on how we wish to access the file
     :type mode: str
 
     :returns: True on successful write, False otherwise
     :rtype: bool
     '''
 
+    self.local.last_error = None
+    if mode == 'auto':
+      return self._get_auto(self.get_html_from_doi, doi, writefile, 'html')
+
+    #Articles already in a store aren't fetched again
+    writefile = self._open_sink(writefile, doi, 'html')
+    if writefile is None:
+      return True
+
     if mode == 'springer':
       base_url = 'http://link.springer.com/'
       api_url = base_url + doi + '.html'
@@ -388,12 +1071,11 @@ class ArticleDownloader:
           'Accept': 'text/html',
           'User-agent': 'Mozilla/5.0'
         }
-        r = requests.get(api_url, stream=True, headers=headers, timeout=self.timeout_sec)
+        r = self._get(api_url, stream=True, headers=headers, timeout=self.timeout_sec)
         if r.status_code == 200:
-          for chunk in r.iter_content(2048):
-            writefile.write(chunk)
+          self._write_body(r, writefile, 'html', mode)
           return True
-      except:
+      except Exception:
         return False
       return False
 
@@ -406,12 +1088,11 @@ class ArticleDownloader:
           'Accept': 'text/html',
           'User-agent': 'Mozilla/5.0'
         }
-        r = requests.get(api_url, stream=True, headers=headers, timeout=self.timeout_sec)
+        r = self._get(api_url, stream=True, headers=headers, timeout=self.timeout_sec)
         if r.status_code == 200:
-          for chunk in r.iter_content(2048):
-            writefile.write(chunk)
+          self._write_body(r, writefile, 'html', mode)
           return True
-      except:
+      except Exception:
         return False
       return False
 
@@ -424,12 +1105,11 @@ class ArticleDownloader:
           'Accept': 'text/html',
           'User-agent': 'Mozilla/5.0'
         }
-        r = requests.get(api_url, stream=True, headers=headers, timeout=self.timeout_sec)
+        r = self._get(api_url, stream=True, headers=headers, timeout=self.timeout_sec)
         if r.status_code == 200:
-          for chunk in r.iter_content(2048):
-            writefile.write(chunk)
+          self._write_body(r, writefile, 'html', mode)
           return True
-      except:
+      except Exception:
         return False
       return False
 
@@ -442,54 +1122,46 @@ class ArticleDownloader:
           'Accept': 'text/html',
           'User-agent': 'Mozilla/5.0'
         }
-        r = requests.get(api_url, stream=True, headers=headers, timeout=self.timeout_sec)
+        r = self._get(api_url, stream=True, headers=headers, timeout=self.timeout_sec)
         if r.status_code == 200:
-          for chunk in r.iter_content(2048):
-            writefile.write(chunk)
+          self._write_body(r, writefile, 'html', mode)
           return True
-      except:
+      except Exception:
         return False
       return False
 
     if mode == 'rsc':
       html_string = 'articlehtml'
-      download_url = 'https://doi.org/' + doi
       headers = {
       'Accept': 'text/html',
       'User-agent': 'Mozilla/5.0'
       }
-      r = requests.get(download_url, headers=headers, timeout=self.timeout_sec)
-      url = r.url
-      url = url.encode('ascii')
-      url = url.split('/')
-      url = url[0] + '//' + url[2] + '/' + url[3] + '/' + url[4] + '/' + html_string + '/' + url[6] + '/' + url[7] + '/' + url[8]
+      def html_url(url):
+        url = url.split('/')
+        return url[0] + '//' + url[2] + '/' + url[3] + '/' + url[4] + '/' + html_string + '/' + url[6] + '/' + url[7] + '/' + url[8]
 
-      r = requests.get(url, stream=True, headers=headers, timeout=self.timeout_sec)
+      r = self._get_from_landing(doi, headers, html_url)
 
       if r.status_code == 200:
         try:
-          for chunk in r.iter_content(2048):
-            writefile.write(chunk)
+          self._write_body(r, writefile, 'html', mode)
           return True
-        except:
+        except Exception:
           return False
 
       return False
 
     if mode == 'nature':
-      download_url = 'https://doi.org/' + doi
-
       headers = {
         'Accept': 'text/html',
         'User-agent': 'Mozilla/5.0'
       }
-      r = requests.get(download_url, stream=True, headers=headers, timeout=self.timeout_sec)
+      r = self._get_landing(doi, headers, stream=True)
       if r.status_code == 200:
         try:
-          for chunk in r.iter_content(2048):
-            writefile.write(chunk)
+          self._write_body(r, writefile, 'html', mode)
           return True
-        except:
+        except Exception:
           return False
       return False
 
@@ -500,18 +1172,12 @@ class ArticleDownloader:
         'User-agent': 'Mozilla/5.0'
       }
 
-      article_url = 'https://doi.org/' + doi
-      resp = requests.get(article_url, headers=headers, timeout=self.timeout_sec)
-
-      download_url = resp.url + '.full'  #Capture fulltext from redirect
-
-      r = requests.get(download_url, stream=True, headers=headers, timeout=self.timeout_sec)
+      r = self._get_from_landing(doi, headers, lambda url: url + '.full')  #Capture fulltext from redirect
       if r.status_code == 200:
         try:
-          for chunk in r.iter_content(2048):
-            writefile.write(chunk)
+          self._write_body(r, writefile, 'html', mode)
           return True
-        except:
+        except Exception:
           return False
       return False
 
@@ -521,18 +1187,12 @@ class ArticleDownloader:
         'User-agent': 'Mozilla/5.0'
       }
 
-      article_url = 'https://doi.org/' + doi
-      resp = requests.get(article_url, headers=headers, timeout=self.timeout_sec)
-
-      download_url = resp.url + '.full'  #Capture fulltext from redirect
-
-      r = requests.get(download_url, stream=True, headers=headers, timeout=self.timeout_sec)
+      r = self._get_from_landing(doi, headers, lambda url: url + '.full')  #Capture fulltext from redirect
       if r.status_code == 200:
         try:
-          for chunk in r.iter_content(2048):
-            writefile.write(chunk)
+          self._write_body(r, writefile, 'html', mode)
           return True
-        except:
+        except Exception:
           return False
       return False
 
@@ -546,16 +1206,25 @@ class ArticleDownloader:
     :param doi: DOI string for the article we want to download
     :type doi: str
 
-    :param writefile: file object to write to
-    :type writefile: file
+    :param writefile: file object to write to, a path to write atomically, or an ArticleStore/ShardWriter
+    :type writefile: file or str or articledownloader.store.ArticleStore
 
-    :param mode: choose from {'crossref' | 'elsevier' | 'rsc' | 'springer' | 'ecs' | 'nature' | 'acs'}, depending on how we wish to access the file
+    :param mode: choose from {'auto' | 'crossref' | 'elsevier' | 'rsc' | 'springer' | 'ecs' | 'nature' | 'acs'}, depending on how we wish to access the file
     :type mode: str
 
     :returns: True on successful write, False otherwise
     :rtype: bool
     '''
 
+    self.local.last_error = None
+    if mode == 'auto':
+      return self._get_auto(self.get_pdf_from_doi, doi, writefile, 'pdf')
+
+    #Articles already in a store aren't fetched again
+    writefile = self._open_sink(writefile, doi, 'pdf')
+    if writefile is None:
+      return True
+
     if mode == 'crossref':
       base_url = 'http://api.crossref.org/works/'
       api_url = base_url + doi
@@ -565,115 +1234,93 @@ class ArticleDownloader:
       }
 
       try:
-        response = json.loads(requests.get(api_url, headers=headers, timeout=self.timeout_sec).text)
+        response = self._get_json(api_url, headers, cached=True)
         pdf_url = response['message']['link'][0]['URL']
         app_type = str(response['message']['link'][0]['content-type'])
 
         if app_type in ['application/pdf', 'unspecified']:
           headers['Accept'] = 'application/pdf'
-          r = requests.get(pdf_url, stream=True, headers=headers)
+          r = self._get(pdf_url, stream=True, headers=headers)
           if r.status_code == 200:
-            for chunk in r.iter_content(2048):
-              writefile.write(chunk)
+            self._write_body(r, writefile, 'pdf', mode)
             return True
-      except:
+      except Exception:
         return False
       return False
 
     if mode == 'elsevier':
       try:
         pdf_url='http://api.elsevier.com/content/article/doi:' + doi + '?view=FULL'
-        headers = {
-          'X-ELS-APIKEY': self.els_api_key,
-          'Accept': 'application/pdf'
-        }
-
-        r = requests.get(pdf_url, stream=True, headers=headers, timeout=self.timeout_sec)
+        r = self._get_elsevier(pdf_url, 'application/pdf', stream=True)
         if r.status_code == 200:
-          for chunk in r.iter_content(2048):
-            writefile.write(chunk)
+          self._write_body(r, writefile, 'pdf', mode)
           return True
-      except:
+      except Exception:
         # API download limit exceeded
         return False
       return False
 
     if mode == 'rsc':
       scraper = scrapers.RSC()
-      scrape_url = 'https://doi.org/' + doi
       download_url = None
 
-      r = requests.get(scrape_url, timeout=self.timeout_sec)
+      r = self._get_landing(doi, stream=True)
       if r.status_code == 200:
-        scraper.feed(r.content)
-
-        if scraper.download_link is not None:
-          download_url = scraper.download_link
+        download_url = scraper.feed_response(r)
 
       if download_url is not None:
         headers = {
           'Accept': 'application/pdf'
         }
-        r = requests.get(download_url, stream=True, headers=headers, timeout=self.timeout_sec)
+        r = self._get(download_url, stream=True, headers=headers, timeout=self.timeout_sec)
         if r.status_code == 200:
           try:
-            for chunk in r.iter_content(2048):
-              writefile.write(chunk)
+            self._write_body(r, writefile, 'pdf', mode)
             return True
-          except:
+          except Exception:
             return False
       return False
 
     if mode == 'ecs':
       scraper = scrapers.ECS()
-      scrape_url = 'https://doi.org/' + doi
       download_url = None
 
-      r = requests.get(scrape_url, timeout=self.timeout_sec)
+      r = self._get_landing(doi, stream=True)
       if r.status_code == 200:
-        scraper.feed(r.content)
-
-        if scraper.download_link is not None:
-          download_url = scraper.download_link
+        download_url = scraper.feed_response(r)
 
       if download_url is not None:
         headers = {
           'Accept': 'application/pdf'
         }
-        r = requests.get(download_url, stream=True, headers=headers, timeout=self.timeout_sec)
+        r = self._get(download_url, stream=True, headers=headers, timeout=self.timeout_sec)
         if r.status_code == 200:
           try:
-            for chunk in r.iter_content(2048):
-              writefile.write(chunk)
+            self._write_body(r, writefile, 'pdf', mode)
             return True
-          except:
+          except Exception:
             return False
 
       return False
 
     if mode == 'nature':
       scraper = scrapers.Nature()
-      scrape_url = 'https://doi.org/' + doi
       download_url = None
 
-      r = requests.get(scrape_url, timeout=self.timeout_sec)
+      r = self._get_landing(doi, stream=True)
       if r.status_code == 200:
-        scraper.feed(r.content)
-
-        if scraper.download_link is not None:
-          download_url = scraper.download_link
+        download_url = scraper.feed_response(r)
 
       if download_url is not None:
         headers = {
           'Accept': 'application/pdf'
         }
-        r = requests.get(download_url, stream=True, headers=headers, timeout=self.timeout_sec)
+        r = self._get(download_url, stream=True, headers=headers, timeout=self.timeout_sec)
         if r.status_code == 200:
           try:
-            for chunk in r.iter_content(2048):
-              writefile.write(chunk)
+            self._write_body(r, writefile, 'pdf', mode)
             return True
-          except:
+          except Exception:
             return False
 
       return False
@@ -687,12 +1334,11 @@ class ArticleDownloader:
           'Accept': 'application/pdf',
           'User-agent': 'Mozilla/5.0'
         }
-        r = requests.get(api_url, stream=True, headers=headers, timeout=self.timeout_sec)
+        r = self._get(api_url, stream=True, headers=headers, timeout=self.timeout_sec)
         if r.status_code == 200:
-          for chunk in r.iter_content(2048):
-            writefile.write(chunk)
+          self._write_body(r, writefile, 'pdf', mode)
           return True
-      except:
+      except Exception:
         return False
       return False
 
@@ -705,17 +1351,85 @@ class ArticleDownloader:
           'Accept': 'application/pdf',
           'User-agent': 'Mozilla/5.0'
         }
-        r = requests.get(api_url, stream=True, headers=headers, timeout=self.timeout_sec)
+        r = self._get(api_url, stream=True, headers=headers, timeout=self.timeout_sec)
         if r.status_code == 200:
-          for chunk in r.iter_content(2048):
-            writefile.write(chunk)
+          self._write_body(r, writefile, 'pdf', mode)
           return True
-      except:
+      except Exception:
         return False
       return False
 
     return False
 
+  @traced
+  def download_many(self, dois, mode, out_dir, fmt='pdf', max_workers=8, max_per_host=4):
+    '''
+    Downloads many articles concurrently, writing each one to its own file in a directory
+
+    :param dois: DOI strings for the articles we want to download
+    :type dois: iterable
+
+    :param mode: operating mode, as accepted by the get_*_from_doi method for this format ('auto' picks one per DOI)
+    :type mode: str
+
+    :param out_dir: directory to write the files to (created if missing), or an ArticleStore/ShardWriter
+    :type out_dir: str or articledownloader.store.ArticleStore
+
+    :param fmt: choose from {'pdf' | 'html' | 'xml'}
+    :type fmt: str
+
+    :param max_workers: number of download threads
+    :type max_workers: int
+
+    :param max_per_host: max number of simultaneous downloads from one publisher
+    :type max_per_host: int
+
+    :returns: (doi, path, success) tuples, yielded as each download finishes (path is None when
+              downloading into a store or shards); with a resuming manifest, DOIs downloaded by an earlier run
+              are yielded as successes without refetching
+    :rtype: generator
+    '''
+
+    getters = {
+      'pdf': self.get_pdf_from_doi,
+      'html': self.get_html_from_doi,
+      'xml': self.get_xml_from_doi
+    }
+    if fmt not in getters:
+      raise ValueError('fmt must be one of ' + ', '.join(sorted(getters)))
+    getter = getters[fmt]
+
+    store = out_dir if hasattr(out_dir, 'writer') else None
+    if store is None and not os.path.isdir(out_dir):
+      os.makedirs(out_dir)
+
+    #Slots are keyed by the DOI's publisher rather than the mode: crossref and the doi.org modes
+    #reach whichever host the DOI lives on
+    host_slots = {}
+    def download(doi, mode):
+      path = os.path.join(out_dir, quote(doi, safe='') + '.' + fmt) if store is None else None
+      if self.manifest is not None and self.manifest.is_done(doi, fmt):
+        return doi, path, True
+      if store is not None and store.has(doi, fmt):
+        return doi, path, True
+
+      #Paths are written atomically, so a failed download never leaves a partial file behind
+      success = False
+      error = None
+      with host_slots.setdefault(self.router.publisher(doi), BoundedSemaphore(max_per_host)):
+        try:
+          success = getter(doi, path if store is None else store, mode)
+        except Exception as e:
+          error = repr(e)
+      if not success and error is None:
+        error = repr(self.last_error) if self.last_error is not None else 'download failed'
+
+      if self.manifest is not None:
+        self.manifest.record_download(doi, fmt, mode, success, error)
+      return doi, path, success
+
+    return _imap_unordered(lambda doi: download(doi, mode), dois, max_workers)
+
   @traced
   def get_abstract_from_doi(self, doi, mode):
     '''
@@ -734,17 +1448,11 @@ class ArticleDownloader:
     if mode == 'elsevier':
       try:
         url='http://api.elsevier.com/content/article/doi/' + doi + '?view=FULL'
-
-        headers = {
-          'X-ELS-APIKEY': self.els_api_key,
-          'Accept': 'application/json'
-        }
-
-        r = requests.get(url, headers=headers, timeout=self.timeout_sec)
+        r = self._get_elsevier(url, 'application/json', cached=True)
         if r.status_code == 200:
           abstract = unicode(json.loads(r.text)['full-text-retrieval-response']['coredata']['dc:description'])
           return abstract
-      except:
+      except Exception:
         # API download limit exceeded or no abstract exists
         return None
 
@@ -769,15 +1477,14 @@ class ArticleDownloader:
       try:
         url='http://api.crossref.org/works/' + doi
         headers = {
-          'X-ELS-APIKEY': self.els_api_key,
           'Accept': 'application/json'
         }
 
-        r = requests.get(url, headers=headers, timeout=self.timeout_sec)
+        r = self._get_cached(url, headers)
         if r.status_code == 200:
           title = unicode(r.json()['message']['title'][0])
           return title
-      except:
+      except Exception:
         # API download limit exceeded or no title exists
         return None
 
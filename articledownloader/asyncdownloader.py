@@ -0,0 +1,414 @@
+'''
+asyncio counterpart to ArticleDownloader, built on aiohttp
+'''
+
+import asyncio
+import inspect
+import aiohttp
+from articledownloader import scrapers
+from articledownloader.keypool import APIKeyPool, QuotaExhaustedError
+from articledownloader.articledownloader import _loads, _metadata_record, DOI_FIELDS
+from articledownloader.ratelimit import DEFAULT_DOWNLOAD_RATE_LIMIT, build_rate_limiter
+from articledownloader.resolver import DOIResolver
+from articledownloader.validation import InvalidPayload, validator_for
+from articledownloader.writers import DEFAULT_CHUNK_SIZE, HEAD_BYTES
+from autologging import logged
+from requests.utils import quote
+from urllib.parse import urlparse
+
+@logged
+class AsyncArticleDownloader:
+
+  def __init__(self, els_api_key=None, sleep_sec=None, timeout_sec=30, pool_size=10, rate_limits=None, resolver=None,
+               download_rate_limit=DEFAULT_DOWNLOAD_RATE_LIMIT, chunk_size=DEFAULT_CHUNK_SIZE, validate=True):
+    '''
+    Initialize and set up API keys
+
+    :param els_api_key: API key for Elsevier (for Elsevier's API), or several keys to rotate over by remaining quota
+    :type els_api_key: str or list or articledownloader.keypool.APIKeyPool
+    :param sleep_sec: Min time between CrossRef API calls (default = CrossRef's limit of 10 requests/s, burst 10)
+    :type sleep_sec: float
+    :param timeout_sec: Max time before timeout (default = 30s)
+    :type timeout_sec: int
+    :param pool_size: Max number of open connections per host (default = 10)
+    :type pool_size: int
+    :param rate_limits: (requests/sec, burst) per host or domain, e.g. {'nature.com': (2, 5)}
+    :type rate_limits: dict
+    :param download_rate_limit: (requests/sec, burst) for doi.org and each publisher host without its own
+      entry in rate_limits (default = (5, 5); None for no limit)
+    :type download_rate_limit: tuple
+    :param resolver: cache of DOI landing page URLs (default = an in-memory DOIResolver)
+    :type resolver: articledownloader.resolver.DOIResolver
+    :param chunk_size: Max bytes handed to writefile.write at once (default = 1MB)
+    :type chunk_size: int
+    :param validate: Check the first bytes of each article and abort paywall/error pages (default = True)
+    :type validate: bool
+    '''
+    self.els_api_key = els_api_key
+    if els_api_key is None or isinstance(els_api_key, APIKeyPool):
+      self.els_keys = els_api_key
+    else:
+      self.els_keys = APIKeyPool([els_api_key] if isinstance(els_api_key, str) else els_api_key)
+    self.sleep_sec = sleep_sec
+    self.timeout_sec = timeout_sec
+    self.pool_size = pool_size
+    self.chunk_size = chunk_size
+    self.validate = validate
+    self.session = None
+    self.resolver = resolver if resolver is not None else DOIResolver()
+
+    self.rate_limiter = build_rate_limiter(sleep_sec, download_rate_limit, rate_limits)
+
+  async def _get_session(self, url):
+    #Wait for the host's rate limit without blocking the event loop
+    delay = self.rate_limiter.reserve(urlparse(url).hostname)
+    if delay > 0:
+      await asyncio.sleep(delay)
+
+    #aiohttp sessions have to be created from inside a running event loop
+    if self.session is None or self.session.closed:
+      connector = aiohttp.TCPConnector(limit_per_host=self.pool_size)
+      timeout = aiohttp.ClientTimeout(total=self.timeout_sec)
+      self.session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+    return self.session
+
+  async def close(self):
+    '''
+    Closes all pooled connections held by this downloader, and saves the DOI resolver cache
+    '''
+    if self.session is not None:
+      await self.session.close()
+    self.resolver.save()
+
+  async def __aenter__(self):
+    return self
+
+  async def __aexit__(self, *exc_info):
+    await self.close()
+
+  async def _get_json(self, url, headers):
+    session = await self._get_session(url)
+    async with session.get(url, headers=headers) as r:
+      return _loads(await r.read())
+
+  async def _write(self, url, headers, writefile, fmt, mode):
+    '''
+    Streams a response body into writefile, which may be a regular file object
+    or one whose write method is a coroutine (e.g. an aiofiles handle). The first
+    bytes are held back and checked before anything is written.
+    '''
+    check = validator_for(fmt, mode) if self.validate else None
+    session = await self._get_session(url)
+    async with session.get(url, headers=headers) as r:
+      if headers.get('X-ELS-APIKEY') is not None:
+        self.els_keys.update(headers['X-ELS-APIKEY'], r.status, r.headers)
+      if r.status != 200:
+        return False
+      head = bytearray() if check is not None else None
+      async for chunk in r.content.iter_chunked(self.chunk_size):
+        if head is not None:
+          head += chunk
+          if len(head) < HEAD_BYTES:
+            continue
+          check(head, False)
+          chunk, head = bytes(head), None
+        result = writefile.write(chunk)
+        if inspect.isawaitable(result):
+          await result
+      if head is not None:
+        check(head, True)
+        result = writefile.write(bytes(head))
+        if inspect.isawaitable(result):
+          await result
+      return True
+
+  def _elsevier_headers(self, accept):
+    #aiohttp can't send a None header the way requests drops it, so without a key there is none
+    headers = {
+      'Accept': accept
+    }
+    if self.els_keys is not None:
+      headers['X-ELS-APIKEY'] = self.els_keys.acquire()
+    return headers
+
+  async def _resolve(self, doi, headers):
+    #Follow the doi.org redirect chain
+    session = await self._get_session('https://doi.org/')
+    async with session.get('https://doi.org/' + doi, headers=headers) as r:
+      if r.history:
+        self.resolver.learn(doi, str(r.url))
+      return str(r.url)
+
+  async def _write_from_landing(self, doi, headers, download_url, writefile, fmt, mode):
+    '''
+    Writes download_url(landing URL) for a DOI. A landing URL known to the resolver is tried
+    first; if what is built from it doesn't work, the resolver forgets it and the DOI is
+    resolved through doi.org again.
+    '''
+    url = self.resolver.lookup(doi)
+    if url is not None:
+      if await self._write(download_url(url), headers, writefile, fmt, mode):
+        return True
+      self.resolver.forget(doi)
+
+    return await self._write(download_url(await self._resolve(doi, headers)), headers, writefile, fmt, mode)
+
+  async def _scrape(self, scraper, doi):
+    url = self.resolver.lookup(doi) or 'https://doi.org/' + doi
+    session = await self._get_session(url)
+    async with session.get(url) as r:
+      if r.status != 200:
+        self.resolver.forget(doi)
+        return None
+      if r.history:
+        self.resolver.learn(doi, str(r.url))
+
+      #Stop reading the page as soon as the link turns up; leaving the block drops the connection
+      decoder = scrapers.incremental_decoder(r.charset)
+      async for chunk in r.content.iter_chunked(8192):
+        scraper.feed(decoder.decode(chunk))
+        if scraper.done:
+          break
+    return scraper.download_link
+
+  async def _crossref_items(self, base_url, rows, headers, select=None):
+    max_rows = 1000 #Defined by CrossRef API
+
+    if select is not None:
+      base_url = base_url + '&select=' + ','.join(select)
+
+    if rows <= max_rows: #No multi-query needed
+      response = await self._get_json(base_url + '&rows=' + str(rows), headers)
+      return response['message']['items']
+
+    items = []
+    cursor = '*'
+    while True:
+      response = await self._get_json(base_url + '&rows=' + str(max_rows) + '&cursor=' + cursor, headers)
+      page = response['message']['items']
+      if len(page) == 0:
+        break
+      cursor = quote(response['message']['next-cursor'], safe='')
+      items.extend(page)
+    return items
+
+  async def get_dois_from_search(self, query, rows=500, mailto="null@null.com"):
+    '''
+    Grabs a set of unique DOIs based on a search query using the CrossRef API
+
+    :param query: the search string
+    :type query: str
+
+    :param rows: the maximum number of DOIs to find
+    :type rows: int
+
+    :param mailto: mailto address for API
+    :type rows: str
+
+    :returns: the unique set of DOIs as a list
+    :rtype: list
+    '''
+
+    headers = {
+      'Accept': 'application/json',
+      'User-agent': 'mailto:' + mailto
+    }
+    items = await self._crossref_items('https://api.crossref.org/works?query=' + query, rows, headers, select=DOI_FIELDS)
+    return list(set(item['DOI'] for item in items))
+
+  async def get_dois_from_journal_issn(self, issn, rows=500, pub_after=2000, mailto="null@null.com"):
+    '''
+    Grabs a set of unique DOIs based on a journal ISSN using the CrossRef API
+
+    :param issn: The ISSN of the journal
+    :type issn: str
+
+    :param rows: the maximum number of DOIs to find
+    :type rows: int
+
+    :param pub_after: the minimum publication year for DOIs returned
+    :type pub_after: int
+
+    :param mailto: mailto address for API
+    :type rows: str
+
+    :returns: the unique set of DOIs as a list
+    :rtype: list
+    '''
+
+    headers = {
+      'Accept': 'application/json',
+      'User-agent': 'mailto:' + mailto
+    }
+    base_url = 'https://api.crossref.org/journals/' + issn + '/works?filter=from-pub-date:' + str(pub_after)
+    items = await self._crossref_items(base_url, rows, headers, select=DOI_FIELDS)
+    return list(set(item['DOI'] for item in items))
+
+  async def get_metadata_from_doi(self, doi, mailto="null@null.com"):
+    '''
+    Grabs the metadata record for a single DOI using the CrossRef API
+
+    :param doi: DOI string for the article we want to grab metadata for
+    :type doi: str
+
+    :param mailto: mailto address for API
+    :type rows: str
+
+    :returns: the metadata record (or None on failure)
+    :rtype: dict
+    '''
+
+    headers = {
+      'Accept': 'application/json',
+      'User-agent': 'mailto:' + mailto
+    }
+    response = await self._get_json('https://api.crossref.org/works/' + str(doi), headers)
+    return _metadata_record(response['message'])
+
+  async def get_xml_from_doi(self, doi, writefile, mode):
+    '''
+    Downloads and writes an XML article to a file, given a DOI and operating mode
+
+    :param doi: DOI string for the article we want to download
+    :type doi: str
+
+    :param writefile: file object to write to; write may be a coroutine
+    :type writefile: file
+
+    :param mode: choose from {'elsevier' | 'aps'}, depending on how we wish to access the file
+    :type mode: str
+
+    :returns: True on successful write, False otherwise
+    :rtype: bool
+    '''
+
+    try:
+      if mode == 'elsevier':
+        headers = self._elsevier_headers('text/xml')
+        xml_url = 'https://api.elsevier.com/content/article/doi/' + doi + '?view=FULL'
+        return await self._write(xml_url, headers, writefile, 'xml', mode)
+
+      if mode == 'aps':
+        headers = {
+          'Accept': 'text/xml'
+        }
+        return await self._write('http://harvest.aps.org/v2/journals/articles/' + doi, headers, writefile, 'xml', mode)
+    except (InvalidPayload, QuotaExhaustedError, aiohttp.ClientError, asyncio.TimeoutError):
+      return False
+
+    return False
+
+  async def get_html_from_doi(self, doi, writefile, mode):
+    '''
+    Downloads and writes an HTML article to a file, given a DOI and operating mode
+
+    :param doi: DOI string for the article we want to download
+    :type doi: str
+
+    :param writefile: file object to write to; write may be a coroutine
+    :type writefile: file
+
+    :param mode: choose from {'elsevier' | 'springer' | 'acs' | 'ecs' | 'rsc' | 'nature' | 'wiley' | 'aaas' | 'emerald'}, depending on how we wish to access the file
+    :type mode: str
+
+    :returns: True on successful write, False otherwise
+    :rtype: bool
+    '''
+
+    headers = {
+      'Accept': 'text/html',
+      'User-agent': 'Mozilla/5.0'
+    }
+
+    direct_urls = {
+      'springer': 'http://link.springer.com/' + doi + '.html',
+      'wiley': 'http://onlinelibrary.wiley.com/doi/' + doi + '/full',
+      'acs': 'http://pubs.acs.org/doi/full/' + doi,
+      'emerald': 'http://www.emeraldinsight.com/doi/full/' + doi,
+      'nature': 'https://doi.org/' + doi
+    }
+
+    try:
+      if mode in direct_urls:
+        return await self._write(direct_urls[mode], headers, writefile, 'html', mode)
+
+      if mode == 'rsc':
+        def html_url(url):
+          url = url.split('/')
+          return url[0] + '//' + url[2] + '/' + url[3] + '/' + url[4] + '/articlehtml/' + url[6] + '/' + url[7] + '/' + url[8]
+        return await self._write_from_landing(doi, headers, html_url, writefile, 'html', mode)
+
+      if mode in ['aaas', 'ecs']:
+        #Capture fulltext from redirect
+        return await self._write_from_landing(doi, headers, lambda url: url + '.full', writefile, 'html', mode)
+    except (InvalidPayload, aiohttp.ClientError, asyncio.TimeoutError, IndexError):
+      return False
+
+    return False
+
+  async def get_pdf_from_doi(self, doi, writefile, mode):
+    '''
+    Downloads and writes a PDF article to a file, given a DOI and operating mode
+
+    :param doi: DOI string for the article we want to download
+    :type doi: str
+
+    :param writefile: file object to write to; write may be a coroutine
+    :type writefile: file
+
+    :param mode: choose from {'crossref' | 'elsevier' | 'rsc' | 'springer' | 'ecs' | 'nature' | 'acs'}, depending on how we wish to access the file
+    :type mode: str
+
+    :returns: True on successful write, False otherwise
+    :rtype: bool
+    '''
+
+    scraper_classes = {
+      'rsc': scrapers.RSC,
+      'ecs': scrapers.ECS,
+      'nature': scrapers.Nature
+    }
+
+    try:
+      if mode == 'crossref':
+        headers = {
+          'Accept': 'application/json'
+        }
+        response = await self._get_json('http://api.crossref.org/works/' + doi, headers)
+        pdf_url = response['message']['link'][0]['URL']
+        app_type = str(response['message']['link'][0]['content-type'])
+
+        if app_type in ['application/pdf', 'unspecified']:
+          headers['Accept'] = 'application/pdf'
+          return await self._write(pdf_url, headers, writefile, 'pdf', mode)
+        return False
+
+      if mode == 'elsevier':
+        headers = self._elsevier_headers('application/pdf')
+        pdf_url = 'http://api.elsevier.com/content/article/doi:' + doi + '?view=FULL'
+        return await self._write(pdf_url, headers, writefile, 'pdf', mode)
+
+      if mode in scraper_classes:
+        download_url = await self._scrape(scraper_classes[mode](), doi)
+        if download_url is None:
+          return False
+        headers = {
+          'Accept': 'application/pdf'
+        }
+        return await self._write(download_url, headers, writefile, 'pdf', mode)
+
+      if mode in ['acs', 'springer']:
+        base_url = {
+          'acs': 'http://pubs.acs.org/doi/pdf/',
+          'springer': 'http://link.springer.com/content/pdf/'
+        }[mode]
+        headers = {
+          'Accept': 'application/pdf',
+          'User-agent': 'Mozilla/5.0'
+        }
+        return await self._write(base_url + doi, headers, writefile, 'pdf', mode)
+    except (InvalidPayload, QuotaExhaustedError, aiohttp.ClientError, asyncio.TimeoutError, KeyError, IndexError,
+            ValueError):
+      return False
+
+    return False
@@ -0,0 +1,165 @@
+'''
+Persistent HTTP cache for metadata lookups (CrossRef works, Elsevier article JSON), stored in SQLite
+'''
+
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+import requests
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+class HTTPCache:
+  '''
+  Caches successful GET responses on disk, keyed by URL plus the request headers that
+  change the response. Entries older than the TTL are revalidated with ETag/Last-Modified
+  when the server supplied them, and the least recently used entries are evicted once the
+  cache grows past its size limit.
+  '''
+
+  #Request headers that select a different representation of the same URL (API keys don't, so
+  #lookups made with any key of a pool share one entry)
+  vary = ('Accept',)
+
+  def __init__(self, path, ttl_sec=7 * 24 * 3600, max_bytes=512 * 1024 * 1024):
+    '''
+    :param path: SQLite file to keep the cache in (created if missing)
+    :type path: str
+
+    :param ttl_sec: time an entry is served without asking the server again (default = 1 week)
+    :type ttl_sec: int
+
+    :param max_bytes: max total size of cached bodies before LRU eviction (default = 512MB)
+    :type max_bytes: int
+    '''
+    self.path = path
+    self.ttl_sec = ttl_sec
+    self.max_bytes = max_bytes
+    self.lock = threading.Lock()
+    self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+    with self.lock, self.db:
+      self.db.execute('''
+        CREATE TABLE IF NOT EXISTS responses (
+          key TEXT PRIMARY KEY,
+          url TEXT,
+          status INTEGER,
+          headers TEXT,
+          body BLOB,
+          etag TEXT,
+          last_modified TEXT,
+          stored REAL,
+          accessed REAL,
+          size INTEGER
+        )''')
+      self.db.execute('CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)')
+
+  def key(self, url, headers):
+    '''
+    Returns the cache key for a request
+    '''
+    headers = CaseInsensitiveDict(headers or {})
+    parts = [url] + [name + ':' + str(headers.get(name)) for name in self.vary]
+    return hashlib.sha1('\n'.join(parts).encode('utf-8')).hexdigest()
+
+  def lookup(self, url, headers):
+    '''
+    Finds the cached entry for a request, fresh or not
+
+    :returns: the entry, or None if the request was never cached
+    :rtype: dict
+    '''
+    key = self.key(url, headers)
+    with self.lock, self.db:
+      row = self.db.execute('SELECT url, status, headers, body, etag, last_modified, stored FROM responses WHERE key = ?',
+                            (key,)).fetchone()
+      if row is None:
+        return None
+      self.db.execute('UPDATE responses SET accessed = ? WHERE key = ?', (time.time(), key))
+
+    return {
+      'key': key,
+      'url': row[0],
+      'status': row[1],
+      'headers': json.loads(row[2]),
+      'body': bytes(row[3]),
+      'etag': row[4],
+      'last_modified': row[5],
+      'stored': row[6]
+    }
+
+  def is_fresh(self, entry):
+    '''
+    True if the entry can be served without revalidation
+    '''
+    return time.time() - entry['stored'] < self.ttl_sec
+
+  def revalidation_headers(self, entry):
+    '''
+    Conditional request headers for revalidating a stale entry
+    '''
+    headers = {}
+    if entry['etag']:
+      headers['If-None-Match'] = entry['etag']
+    if entry['last_modified']:
+      headers['If-Modified-Since'] = entry['last_modified']
+    return headers
+
+  def refresh(self, entry):
+    '''
+    Marks a stale entry as fresh again, after the server answered 304 Not Modified
+    '''
+    with self.lock, self.db:
+      self.db.execute('UPDATE responses SET stored = ? WHERE key = ?', (time.time(), entry['key']))
+
+  def store(self, url, headers, r):
+    '''
+    Saves a successful response, then evicts old entries if the cache is over its size limit
+    '''
+    if r.status_code != 200:
+      return
+
+    now = time.time()
+    body = r.content
+    with self.lock, self.db:
+      self.db.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                      (self.key(url, headers), url, r.status_code, json.dumps(dict(r.headers)), sqlite3.Binary(body),
+                       r.headers.get('ETag'), r.headers.get('Last-Modified'), now, now, len(body)))
+      self._evict()
+
+  def _evict(self):
+    total = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+    if total <= self.max_bytes:
+      return
+    for key, size in self.db.execute('SELECT key, size FROM responses ORDER BY accessed').fetchall():
+      self.db.execute('DELETE FROM responses WHERE key = ?', (key,))
+      total -= size
+      if total <= self.max_bytes:
+        return
+
+  def response(self, entry):
+    '''
+    Rebuilds a requests.Response from a cached entry
+    '''
+    r = requests.Response()
+    r.status_code = entry['status']
+    r.url = entry['url']
+    r.headers = CaseInsensitiveDict(entry['headers'])
+    r.encoding = get_encoding_from_headers(r.headers)
+    r._content = entry['body']
+    r.from_cache = True
+    return r
+
+  def clear(self):
+    '''
+    Removes every cached entry
+    '''
+    with self.lock, self.db:
+      self.db.execute('DELETE FROM responses')
+
+  def close(self):
+    '''
+    Closes the underlying SQLite connection
+    '''
+    self.db.close()
@@ -0,0 +1,128 @@
+'''
+Rotates requests over several Elsevier API keys, using the quota each key has left
+'''
+
+import threading
+import time
+
+class QuotaExhaustedError(Exception):
+  '''
+  Raised when every key in a pool has used up its quota
+  '''
+
+  def __init__(self, retry_at):
+    Exception.__init__(self, 'every API key is out of quota until ' +
+                       time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(retry_at)))
+    self.retry_at = retry_at
+
+class APIKeyPool:
+  '''
+  Hands out the key with the most quota left, going by the X-RateLimit-Limit/-Remaining/-Reset
+  headers of the responses each key got. A key that runs out (Remaining hits 0, or X-ELS-Status
+  says QUOTA_EXCEEDED) is set aside until its reset time. A 429 that only throttles a key (too
+  many requests per second) sets it aside for the Retry-After, or throttle_sec. Keys that haven't
+  been used yet are assumed to have their whole quota.
+  '''
+
+  def __init__(self, keys, default_cooldown_sec=3600, throttle_sec=1):
+    '''
+    :param keys: API keys
+    :type keys: list
+
+    :param default_cooldown_sec: time an exhausted key is set aside when no reset time was sent
+    :type default_cooldown_sec: float
+
+    :param throttle_sec: time a throttled key (a 429 with quota left) is set aside when no Retry-After was sent
+    :type throttle_sec: float
+    '''
+    if not keys:
+      raise ValueError('an APIKeyPool needs at least one key')
+    self.keys = list(keys)
+    self.default_cooldown_sec = default_cooldown_sec
+    self.throttle_sec = throttle_sec
+    self.remaining = dict((key, None) for key in self.keys)
+    self.limits = dict((key, None) for key in self.keys)
+    self.resets = dict((key, None) for key in self.keys)
+    self.exhausted_until = dict((key, 0) for key in self.keys)
+    self.lock = threading.Lock()
+
+  def __len__(self):
+    return len(self.keys)
+
+  def _headroom(self, key):
+    if self.remaining[key] is not None:
+      return self.remaining[key]
+    return self.limits[key] if self.limits[key] is not None else float('inf')
+
+  def acquire(self):
+    '''
+    Returns the key with the most quota left, and counts one request against it
+
+    :raises QuotaExhaustedError: if every key is set aside
+    '''
+    now = time.time()
+    with self.lock:
+      for key in self.keys:
+        if self.exhausted_until[key] and self.exhausted_until[key] <= now:
+          #Past its reset time, a key's quota is whole again; a throttled key just keeps what it had
+          self.exhausted_until[key] = 0
+          if self.remaining[key] == 0:
+            self.remaining[key] = self.limits[key]
+
+      available = [key for key in self.keys if self.exhausted_until[key] <= now]
+      if not available:
+        raise QuotaExhaustedError(min(self.exhausted_until.values()))
+
+      #max() keeps the first of equal keys, so untested keys are used in order
+      key = max(available, key=self._headroom)
+      if self.remaining[key] is not None:
+        self.remaining[key] = max(0, self.remaining[key] - 1)
+      return key
+
+  def update(self, key, status, headers):
+    '''
+    Records the quota a response reports for a key
+
+    :param status: HTTP status of the response
+    :type status: int
+
+    :param headers: response headers
+    :type headers: dict-like
+    '''
+    limit = _int_header(headers, 'X-RateLimit-Limit')
+    remaining = _int_header(headers, 'X-RateLimit-Remaining')
+    reset = _int_header(headers, 'X-RateLimit-Reset')
+    if reset is not None and reset < 10 ** 9:
+      #Seconds from now rather than a timestamp
+      reset += time.time()
+
+    with self.lock:
+      if limit is not None:
+        self.limits[key] = limit
+      if remaining is not None:
+        self.remaining[key] = remaining
+      if reset is not None:
+        self.resets[key] = reset
+      now = time.time()
+      if remaining == 0 or 'QUOTA_EXCEEDED' in (headers.get('X-ELS-Status') or '').upper():
+        self.remaining[key] = 0
+        reset_at = self.resets[key]
+        self.exhausted_until[key] = reset_at if reset_at is not None and reset_at > now else now + self.default_cooldown_sec
+      elif status == 429:
+        #Throttled, not out of quota: the key is only rested briefly
+        retry_after = _int_header(headers, 'Retry-After')
+        self.exhausted_until[key] = now + (retry_after if retry_after is not None else self.throttle_sec)
+
+  def headroom(self):
+    '''
+    Returns the quota left for each key (None if unknown), and 0 for keys that are set aside
+    '''
+    now = time.time()
+    with self.lock:
+      return dict((key, 0 if self.exhausted_until[key] > now else self.remaining[key]) for key in self.keys)
+
+def _int_header(headers, name):
+  try:
+    return int(float(headers.get(name)))
+  except (TypeError, ValueError):
+    return None
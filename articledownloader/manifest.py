@@ -0,0 +1,193 @@
+'''
+Durable record of crawl progress (CrossRef cursors and per-DOI download outcomes), stored in SQLite
+'''
+
+import json
+import sqlite3
+import threading
+import time
+
+class CrawlManifest:
+  '''
+  Checkpoints long-running harvests so they can be resumed after a crash.
+
+  Each CrossRef cursor sweep is keyed by its query URL. After every page, the page's items
+  and the cursor for the next page are committed together, so a resumed sweep replays the
+  stored pages and then carries on from exactly the page where the previous run stopped.
+  Sweeps that stream into a sink and never replay keep only the cursor and page count.
+  CrossRef drops cursors that go unused for a few minutes; when a resumed cursor is rejected,
+  the sweep starts over from the first page and leaves out the DOIs on the stored pages, or
+  as many pages as were checkpointed when none are stored.
+  Download outcomes are kept per (DOI, format), so finished downloads can be skipped, and
+  incremental harvests keep the date they last ran up to as a per-key high-water mark.
+  '''
+
+  def __init__(self, path, resume=True):
+    '''
+    :param path: SQLite file to keep the manifest in (created if missing)
+    :type path: str
+
+    :param resume: pick up unfinished sweeps and skip finished downloads (default = True)
+    :type resume: bool
+    '''
+    self.path = path
+    self.resume = resume
+    self.lock = threading.Lock()
+    self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+    with self.lock, self.db:
+      self.db.execute('''
+        CREATE TABLE IF NOT EXISTS sweeps (
+          key TEXT PRIMARY KEY,
+          cursor TEXT,
+          pages INTEGER,
+          done INTEGER,
+          updated REAL
+        )''')
+      self.db.execute('''
+        CREATE TABLE IF NOT EXISTS sweep_pages (
+          key TEXT,
+          page INTEGER,
+          items TEXT,
+          PRIMARY KEY (key, page)
+        )''')
+      self.db.execute('''
+        CREATE TABLE IF NOT EXISTS downloads (
+          doi TEXT,
+          fmt TEXT,
+          mode TEXT,
+          status TEXT,
+          error TEXT,
+          attempts INTEGER,
+          updated REAL,
+          PRIMARY KEY (doi, fmt)
+        )''')
+      self.db.execute('''
+        CREATE TABLE IF NOT EXISTS watermarks (
+          key TEXT PRIMARY KEY,
+          value TEXT,
+          updated REAL
+        )''')
+
+  def start_sweep(self, key, replay=True):
+    '''
+    Starts a cursor sweep, or resumes it if an earlier run didn't finish
+
+    :param key: identifies the sweep, e.g. its query URL
+    :type key: str
+
+    :param replay: the stored pages will be replayed, so a sweep checkpointed without its pages starts afresh
+    :type replay: bool
+
+    :returns: the cursor to request next ('*' for a fresh sweep)
+    :rtype: str
+    '''
+    with self.lock, self.db:
+      row = self.db.execute('SELECT cursor, pages, done FROM sweeps WHERE key = ?', (key,)).fetchone()
+      if row is not None and self.resume and not row[2]:
+        stored = self.db.execute('SELECT COUNT(*) FROM sweep_pages WHERE key = ?', (key,)).fetchone()[0]
+        if not replay or stored == row[1]:
+          return row[0]
+
+      self.db.execute('DELETE FROM sweep_pages WHERE key = ?', (key,))
+      self.db.execute('INSERT OR REPLACE INTO sweeps VALUES (?, ?, 0, 0, ?)', (key, '*', time.time()))
+      return '*'
+
+  def iter_sweep_pages(self, key):
+    '''
+    Yields the items of each page already checkpointed for a sweep, in order
+    '''
+    with self.lock:
+      pages = self.db.execute('SELECT page FROM sweep_pages WHERE key = ? ORDER BY page', (key,)).fetchall()
+    for (page,) in pages:
+      with self.lock:
+        items = self.db.execute('SELECT items FROM sweep_pages WHERE key = ? AND page = ?', (key, page)).fetchone()[0]
+      yield json.loads(items)
+
+  def swept_pages(self, key):
+    '''
+    Returns how many pages of a sweep have been checkpointed
+    '''
+    with self.lock:
+      row = self.db.execute('SELECT pages FROM sweeps WHERE key = ?', (key,)).fetchone()
+    return row[0] if row is not None else 0
+
+  def checkpoint(self, key, items, cursor):
+    '''
+    Stores a finished page together with the cursor for the page after it. With items None,
+    only the cursor and page count are kept, for sweeps whose pages won't be replayed.
+    '''
+    with self.lock, self.db:
+      pages = self.db.execute('SELECT pages FROM sweeps WHERE key = ?', (key,)).fetchone()[0]
+      if items is not None:
+        self.db.execute('INSERT OR REPLACE INTO sweep_pages VALUES (?, ?, ?)', (key, pages, json.dumps(items)))
+      self.db.execute('UPDATE sweeps SET cursor = ?, pages = ?, updated = ? WHERE key = ?',
+                      (cursor, pages + 1, time.time(), key))
+
+  def finish_sweep(self, key):
+    '''
+    Marks a sweep as complete and drops its stored pages; the next run starts it afresh
+    '''
+    with self.lock, self.db:
+      self.db.execute('DELETE FROM sweep_pages WHERE key = ?', (key,))
+      self.db.execute('UPDATE sweeps SET done = 1, updated = ? WHERE key = ?', (time.time(), key))
+
+  def record_download(self, doi, fmt, mode, success, error=None):
+    '''
+    Records the outcome of one download attempt
+
+    :param success: whether the article was downloaded
+    :type success: bool
+
+    :param error: description of what went wrong, for failed attempts
+    :type error: str
+    '''
+    status = 'done' if success else 'failed'
+    with self.lock, self.db:
+      row = self.db.execute('SELECT attempts FROM downloads WHERE doi = ? AND fmt = ?', (doi, fmt)).fetchone()
+      attempts = (row[0] if row is not None else 0) + 1
+      self.db.execute('INSERT OR REPLACE INTO downloads VALUES (?, ?, ?, ?, ?, ?, ?)',
+                      (doi, fmt, mode, status, error, attempts, time.time()))
+
+  def download_status(self, doi, fmt):
+    '''
+    Returns the last recorded outcome of a download
+
+    :returns: dict with status ('done' or 'failed'), mode, error and attempts, or None if never attempted
+    :rtype: dict
+    '''
+    with self.lock:
+      row = self.db.execute('SELECT status, mode, error, attempts FROM downloads WHERE doi = ? AND fmt = ?',
+                            (doi, fmt)).fetchone()
+    if row is None:
+      return None
+    return {'status': row[0], 'mode': row[1], 'error': row[2], 'attempts': row[3]}
+
+  def is_done(self, doi, fmt):
+    '''
+    True if resuming and the download already succeeded in an earlier run
+    '''
+    if not self.resume:
+      return False
+    status = self.download_status(doi, fmt)
+    return status is not None and status['status'] == 'done'
+
+  def get_watermark(self, key):
+    '''
+    Returns the high-water mark stored for an incremental harvest, or None if there is none yet
+    '''
+    with self.lock:
+      row = self.db.execute('SELECT value FROM watermarks WHERE key = ?', (key,)).fetchone()
+    return row[0] if row is not None else None
+
+  def set_watermark(self, key, value):
+    '''
+    Stores the high-water mark for an incremental harvest
+    '''
+    with self.lock, self.db:
+      self.db.execute('INSERT OR REPLACE INTO watermarks VALUES (?, ?, ?)', (key, value, time.time()))
+
+  def close(self):
+    '''
+    Closes the underlying SQLite connection
+    '''
+    self.db.close()
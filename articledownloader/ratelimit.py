@@ -0,0 +1,130 @@
+'''
+Token-bucket rate limiting for API calls, with one bucket per host
+'''
+
+import threading
+import time
+
+#Requests/sec and burst size for hosts known to allow more than the default
+DEFAULT_RATE_LIMITS = {
+  'api.crossref.org': (10, 10)
+}
+
+#Requests/sec and burst size for publisher and doi.org hosts without their own limit
+DEFAULT_DOWNLOAD_RATE_LIMIT = (5, 5)
+
+def build_rate_limiter(sleep_sec=None, download_rate_limit=DEFAULT_DOWNLOAD_RATE_LIMIT, rate_limits=None):
+  '''
+  Builds the rate limiter used by a downloader
+
+  :param sleep_sec: min time between CrossRef API calls (None = the CrossRef default above, 0 = no limit)
+  :type sleep_sec: float
+
+  :param download_rate_limit: (requests/sec, burst) for every other host, i.e. doi.org and the publishers
+    (None = no limit)
+  :type download_rate_limit: tuple
+
+  :param rate_limits: (requests/sec, burst) per host or domain, overriding both of the above
+  :type rate_limits: dict
+
+  :rtype: articledownloader.ratelimit.RateLimiter
+  '''
+  limits = {}
+  if sleep_sec is not None:
+    limits['api.crossref.org'] = (1.0 / sleep_sec if sleep_sec else None, 1)
+  if rate_limits is not None:
+    limits.update(rate_limits)
+  return RateLimiter(default=download_rate_limit if download_rate_limit is not None else (None, 1), limits=limits)
+
+class TokenBucket:
+  '''
+  Thread-safe token bucket that refills at a fixed rate up to a burst size
+  '''
+
+  def __init__(self, rate, burst=1):
+    '''
+    :param rate: tokens added per second; None for no limit
+    :type rate: float
+
+    :param burst: max number of tokens the bucket can hold
+    :type burst: int
+    '''
+    self.rate = rate
+    self.burst = max(1, burst)
+    self.tokens = float(self.burst)
+    self.updated = time.monotonic()
+    self.lock = threading.Lock()
+
+  def reserve(self):
+    '''
+    Takes one token, going into debt if the bucket is empty
+
+    :returns: seconds the caller must wait before using the token
+    :rtype: float
+    '''
+    if not self.rate:
+      return 0.0
+
+    with self.lock:
+      now = time.monotonic()
+      self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+      self.updated = now
+      self.tokens -= 1
+      if self.tokens >= 0:
+        return 0.0
+      return -self.tokens / self.rate
+
+class RateLimiter:
+  '''
+  Keeps a token bucket per host; a limit set for a domain also covers its subdomains
+  '''
+
+  def __init__(self, default=(1, 1), limits=None):
+    '''
+    :param default: (requests/sec, burst) for hosts without their own limit
+    :type default: tuple
+
+    :param limits: maps a host or domain to its (requests/sec, burst)
+    :type limits: dict
+    '''
+    self.default = default
+    self.limits = dict(DEFAULT_RATE_LIMITS)
+    if limits is not None:
+      self.limits.update(limits)
+    self.buckets = {}
+    self.lock = threading.Lock()
+
+  def _limit_for(self, host):
+    parts = host.split('.')
+    for i in range(len(parts)):
+      domain = '.'.join(parts[i:])
+      if domain in self.limits:
+        return domain, self.limits[domain]
+    return host, self.default
+
+  def bucket(self, host):
+    '''
+    Returns the bucket that meters requests to a host
+    '''
+    key, (rate, burst) = self._limit_for(host or '')
+    with self.lock:
+      if key not in self.buckets:
+        self.buckets[key] = TokenBucket(rate, burst)
+      return self.buckets[key]
+
+  def reserve(self, host):
+    '''
+    Reserves a request slot for a host without blocking
+
+    :returns: seconds to wait before sending the request
+    :rtype: float
+    '''
+    return self.bucket(host).reserve()
+
+  def wait(self, host):
+    '''
+    Blocks until a request to the host is within its budget
+    '''
+    delay = self.reserve(host)
+    if delay > 0:
+      time.sleep(delay)
@@ -0,0 +1,259 @@
+'''
+Compact and columnar representations of CrossRef metadata records, and writers that stream them to disk
+
+pyarrow is only needed for the Arrow/Parquet helpers, and is imported when they are first used.
+'''
+
+import csv
+import json
+
+#Fields of the records built by ArticleDownloader, in column order
+METADATA_COLUMNS = ('doi', 'issn', 'title', 'prefix', 'journal', 'publisher', 'volume', 'issue', 'page', 'year',
+                    'num_references', 'times_cited')
+
+class MetadataRecord:
+  '''
+  Metadata record with the same fields as the dicts returned by ArticleDownloader, stored
+  in __slots__ so that millions of them fit in a fraction of the memory
+  '''
+
+  __slots__ = METADATA_COLUMNS
+
+  def __init__(self, doi, issn, title, prefix, journal, publisher, volume=None, issue=None, page=None, year=None,
+               num_references=None, times_cited=None):
+    self.doi = doi
+    self.issn = issn
+    self.title = title
+    self.prefix = prefix
+    self.journal = journal
+    self.publisher = publisher
+    self.volume = volume
+    self.issue = issue
+    self.page = page
+    self.year = year
+    self.num_references = num_references
+    self.times_cited = times_cited
+
+  @classmethod
+  def from_dict(cls, record):
+    '''
+    Builds a compact record from a metadata dict
+    '''
+    return cls(**record)
+
+  def to_dict(self):
+    '''
+    Returns the record as a metadata dict
+    '''
+    return dict((name, getattr(self, name)) for name in METADATA_COLUMNS)
+
+  def __eq__(self, other):
+    return isinstance(other, MetadataRecord) and self.to_dict() == other.to_dict()
+
+  def __repr__(self):
+    return 'MetadataRecord(doi=%r, title=%r)' % (self.doi, self.title)
+
+def metadata_schema():
+  '''
+  Returns the fixed Arrow schema used for metadata exports
+  '''
+  import pyarrow as pa
+
+  return pa.schema([
+    ('doi', pa.string()),
+    ('issn', pa.string()),
+    ('title', pa.string()),
+    ('prefix', pa.string()),
+    ('journal', pa.string()),
+    ('publisher', pa.string()),
+    ('volume', pa.string()),
+    ('issue', pa.string()),
+    ('page', pa.string()),
+    ('year', pa.int32()),
+    ('num_references', pa.int64()),
+    ('times_cited', pa.int64())
+  ])
+
+def _value(record, name):
+  if isinstance(record, MetadataRecord):
+    return getattr(record, name)
+  return record.get(name)
+
+def _record_batch(columns, schema):
+  import pyarrow as pa
+
+  return pa.RecordBatch.from_arrays([pa.array(columns[field.name], type=field.type) for field in schema], schema=schema)
+
+def iter_record_batches(records, batch_size=10000):
+  '''
+  Packs metadata records into Arrow record batches, filling one column list per field instead
+  of keeping the records themselves around
+
+  :param records: metadata dicts or MetadataRecords, e.g. from iter_metadata_from_journal_issn
+  :type records: iterable
+
+  :param batch_size: rows per record batch
+  :type batch_size: int
+
+  :returns: pyarrow.RecordBatch objects with the metadata_schema() schema
+  :rtype: generator
+  '''
+
+  schema = metadata_schema()
+  columns = dict((name, []) for name in METADATA_COLUMNS)
+  rows = 0
+  for record in records:
+    for name in METADATA_COLUMNS:
+      columns[name].append(_value(record, name))
+    rows += 1
+    if rows == batch_size:
+      yield _record_batch(columns, schema)
+      columns = dict((name, []) for name in METADATA_COLUMNS)
+      rows = 0
+  if rows:
+    yield _record_batch(columns, schema)
+
+class ParquetMetadataWriter:
+  '''
+  Streams metadata records into a Parquet file. Records are buffered column by column and
+  written out as a row group whenever row_group_size of them have arrived.
+
+  Usage:
+
+    with ParquetMetadataWriter('journal.parquet') as writer:
+      writer.write(downloader.iter_metadata_from_journal_issn(issn, rows=100000))
+  '''
+
+  def __init__(self, path, row_group_size=50000, compression='zstd'):
+    '''
+    :param path: Parquet file to write
+    :type path: str
+
+    :param row_group_size: rows per row group
+    :type row_group_size: int
+
+    :param compression: Parquet compression codec
+    :type compression: str
+    '''
+    import pyarrow.parquet as pq
+
+    self.row_group_size = row_group_size
+    self.schema = metadata_schema()
+    self.writer = pq.ParquetWriter(path, self.schema, compression=compression)
+    self.columns = dict((name, []) for name in METADATA_COLUMNS)
+    self.buffered = 0
+    self.rows = 0
+
+  def write(self, records):
+    '''
+    Appends metadata records to the file
+    '''
+    for record in records:
+      for name in METADATA_COLUMNS:
+        self.columns[name].append(_value(record, name))
+      self.buffered += 1
+      if self.buffered == self.row_group_size:
+        self.flush()
+
+  def flush(self):
+    '''
+    Writes the buffered records out as a row group
+    '''
+    if self.buffered:
+      self.writer.write_batch(_record_batch(self.columns, self.schema), row_group_size=self.row_group_size)
+      self.rows += self.buffered
+      self.columns = dict((name, []) for name in METADATA_COLUMNS)
+      self.buffered = 0
+
+  def close(self):
+    '''
+    Writes any buffered records and finishes the file; it isn't readable until this is called
+    '''
+    self.flush()
+    self.writer.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()
+
+class JSONLMetadataWriter:
+  '''
+  Appends metadata records to a file as JSON lines, flushing after every write so that
+  everything written so far survives an interrupted harvest.
+
+  Usage:
+
+    with JSONLMetadataWriter('journal.jsonl') as sink:
+      downloader.get_metadata_from_journal_issn(issn, rows=None, sink=sink)
+  '''
+
+  def __init__(self, path, append=False):
+    '''
+    :param path: file to write
+    :type path: str
+
+    :param append: add to the end of an existing file instead of replacing it
+    :type append: bool
+    '''
+    self.file = open(path, 'a' if append else 'w', encoding='utf-8')
+    self.rows = 0
+
+  def write(self, records):
+    '''
+    Writes metadata records (dicts or MetadataRecords), one JSON object per line
+    '''
+    for record in records:
+      if isinstance(record, MetadataRecord):
+        record = record.to_dict()
+      self.file.write(json.dumps(record, ensure_ascii=False) + '\n')
+      self.rows += 1
+    self.file.flush()
+
+  def close(self):
+    self.file.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()
+
+class CSVMetadataWriter:
+  '''
+  Appends metadata records to a CSV file with one column per field of METADATA_COLUMNS,
+  flushing after every write. Missing values are written as empty cells.
+  '''
+
+  def __init__(self, path, append=False):
+    '''
+    :param path: file to write; the header row is written unless appending to a non-empty file
+    :type path: str
+
+    :param append: add to the end of an existing file instead of replacing it
+    :type append: bool
+    '''
+    self.file = open(path, 'a' if append else 'w', encoding='utf-8', newline='')
+    self.writer = csv.writer(self.file)
+    self.rows = 0
+    if self.file.tell() == 0:
+      self.writer.writerow(METADATA_COLUMNS)
+
+  def write(self, records):
+    '''
+    Writes metadata records (dicts or MetadataRecords), one row each
+    '''
+    for record in records:
+      self.writer.writerow([_value(record, name) for name in METADATA_COLUMNS])
+      self.rows += 1
+    self.file.flush()
+
+  def close(self):
+    self.file.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()
@@ -0,0 +1,160 @@
+'''
+Retries with backoff, and per-host circuit breakers, for the requests sent to publishers
+'''
+
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+class CircuitOpenError(Exception):
+  '''
+  Raised instead of sending a request to a host whose circuit breaker is open
+  '''
+
+  def __init__(self, host, retry_at):
+    Exception.__init__(self, host + ' is failing; retry after ' + time.strftime('%H:%M:%S', time.localtime(retry_at)))
+    self.host = host
+    self.retry_at = retry_at
+
+class RetryPolicy:
+  '''
+  Decides which responses are retried and how long to wait first: exponential backoff with
+  full jitter, or the server's Retry-After when a 429/503 carries one.
+  '''
+
+  def __init__(self, max_retries=3, backoff_sec=0.5, max_backoff_sec=30, max_retry_after_sec=300,
+               retry_statuses=(429, 500, 502, 503, 504)):
+    '''
+    :param max_retries: retries after the first attempt
+    :type max_retries: int
+
+    :param backoff_sec: base of the exponential backoff
+    :type backoff_sec: float
+
+    :param max_backoff_sec: cap on the backoff between two attempts
+    :type max_backoff_sec: float
+
+    :param max_retry_after_sec: longest Retry-After that is waited for; longer ones aren't retried
+    :type max_retry_after_sec: float
+
+    :param retry_statuses: HTTP statuses that are retried
+    :type retry_statuses: tuple
+    '''
+    self.max_retries = max_retries
+    self.backoff_sec = backoff_sec
+    self.max_backoff_sec = max_backoff_sec
+    self.max_retry_after_sec = max_retry_after_sec
+    self.retry_statuses = retry_statuses
+
+  @staticmethod
+  def retry_after(r):
+    '''
+    Returns the seconds to wait from a response's Retry-After header, or None if it has none
+    '''
+    value = r.headers.get('Retry-After') if r is not None else None
+    if value is None:
+      return None
+    value = value.strip()
+    if value.isdigit():
+      return float(value)
+    try:
+      return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+      return None
+
+  def delay(self, attempt, r=None):
+    '''
+    Returns the seconds to wait before retrying
+
+    :param attempt: number of attempts already made, minus one
+    :type attempt: int
+
+    :param r: the response that is retried, or None after a connection error or timeout
+    :type r: requests.Response
+
+    :returns: the delay, or None if the request shouldn't be retried
+    :rtype: float
+    '''
+    if attempt >= self.max_retries:
+      return None
+    if r is not None and r.status_code in (429, 503):
+      retry_after = self.retry_after(r)
+      if retry_after is not None:
+        return retry_after if retry_after <= self.max_retry_after_sec else None
+    return random.uniform(0, min(self.max_backoff_sec, self.backoff_sec * 2 ** attempt))
+
+class CircuitBreaker:
+  '''
+  Tracks consecutive failures per host. After failure_threshold of them the host's circuit
+  opens, and requests to it fail at once with CircuitOpenError until cooldown_sec has passed;
+  then a single trial request is let through, which closes the circuit if it succeeds and
+  opens it again (for twice as long, up to max_cooldown_sec) if it fails.
+  '''
+
+  def __init__(self, failure_threshold=5, cooldown_sec=60, max_cooldown_sec=900):
+    '''
+    :param failure_threshold: consecutive failures that open a host's circuit
+    :type failure_threshold: int
+
+    :param cooldown_sec: time an opened circuit stays open
+    :type cooldown_sec: float
+
+    :param max_cooldown_sec: cap on the cooldown after repeated failed trials
+    :type max_cooldown_sec: float
+    '''
+    self.failure_threshold = failure_threshold
+    self.cooldown_sec = cooldown_sec
+    self.max_cooldown_sec = max_cooldown_sec
+    self.hosts = {} #host -> [consecutive failures, cooldown, retry_at or None, trial in progress]
+    self.lock = threading.Lock()
+
+  def before(self, host):
+    '''
+    Raises CircuitOpenError if requests to the host should not be sent now
+    '''
+    with self.lock:
+      state = self.hosts.get(host)
+      if state is None or state[2] is None:
+        return
+      if time.time() < state[2] or state[3]:
+        raise CircuitOpenError(host, state[2])
+      state[3] = True
+
+  def success(self, host):
+    '''
+    Records a request that reached the host and got a usable answer
+    '''
+    with self.lock:
+      self.hosts.pop(host, None)
+
+  def failure(self, host):
+    '''
+    Records a connection error, timeout, or retryable error status from the host
+    '''
+    with self.lock:
+      state = self.hosts.setdefault(host, [0, self.cooldown_sec, None, False])
+      state[0] += 1
+      if state[3]:
+        state[1] = min(self.max_cooldown_sec, state[1] * 2)
+      if state[3] or state[0] >= self.failure_threshold:
+        state[2] = time.time() + state[1]
+        state[3] = False
+
+  def release(self, host):
+    '''
+    Ends a half-open trial whose request failed in a way that says nothing about the host (e.g. a
+    redirect loop or an invalid URL), without counting it; the next request is another trial
+    '''
+    with self.lock:
+      state = self.hosts.get(host)
+      if state is not None:
+        state[3] = False
+
+  def is_open(self, host):
+    '''
+    True if requests to the host currently fail fast
+    '''
+    with self.lock:
+      state = self.hosts.get(host)
+      return state is not None and state[2] is not None and time.time() < state[2]
@@ -0,0 +1,165 @@
+'''
+Caches where DOIs resolve to, so doi.org redirect chains are followed once per article
+'''
+
+import json
+import os
+import threading
+from collections import OrderedDict
+
+class DOIResolver:
+  '''
+  Maps DOIs to the landing page URL that doi.org redirects them to.
+
+  Resolved URLs are kept in a bounded LRU cache. When the landing URLs of a DOI prefix are
+  a plain function of the DOI (e.g. https://www.nature.com/articles/<suffix>), the resolver
+  learns that URL template once it has seen it for min_template_hits different DOIs, and
+  from then on builds URLs for the prefix without asking doi.org at all.
+
+  A template is only right if everything but the DOI is the same for the whole prefix;
+  RSC's landing URLs, for instance, also carry the year and journal. So a prefix is never
+  templated again once two of its DOIs disagree on the template, or once a URL built from
+  its template turns out not to work (see forget).
+  '''
+
+  def __init__(self, path=None, max_entries=100000, min_template_hits=2):
+    '''
+    :param path: JSON file the cache is loaded from and saved to (default = memory only)
+    :type path: str
+
+    :param max_entries: max number of resolved DOIs kept
+    :type max_entries: int
+
+    :param min_template_hits: DOIs that must agree on a URL template before it is trusted
+    :type min_template_hits: int
+    '''
+    self.path = path
+    self.max_entries = max_entries
+    self.min_template_hits = min_template_hits
+    self.urls = OrderedDict()
+    self.templates = {}
+    self.candidates = {} #prefix -> [template, hits] while a template is being confirmed
+    self.untemplated = set() #prefixes whose URLs aren't a function of the DOI alone
+    self.lock = threading.Lock()
+
+    if path is not None and os.path.exists(path):
+      with open(path) as f:
+        saved = json.load(f)
+      self.urls.update(saved.get('urls', {}))
+      self.templates.update(saved.get('templates', {}))
+      self.candidates.update(saved.get('candidates', {}))
+      self.untemplated.update(saved.get('untemplated', []))
+
+  @staticmethod
+  def _fields(doi):
+    prefix, suffix = doi.split('/', 1)
+    return prefix, OrderedDict([
+      ('doi', doi),
+      ('doi_lower', doi.lower()),
+      ('suffix', suffix),
+      ('suffix_lower', suffix.lower())
+    ])
+
+  @classmethod
+  def template_for(cls, doi, url):
+    '''
+    Turns a resolved URL into a template by replacing the DOI (or its suffix) with a placeholder
+
+    :returns: the template, or None if the URL doesn't contain the DOI
+    :rtype: str
+    '''
+    prefix, fields = cls._fields(doi)
+    escaped = url.replace('{', '{{').replace('}', '}}')
+    for name, value in fields.items():
+      if value in url:
+        return escaped.replace(value, '{' + name + '}')
+    return None
+
+  def lookup(self, doi):
+    '''
+    Returns the landing URL for a DOI from the cache or a learned template
+
+    :returns: the URL, or None if the DOI has to be resolved through doi.org
+    :rtype: str
+    '''
+    if '/' not in doi:
+      return None
+
+    with self.lock:
+      if doi in self.urls:
+        self.urls.move_to_end(doi)
+        return self.urls[doi]
+
+      prefix, fields = self._fields(doi)
+      if prefix in self.templates:
+        return self.templates[prefix].format(**fields)
+    return None
+
+  def learn(self, doi, url):
+    '''
+    Records the URL a DOI resolved to, and updates the URL template for its prefix
+    '''
+    if '/' not in doi:
+      return
+
+    template = self.template_for(doi, url)
+    prefix = doi.split('/', 1)[0]
+    with self.lock:
+      self.urls[doi] = url
+      self.urls.move_to_end(doi)
+      while len(self.urls) > self.max_entries:
+        self.urls.popitem(last=False)
+
+      if prefix in self.untemplated:
+        return
+      if prefix in self.templates:
+        if self.templates[prefix] != template:
+          del self.templates[prefix]
+          self.untemplated.add(prefix)
+        return
+
+      candidate = self.candidates.get(prefix)
+      if template is None or (candidate is not None and candidate[0] != template):
+        self.candidates.pop(prefix, None)
+        self.untemplated.add(prefix)
+        return
+
+      if candidate is None:
+        candidate = [template, 0]
+      candidate[1] += 1
+      self.candidates[prefix] = candidate
+      if candidate[1] >= self.min_template_hits:
+        self.templates[prefix] = template
+        del self.candidates[prefix]
+
+  def forget(self, doi):
+    '''
+    Drops a DOI's cached URL, and its prefix's template, after the URL turned out to be wrong.
+    If the URL was built from the template, the prefix is never templated again.
+    '''
+    with self.lock:
+      url = self.urls.pop(doi, None)
+      if '/' in doi:
+        prefix = doi.split('/', 1)[0]
+        template = self.templates.pop(prefix, None)
+        if url is None and template is not None:
+          self.untemplated.add(prefix)
+
+  def save(self):
+    '''
+    Writes the cache to self.path, if one was given
+    '''
+    if self.path is None:
+      return
+
+    with self.lock:
+      saved = {
+        'urls': self.urls,
+        'templates': self.templates,
+        'candidates': self.candidates,
+        'untemplated': sorted(self.untemplated)
+      }
+      tmp_path = self.path + '.tmp'
+      with open(tmp_path, 'w') as f:
+        json.dump(saved, f)
+      os.replace(tmp_path, self.path)
@@ -0,0 +1,145 @@
+'''
+Chooses which modes to try for a DOI, from its prefix and from how well each mode has done before
+'''
+
+import json
+import os
+import threading
+import time
+
+#Publisher mode of each DOI prefix
+PREFIX_MODES = {
+  '10.1016': 'elsevier',
+  '10.1039': 'rsc',
+  '10.1038': 'nature',
+  '10.1021': 'acs',
+  '10.1007': 'springer',
+  '10.1002': 'wiley',
+  '10.1126': 'aaas',
+  '10.1149': 'ecs',
+  '10.1108': 'emerald',
+  '10.1103': 'aps'
+}
+
+#Modes supported by each get_*_from_doi method, in the order they are tried when nothing else is known
+FORMAT_MODES = {
+  'pdf': ['crossref', 'elsevier', 'rsc', 'springer', 'ecs', 'nature', 'acs'],
+  'html': ['springer', 'acs', 'ecs', 'rsc', 'nature', 'wiley', 'aaas', 'emerald'],
+  'xml': ['elsevier', 'aps']
+}
+
+#Modes that work for any publisher
+GENERIC_MODES = ('crossref',)
+
+class ModeRouter:
+  '''
+  Builds the fallback chain of modes for mode='auto'.
+
+  The mode of the DOI's publisher (from PREFIX_MODES) goes first, then generic modes such as
+  CrossRef's full-text links, then the rest. Every attempt is counted per (prefix, format,
+  mode), and the chain is ordered by each mode's success rate for the prefix, so that a
+  prefix missing from the table, or one whose publisher mode keeps failing, soon goes to the
+  mode that actually works. Modes that have never succeeded for a prefix after
+  max_failures attempts are dropped from its chain, until retry_dropped_sec after their last
+  attempt; then they get one trial at their initial rank, in case the publisher has changed.
+  A trial that succeeds clears the mode's record for the prefix.
+  '''
+
+  def __init__(self, path=None, max_modes=3, max_failures=5, retry_dropped_sec=7 * 24 * 3600):
+    '''
+    :param path: JSON file the statistics are loaded from and saved to (default = memory only)
+    :type path: str
+
+    :param max_modes: max number of modes tried per DOI
+    :type max_modes: int
+
+    :param max_failures: attempts after which a mode that never succeeded for a prefix is dropped
+    :type max_failures: int
+
+    :param retry_dropped_sec: time after which a dropped mode is tried again (default = 1 week)
+    :type retry_dropped_sec: float
+    '''
+    self.path = path
+    self.max_modes = max_modes
+    self.max_failures = max_failures
+    self.retry_dropped_sec = retry_dropped_sec
+    self.stats = {} #'<prefix> <fmt>' -> {mode: [successes, attempts, time of last attempt]}
+    self.lock = threading.Lock()
+
+    if path is not None and os.path.exists(path):
+      with open(path) as f:
+        self.stats.update(json.load(f))
+
+  @staticmethod
+  def publisher(doi):
+    '''
+    Returns the publisher mode for a DOI, or its prefix if the prefix isn't in the table
+    '''
+    prefix = doi.split('/', 1)[0]
+    return PREFIX_MODES.get(prefix, prefix)
+
+  def _dropped(self, counts):
+    return counts[0] == 0 and counts[1] >= self.max_failures
+
+  def _prior(self, prefix, mode):
+    if PREFIX_MODES.get(prefix) == mode:
+      return 1.0
+    if mode in GENERIC_MODES:
+      return 0.5
+    return 0.1
+
+  def chain(self, doi, fmt, skip=()):
+    '''
+    Returns the modes to try for a DOI, most likely to succeed first
+
+    :param skip: modes that can't be used, e.g. 'elsevier' without an API key
+    :type skip: iterable
+
+    :rtype: list
+    '''
+    prefix = doi.split('/', 1)[0]
+    with self.lock:
+      counts = dict(self.stats.get(prefix + ' ' + fmt, {}))
+
+    now = time.time()
+    scored = []
+    for position, mode in enumerate(FORMAT_MODES[fmt]):
+      if mode in skip:
+        continue
+      successes, attempts = counts.get(mode, (0, 0))[:2]
+      if self._dropped((successes, attempts)):
+        #Statistics saved without the time of the last attempt count as tried long ago
+        last_attempt = counts[mode][2] if len(counts[mode]) > 2 else 0
+        if now - last_attempt < self.retry_dropped_sec:
+          continue
+        score = self._prior(prefix, mode)
+      else:
+        score = (successes + self._prior(prefix, mode)) / (attempts + 1.0)
+      scored.append((-score, position, mode))
+    return [mode for _, _, mode in sorted(scored)][:self.max_modes]
+
+  def record(self, doi, fmt, mode, success):
+    '''
+    Counts one attempt to download a DOI with a mode
+    '''
+    key = doi.split('/', 1)[0] + ' ' + fmt
+    with self.lock:
+      counts = self.stats.setdefault(key, {}).setdefault(mode, [0, 0, 0])
+      if success and self._dropped(counts):
+        counts[:2] = [0, 0]
+      counts[0] += 1 if success else 0
+      counts[1] += 1
+      counts[2:] = [time.time()]
+
+  def save(self):
+    '''
+    Writes the statistics to self.path, if one was given
+    '''
+    if self.path is None:
+      return
+
+    with self.lock:
+      tmp_path = self.path + '.tmp'
+      with open(tmp_path, 'w') as f:
+        json.dump(self.stats, f)
+      os.replace(tmp_path, self.path)
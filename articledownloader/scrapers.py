@@ -2,14 +2,129 @@
 These scraping implementations are used only for detecting PDF direct download links as necessary
 '''
 
+import codecs
+import re
+from html import unescape
 from html.parser import HTMLParser
 
-class RSC(HTMLParser):
+def incremental_decoder(encoding=None):
   '''
-  Scraper for RSC publications
+  Returns an incremental decoder for a page's charset, falling back to UTF-8 for unknown ones
+  '''
+  try:
+    return codecs.getincrementaldecoder(encoding or 'utf-8')(errors='replace')
+  except LookupError:
+    return codecs.getincrementaldecoder('utf-8')(errors='replace')
+
+_href = re.compile(br'''\shref\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s>]+))''', re.IGNORECASE)
+
+def _tag_attr(data, tag_pattern, attr_pattern=_href):
+  '''
+  Finds the first tag matching tag_pattern (which must match from the tag's opening '<') in
+  raw page bytes, and returns the value of one of its attributes
+  '''
+  for match in tag_pattern.finditer(data):
+    end = data.find(b'>', match.end() - 1)
+    if end < 0:
+      continue #The rest of the tag is in the next chunk
+    attr = attr_pattern.search(data, match.start(), end)
+    if attr is not None:
+      return unescape(next(group for group in attr.groups() if group is not None).decode('latin-1'))
+  return None
+
+class PDFLinkScraper(HTMLParser):
+  '''
+  Base class for the scrapers below, which can stop reading a page as soon as the link is found.
+
+  Each scraper has a fast path that scans raw bytes with precompiled patterns, and only runs
+  the (much slower) HTMLParser over the page when the fast path finds nothing.
   '''
 
   download_link = None
+  overlap = 4096 #Bytes of the previous chunk rescanned, so tags split across chunks are found
+
+  @classmethod
+  def fast_extract(cls, data):
+    '''
+    Looks for the download link in raw page bytes without parsing the HTML
+
+    :returns: the download link, or None if the fast path can't find it
+    :rtype: str
+    '''
+    return None
+
+  @property
+  def done(self):
+    '''
+    True once a download link has been found
+    '''
+    return self.download_link is not None
+
+  def feed_chunks(self, chunks, encoding=None, fast=True):
+    '''
+    Feeds raw page bytes into the scraper chunk by chunk, stopping at the first chunk that
+    yields a download link
+
+    :param chunks: byte strings making up the page
+    :type chunks: iterable
+
+    :param encoding: charset of the page (default = UTF-8)
+    :type encoding: str
+
+    :param fast: try the byte-level fast path before falling back to HTMLParser (default = True)
+    :type fast: bool
+
+    :returns: the download link, or None if the page doesn't have one
+    :rtype: str
+    '''
+    if fast:
+      seen = []
+      tail = b''
+      for chunk in chunks:
+        seen.append(chunk)
+        window = tail + chunk
+        link = self.fast_extract(window)
+        if link is not None:
+          self.download_link = link
+          return link
+        tail = window[-self.overlap:]
+      chunks = seen
+
+    decoder = incremental_decoder(encoding)
+    for chunk in chunks:
+      self.feed(decoder.decode(chunk))
+      if self.done:
+        return self.download_link
+    self.feed(decoder.decode(b'', final=True))
+    return self.download_link
+
+  def feed_response(self, r, chunk_size=8192, fast=True):
+    '''
+    Scrapes a streamed requests response, closing the connection as soon as the link is found
+    instead of reading the rest of the page
+
+    :returns: the download link, or None if the page doesn't have one
+    :rtype: str
+    '''
+    try:
+      return self.feed_chunks(r.iter_content(chunk_size), r.encoding, fast=fast)
+    finally:
+      r.close()
+
+class RSC(PDFLinkScraper):
+  '''
+  Scraper for RSC publications
+  '''
+
+  _fast = re.compile(br'''\scontent\s*=\s*(["'])([^"']*http://pubs\.rsc\.org/en/content/articlepdf/[^"']*)\1''',
+                     re.IGNORECASE)
+
+  @classmethod
+  def fast_extract(cls, data):
+    match = cls._fast.search(data)
+    if match is None:
+      return None
+    return unescape(match.group(2).decode('latin-1'))
 
   #RSC scraping implementation
   def handle_starttag(self, tag, attrs):
@@ -20,12 +135,20 @@ class RSC(HTMLParser):
       if attr[0] == 'content':
         if 'http://pubs.rsc.org/en/content/articlepdf/' in attr[1]: self.download_link = attr[1]
 
-class ECS(HTMLParser):
+class ECS(PDFLinkScraper):
   '''
   Scraper for ECS publications
   '''
 
-  download_link = None
+  _fast = re.compile(br'''<a\s(?:[^>]*?\s)?rel\s*='''
+                     br'''\s*(?:"view-full-text\.pdf"|'view-full-text\.pdf'|view-full-text\.pdf[\s>])''', re.IGNORECASE)
+
+  @classmethod
+  def fast_extract(cls, data):
+    href = _tag_attr(data, cls._fast)
+    if href is None:
+      return None
+    return 'http://jes.ecsdl.org' + href[:-5]
 
   #ECS scraping implementation
   def handle_starttag(self, tag, attrs):
@@ -37,12 +160,20 @@ class ECS(HTMLParser):
         if attr[0] == 'href':
           self.download_link = 'http://jes.ecsdl.org' + attr[1][:-5]
 
-class Nature(HTMLParser):
+class Nature(PDFLinkScraper):
   '''
   Scraper for Nature publications
   '''
 
-  download_link = None
+  _fast = re.compile(br'''<a\s(?:[^>]*?\s)?(?:class|id)\s*='''
+                     br'''\s*(?:"download-pdf"|'download-pdf'|download-pdf[\s>])''', re.IGNORECASE)
+
+  @classmethod
+  def fast_extract(cls, data):
+    href = _tag_attr(data, cls._fast)
+    if href is None:
+      return None
+    return 'http://www.nature.com' + href
 
   #Nature scraping implementation
   def handle_starttag(self, tag, attrs):
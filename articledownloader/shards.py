@@ -0,0 +1,279 @@
+'''
+Packed shard archives: many downloaded articles appended to a few large files, each with a
+sidecar offset index, so that readers can memory-map a shard and pull out any article directly
+'''
+
+import json
+import mmap
+import os
+import re
+import tempfile
+import threading
+
+try:
+  import fcntl
+except ImportError: #Not on Windows, where shards aren't locked
+  fcntl = None
+
+#Shard files are named <prefix>-<number>.shard, with the index next to them as <prefix>-<number>.idx
+SHARD_PATTERN = re.compile(r'^(?P<prefix>.+)-(?P<number>\d{5})\.shard$')
+
+class ShardWriter:
+  '''
+  Appends articles to shard files in a directory, starting a new shard once the current one
+  passes max_bytes. Every record is a header line, 'ADS1 <fmt> <length> <doi>', followed by
+  the body and a newline, so shards can also be read sequentially like a WARC file. The
+  (doi, fmt, offset, length) of each record is appended to the shard's .idx file as a JSON
+  line once the record is complete.
+
+  Pass a shard writer wherever the get_*_from_doi methods take a file. Each article is
+  buffered by its own writer (in memory, spilling to disk when large), and only appended to
+  the shard once it has fully arrived, so concurrent downloads never interleave:
+
+    with ShardWriter('corpus') as shards:
+      for doi, _, success in downloader.download_many(dois, 'elsevier', shards, fmt='xml'):
+        pass
+
+  Several writers (e.g. one per process) can share a directory and prefix: a writer only
+  starts a shard that is still empty, and holds an exclusive lock on it while it is open, so
+  every writer appends to shards of its own. Without fcntl (on Windows) there is no lock, and
+  writers that run at the same time need different prefixes.
+  '''
+
+  def __init__(self, directory, prefix='articles', max_bytes=1024 * 1024 * 1024, spool_bytes=8 * 1024 * 1024):
+    '''
+    :param directory: directory to write the shards to (created if missing)
+    :type directory: str
+
+    :param prefix: file name prefix of the shards
+    :type prefix: str
+
+    :param max_bytes: size after which a new shard is started (default = 1GB)
+    :type max_bytes: int
+
+    :param spool_bytes: size up to which an article is buffered in memory before spilling to a temporary file
+    :type spool_bytes: int
+    '''
+    self.directory = directory
+    self.prefix = prefix
+    self.max_bytes = max_bytes
+    self.spool_bytes = spool_bytes
+    self.lock = threading.Lock()
+    self.shard = None
+    self.index = None
+    if not os.path.isdir(directory):
+      os.makedirs(directory)
+
+    #Articles written by earlier runs, so that they are not downloaded again
+    self.keys = set()
+    numbers = [-1]
+    for name in os.listdir(directory):
+      match = SHARD_PATTERN.match(name)
+      if match is not None and match.group('prefix') == prefix:
+        numbers.append(int(match.group('number')))
+        for doi, fmt, offset, length in _read_index(_index_path(os.path.join(directory, name))):
+          self.keys.add((doi, fmt))
+    self.number = max(numbers)
+
+  def _next_shard(self):
+    if self.shard is not None:
+      self.shard.close()
+      self.index.close()
+    #Skip shards that another writer holds, or has already written to
+    while True:
+      self.number += 1
+      path = os.path.join(self.directory, self.prefix + '-%05d.shard' % self.number)
+      shard = open(path, 'ab')
+      if fcntl is not None:
+        try:
+          fcntl.flock(shard.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+          shard.close()
+          continue
+      if shard.tell() == 0:
+        break
+      shard.close()
+    self.shard = shard
+    self.index = open(_index_path(path), 'a', encoding='utf-8')
+
+  def has(self, doi, fmt):
+    '''
+    True if the article is already in one of the shards
+    '''
+    with self.lock:
+      return (doi, fmt) in self.keys
+
+  def writer(self, doi, fmt):
+    '''
+    Returns a file-like object whose content is appended to the shards as this article once committed
+
+    :rtype: articledownloader.shards.ShardRecordWriter
+    '''
+    return ShardRecordWriter(self, doi, fmt)
+
+  def _append(self, doi, fmt, body):
+    length = body.seek(0, os.SEEK_END)
+    body.seek(0)
+    with self.lock:
+      if self.shard is None or self.shard.tell() >= self.max_bytes:
+        self._next_shard()
+      header = ('ADS1 ' + fmt + ' ' + str(length) + ' ' + doi + '\n').encode('utf-8')
+      offset = self.shard.tell() + len(header)
+      self.shard.write(header)
+      while True:
+        chunk = body.read(1024 * 1024)
+        if not chunk:
+          break
+        self.shard.write(chunk)
+      self.shard.write(b'\n')
+      self.shard.flush()
+
+      #The index entry is only written once the record itself is complete
+      self.index.write(json.dumps([doi, fmt, offset, length]) + '\n')
+      self.index.flush()
+      self.keys.add((doi, fmt))
+
+  def close(self):
+    '''
+    Closes the current shard and its index
+    '''
+    with self.lock:
+      if self.shard is not None:
+        self.shard.close()
+        self.index.close()
+        self.shard = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()
+
+class ShardRecordWriter:
+  '''
+  Buffers one article, and appends it to the shards on commit()
+  '''
+
+  def __init__(self, shards, doi, fmt):
+    self.shards = shards
+    self.doi = doi
+    self.fmt = fmt
+    self.buffer = tempfile.SpooledTemporaryFile(max_size=shards.spool_bytes)
+
+  def write(self, data):
+    return self.buffer.write(data)
+
+  def commit(self):
+    '''
+    Appends the article to the current shard
+    '''
+    if self.buffer.closed:
+      return
+    try:
+      self.shards._append(self.doi, self.fmt, self.buffer)
+    finally:
+      self.buffer.close()
+
+  def abort(self):
+    '''
+    Discards everything written so far
+    '''
+    self.buffer.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.abort()
+
+class ShardReader:
+  '''
+  Random access to the articles in a directory of shards (or a single shard file). The
+  indexes are loaded up front, and each shard is memory-mapped the first time it is read.
+
+  Usage:
+
+    with ShardReader('corpus') as shards:
+      xml = shards.get('10.1016/j.nantod.2008.10.014', 'xml')
+  '''
+
+  def __init__(self, path):
+    '''
+    :param path: directory of shards, or the path of one shard
+    :type path: str
+    '''
+    if os.path.isdir(path):
+      paths = sorted(os.path.join(path, name) for name in os.listdir(path) if SHARD_PATTERN.match(name))
+    else:
+      paths = [path]
+
+    self.paths = paths
+    self.maps = {}
+    self.lock = threading.Lock()
+    self.index = {}
+    for number, shard_path in enumerate(paths):
+      for doi, fmt, offset, length in _read_index(_index_path(shard_path)):
+        self.index[(doi, fmt)] = (number, offset, length)
+
+  def _map(self, number):
+    with self.lock:
+      if number not in self.maps:
+        with open(self.paths[number], 'rb') as f:
+          self.maps[number] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+      return self.maps[number]
+
+  def keys(self):
+    '''
+    Returns the (doi, fmt) pairs of every article in the shards
+    '''
+    return self.index.keys()
+
+  def __contains__(self, key):
+    return key in self.index
+
+  def __len__(self):
+    return len(self.index)
+
+  def view(self, doi, fmt):
+    '''
+    Returns a memoryview of an article's bytes, straight from the mapped shard without copying;
+    release it before closing the reader
+    '''
+    number, offset, length = self.index[(doi, fmt)]
+    return memoryview(self._map(number))[offset:offset + length]
+
+  def get(self, doi, fmt):
+    '''
+    Returns an article's bytes
+
+    :rtype: bytes
+    '''
+    number, offset, length = self.index[(doi, fmt)]
+    return self._map(number)[offset:offset + length]
+
+  def close(self):
+    '''
+    Unmaps the shards
+    '''
+    with self.lock:
+      for mapped in self.maps.values():
+        mapped.close()
+      self.maps = {}
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()
+
+def _index_path(shard_path):
+  return shard_path[:-len('.shard')] + '.idx' if shard_path.endswith('.shard') else shard_path + '.idx'
+
+def _read_index(index_path):
+  if not os.path.exists(index_path):
+    return
+  with open(index_path, encoding='utf-8') as f:
+    for line in f:
+      #A line cut short by a crash has no matching complete record
+      if line.endswith('\n'):
+        yield json.loads(line)
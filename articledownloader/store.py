@@ -0,0 +1,229 @@
+'''
+Content-addressed store for downloaded articles, with a SQLite index from DOI to stored object
+'''
+
+import gzip
+import hashlib
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+try:
+  import zstandard
+except ImportError:
+  zstandard = None
+
+#File name suffix of each compression codec
+EXTENSIONS = {'zstd': '.zst', 'gzip': '.gz'}
+
+class ArticleStore:
+  '''
+  Keeps article bodies under root/objects, named by the SHA-256 of their content and sharded
+  into two levels of subdirectories (objects/ab/cd/abcd...), so no directory holds more than
+  a few thousand files. Identical payloads are stored once. Text formats are compressed
+  while they are written, with zstd when the zstandard package is installed and gzip
+  otherwise. An index maps each (DOI, format) to its object, for quick lookups and
+  "already have it" checks.
+
+  Pass a store wherever the get_*_from_doi methods take a file:
+
+    store = ArticleStore('articles')
+    downloader.get_pdf_from_doi(doi, store, 'crossref')
+    with store.open(doi, 'pdf') as f:
+      pdf = f.read()
+  '''
+
+  def __init__(self, root, compress=('html', 'xml'), level=3):
+    '''
+    :param root: directory to keep the store in (created if missing)
+    :type root: str
+
+    :param compress: formats that are compressed when stored
+    :type compress: tuple
+
+    :param level: compression level
+    :type level: int
+    '''
+    self.root = root
+    self.compress = compress
+    self.level = level
+    self.codec = 'zstd' if zstandard is not None else 'gzip'
+    self.tmp_dir = os.path.join(root, 'tmp')
+    if not os.path.isdir(self.tmp_dir):
+      os.makedirs(self.tmp_dir)
+
+    self.lock = threading.Lock()
+    self.db = sqlite3.connect(os.path.join(root, 'index.sqlite'), timeout=30, check_same_thread=False)
+    with self.lock, self.db:
+      self.db.execute('''
+        CREATE TABLE IF NOT EXISTS articles (
+          doi TEXT,
+          fmt TEXT,
+          digest TEXT,
+          codec TEXT,
+          size INTEGER,
+          stored_size INTEGER,
+          updated REAL,
+          PRIMARY KEY (doi, fmt)
+        )''')
+
+  def object_path(self, digest, codec=None):
+    '''
+    Returns where the object with this content digest is kept
+    '''
+    name = digest + EXTENSIONS.get(codec, '')
+    return os.path.join(self.root, 'objects', digest[:2], digest[2:4], name)
+
+  def lookup(self, doi, fmt):
+    '''
+    Returns the index entry for an article
+
+    :returns: dict with digest, codec, size, stored_size and path, or None if the article isn't stored
+    :rtype: dict
+    '''
+    with self.lock:
+      row = self.db.execute('SELECT digest, codec, size, stored_size FROM articles WHERE doi = ? AND fmt = ?',
+                            (doi, fmt)).fetchone()
+    if row is None:
+      return None
+    return {'digest': row[0], 'codec': row[1], 'size': row[2], 'stored_size': row[3],
+            'path': self.object_path(row[0], row[1])}
+
+  def has(self, doi, fmt):
+    '''
+    True if the article is already stored in this format
+    '''
+    return self.lookup(doi, fmt) is not None
+
+  def writer(self, doi, fmt):
+    '''
+    Returns a file-like object that stores what is written to it as this article once committed
+
+    :rtype: articledownloader.store.StoreWriter
+    '''
+    return StoreWriter(self, doi, fmt, self.codec if fmt in self.compress else None)
+
+  def _add(self, doi, fmt, tmp_path, digest, codec, size):
+    path = self.object_path(digest, codec)
+    if os.path.exists(path):
+      os.remove(tmp_path)
+    else:
+      if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+      os.replace(tmp_path, path)
+
+    with self.lock, self.db:
+      self.db.execute('INSERT OR REPLACE INTO articles VALUES (?, ?, ?, ?, ?, ?, ?)',
+                      (doi, fmt, digest, codec, size, os.path.getsize(path), time.time()))
+
+  def open(self, doi, fmt):
+    '''
+    Opens a stored article for reading, decompressing it if needed
+
+    :returns: binary file object
+    :rtype: file
+    '''
+    entry = self.lookup(doi, fmt)
+    if entry is None:
+      raise KeyError((doi, fmt))
+    if entry['codec'] == 'zstd':
+      if zstandard is None:
+        raise RuntimeError('zstandard is needed to read ' + entry['path'])
+      return zstandard.ZstdDecompressor().stream_reader(open(entry['path'], 'rb'), closefd=True)
+    if entry['codec'] == 'gzip':
+      return gzip.open(entry['path'], 'rb')
+    return open(entry['path'], 'rb')
+
+  def get(self, doi, fmt):
+    '''
+    Returns the content of a stored article
+
+    :rtype: bytes
+    '''
+    with self.open(doi, fmt) as f:
+      return f.read()
+
+  def close(self):
+    '''
+    Closes the index's SQLite connection
+    '''
+    self.db.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()
+
+class StoreWriter:
+  '''
+  Streams one article into the store: the content is hashed and, for text formats,
+  compressed as it is written to a temporary file, which commit() moves to its
+  content-addressed location (or drops, if the store already has that content).
+  '''
+
+  def __init__(self, store, doi, fmt, codec=None):
+    self.store = store
+    self.doi = doi
+    self.fmt = fmt
+    self.codec = codec
+    self.hash = hashlib.sha256()
+    self.size = 0
+    self.file = None
+    self.stream = None
+    self.closed = False
+
+  def _open(self):
+    fd, self.tmp_path = tempfile.mkstemp(suffix='.part', dir=self.store.tmp_dir)
+    self.file = os.fdopen(fd, 'wb')
+    if self.codec == 'zstd':
+      self.stream = zstandard.ZstdCompressor(level=self.store.level).stream_writer(self.file, closefd=False)
+    elif self.codec == 'gzip':
+      self.stream = gzip.GzipFile(fileobj=self.file, mode='wb', compresslevel=self.store.level, mtime=0)
+    else:
+      self.stream = self.file
+
+  def write(self, data):
+    if self.file is None:
+      self._open()
+    self.hash.update(data)
+    self.size += len(data)
+    self.stream.write(data)
+    return len(data)
+
+  def _close(self):
+    self.closed = True
+    if self.file is None:
+      return
+    if self.stream is not self.file:
+      self.stream.close()
+    self.file.close()
+
+  def commit(self):
+    '''
+    Adds the article to the store
+    '''
+    if self.closed:
+      return
+    if self.file is None:
+      self._open()
+    self._close()
+    self.store._add(self.doi, self.fmt, self.tmp_path, self.hash.hexdigest(), self.codec, self.size)
+
+  def abort(self):
+    '''
+    Discards everything written so far
+    '''
+    if self.closed:
+      return
+    self._close()
+    if self.file is not None:
+      os.remove(self.tmp_path)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.abort()
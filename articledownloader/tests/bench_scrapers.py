@@ -0,0 +1,40 @@
+'''
+Compares the byte-level fast path of the PDF-link scrapers with the HTMLParser path, over the
+landing pages in fixtures/. Those pages are synthetic: each publisher's real link markup,
+padded with repeated navigation and script lines, so the timings only show the relative cost
+of the two paths on pages of that size, not what to expect on real landing pages. Run from
+the repository root:
+
+  python articledownloader/tests/bench_scrapers.py
+'''
+
+import os
+import sys
+from timeit import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from articledownloader import scrapers
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+SCRAPERS = [('rsc', scrapers.RSC), ('ecs', scrapers.ECS), ('nature', scrapers.Nature)]
+CHUNK_SIZE = 8192
+
+def load_chunks(name):
+  with open(os.path.join(FIXTURES, name + '_landing.html'), 'rb') as f:
+    page = f.read()
+  return [page[i:i + CHUNK_SIZE] for i in range(0, len(page), CHUNK_SIZE)]
+
+def main(number=50):
+  print('%-8s %12s %12s %8s' % ('fixture', 'parser (ms)', 'fast (ms)', 'speedup'))
+  for name, scraper in SCRAPERS:
+    chunks = load_chunks(name)
+    parsed = scraper().feed_chunks(chunks, fast=False)
+    fast = scraper().feed_chunks(chunks, fast=True)
+    assert parsed == fast, (name, parsed, fast)
+
+    parser_ms = timeit(lambda: scraper().feed_chunks(chunks, fast=False), number=number) * 1000 / number
+    fast_ms = timeit(lambda: scraper().feed_chunks(chunks, fast=True), number=number) * 1000 / number
+    print('%-8s %12.3f %12.3f %7.1fx' % (name, parser_ms, fast_ms, parser_ms / fast_ms))
+
+if __name__ == '__main__':
+  main()
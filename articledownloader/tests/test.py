@@ -1,7 +1,37 @@
-from articledownloader.articledownloader import ArticleDownloader
-from os import environ
+from articledownloader.articledownloader import ArticleDownloader, _prefetch
+from articledownloader import scrapers
+from articledownloader.cache import HTTPCache
+from articledownloader.keypool import APIKeyPool, QuotaExhaustedError
+from articledownloader.manifest import CrawlManifest
+from articledownloader.ratelimit import RateLimiter, build_rate_limiter
+from articledownloader.records import MetadataRecord, ParquetMetadataWriter, JSONLMetadataWriter, CSVMetadataWriter
+from articledownloader.resilience import CircuitBreaker, CircuitOpenError, RetryPolicy
+from articledownloader.resolver import DOIResolver
+from articledownloader.routing import ModeRouter
+from articledownloader.shards import ShardReader, ShardWriter
+from articledownloader.store import ArticleStore
+from articledownloader.validation import NotPDF, PaywallPage, UnexpectedXMLRoot, validator_for
+from articledownloader.workqueue import JobQueue, SQLiteJobQueue, Worker
+from articledownloader.writers import AtomicFileWriter, copy_body, write_body
+from datetime import datetime, timezone
+from io import BytesIO
+from os import environ, listdir, path
 from unittest import TestCase
-from tempfile import TemporaryFile
+from tempfile import TemporaryFile, mkdtemp
+from threading import Event, Lock, Thread
+from urllib.parse import unquote
+import asyncio
+import csv
+import gzip
+import json
+import time
+import requests
+import urllib3
+
+try:
+  from articledownloader.asyncdownloader import AsyncArticleDownloader
+except ImportError: #aiohttp is optional
+  AsyncArticleDownloader = None
 
 class Tester(TestCase):
   def setUp(self):
@@ -31,3 +61,1035 @@ class Tester(TestCase):
 
   def tearDown(self):
     pass
+
+class RateLimiterTester(TestCase):
+  def test_burst_then_wait(self):
+    limiter = RateLimiter(default=(10, 3))
+    delays = [limiter.reserve('example.org') for i in range(5)]
+    self.assertEqual(delays[:3], [0.0, 0.0, 0.0])
+    self.assertTrue(0 < delays[3] < delays[4] <= 0.2)
+
+  def test_domain_limits_cover_subdomains(self):
+    limiter = RateLimiter(default=(1, 1), limits={'nature.com': (None, 1)})
+    for i in range(10):
+      self.assertEqual(limiter.reserve('www.nature.com'), 0.0)
+
+  def test_crossref_pacing_is_separate_from_downloads(self):
+    limiter = build_rate_limiter(sleep_sec=2)
+    self.assertEqual(limiter.reserve('api.crossref.org'), 0.0)
+    self.assertGreater(limiter.reserve('api.crossref.org'), 1.9)
+    self.assertEqual([limiter.reserve('doi.org') for i in range(5)], [0.0] * 5)
+    self.assertEqual(limiter.bucket('pubs.acs.org').rate, 5)
+
+    limiter = build_rate_limiter(download_rate_limit=None, rate_limits={'nature.com': (1, 1)})
+    self.assertEqual(limiter.bucket('api.crossref.org').rate, 10)
+    self.assertEqual([limiter.reserve('doi.org') for i in range(50)], [0.0] * 50)
+    self.assertEqual(limiter.bucket('www.nature.com').rate, 1)
+
+class HTTPCacheTester(TestCase):
+  def setUp(self):
+    self.cache = HTTPCache(path.join(mkdtemp(), 'cache.sqlite'), ttl_sec=60, max_bytes=25)
+    self.headers = {'Accept': 'application/json'}
+
+  def response(self, body, etag=None):
+    r = requests.Response()
+    r.status_code = 200
+    r._content = body
+    if etag is not None:
+      r.headers['ETag'] = etag
+    return r
+
+  def test_roundtrip_and_revalidation(self):
+    url = 'https://api.crossref.org/works/10.1/a'
+    self.cache.store(url, self.headers, self.response(b'{"message": {}}', etag='"v1"'))
+    entry = self.cache.lookup(url, self.headers)
+    self.assertTrue(self.cache.is_fresh(entry))
+    self.assertEqual(self.cache.response(entry).json(), {'message': {}})
+    self.assertEqual(self.cache.revalidation_headers(entry), {'If-None-Match': '"v1"'})
+    self.assertIsNone(self.cache.lookup(url, {'Accept': 'text/xml'}))
+
+  def test_lru_eviction(self):
+    for name in ['a', 'b', 'c']:
+      self.cache.store('http://x/' + name, self.headers, self.response(b'0123456789'))
+      self.cache.lookup('http://x/a', self.headers)
+    self.assertIsNotNone(self.cache.lookup('http://x/a', self.headers))
+    self.assertIsNone(self.cache.lookup('http://x/b', self.headers))
+    self.assertIsNotNone(self.cache.lookup('http://x/c', self.headers))
+
+  def tearDown(self):
+    self.cache.close()
+
+class DOIResolverTester(TestCase):
+  def test_learns_prefix_template(self):
+    resolver = DOIResolver(min_template_hits=2)
+    resolver.learn('10.1038/nmat1001', 'https://www.nature.com/articles/nmat1001')
+    self.assertIsNone(resolver.lookup('10.1038/nmat1002'))
+    resolver.learn('10.1038/nmat1003', 'https://www.nature.com/articles/nmat1003')
+    self.assertEqual(resolver.lookup('10.1038/nmat1002'), 'https://www.nature.com/articles/nmat1002')
+
+  def test_persists_and_bounds_urls(self):
+    cache_path = path.join(mkdtemp(), 'resolver.json')
+    resolver = DOIResolver(path=cache_path, max_entries=1)
+    resolver.learn('10.1039/a', 'https://pubs.rsc.org/en/content/articlelanding/2015/ta/x1')
+    resolver.learn('10.1039/b', 'https://pubs.rsc.org/en/content/articlelanding/2015/ta/x2')
+    resolver.save()
+    reloaded = DOIResolver(path=cache_path)
+    self.assertIsNone(reloaded.lookup('10.1039/a'))
+    self.assertEqual(reloaded.lookup('10.1039/b'), 'https://pubs.rsc.org/en/content/articlelanding/2015/ta/x2')
+
+  def test_never_templates_prefixes_that_disagree(self):
+    resolver = DOIResolver(min_template_hits=2)
+    resolver.learn('10.1039/c4ta00001a', 'https://pubs.rsc.org/en/content/articlelanding/2014/ta/c4ta00001a')
+    resolver.learn('10.1039/c4cp00002b', 'https://pubs.rsc.org/en/content/articlelanding/2014/cp/c4cp00002b')
+    resolver.learn('10.1039/c4ta00003c', 'https://pubs.rsc.org/en/content/articlelanding/2014/ta/c4ta00003c')
+    resolver.learn('10.1039/c4ta00004d', 'https://pubs.rsc.org/en/content/articlelanding/2014/ta/c4ta00004d')
+    self.assertIsNone(resolver.lookup('10.1039/c9cp00001x'))
+
+  def test_dead_template_urls_are_forgotten(self):
+    cache_path = path.join(mkdtemp(), 'resolver.json')
+    resolver = DOIResolver(path=cache_path, min_template_hits=2)
+    resolver.learn('10.1039/c4ta00001a', 'https://pubs.rsc.org/en/content/articlelanding/2014/ta/c4ta00001a')
+    resolver.learn('10.1039/c4ta00002b', 'https://pubs.rsc.org/en/content/articlelanding/2014/ta/c4ta00002b')
+    self.assertEqual(resolver.lookup('10.1039/c9cp00001x'),
+                     'https://pubs.rsc.org/en/content/articlelanding/2014/ta/c9cp00001x')
+    resolver.forget('10.1039/c9cp00001x')
+    resolver.learn('10.1039/c9cp00001x', 'https://pubs.rsc.org/en/content/articlelanding/2019/cp/c9cp00001x')
+    resolver.learn('10.1039/c4ta00005e', 'https://pubs.rsc.org/en/content/articlelanding/2014/ta/c4ta00005e')
+    resolver.learn('10.1039/c4ta00006f', 'https://pubs.rsc.org/en/content/articlelanding/2014/ta/c4ta00006f')
+    resolver.save()
+    self.assertIsNone(DOIResolver(path=cache_path).lookup('10.1039/c9cp00009z'))
+
+  def test_downloader_resolves_again_after_dead_url(self):
+    downloader = ArticleDownloader(sleep_sec=0, resolver=DOIResolver(min_template_hits=2))
+    for suffix in ['c4ta00001a', 'c4ta00002b']:
+      downloader.resolver.learn('10.1039/' + suffix, 'https://pubs.rsc.org/en/content/articlelanding/2014/ta/' + suffix)
+    requested = []
+    def get(url, **kwargs):
+      requested.append(url)
+      r = requests.Response()
+      r.headers = requests.structures.CaseInsensitiveDict()
+      r.raw = BytesIO(b'<html>article</html>')
+      if url.startswith('https://doi.org/'):
+        r.status_code = 200
+        r.url = 'https://pubs.rsc.org/en/content/articlelanding/2019/cp/c9cp00001x'
+        r.history = [requests.Response()]
+      else:
+        r.status_code = 200 if '2019/cp' in url else 404
+      return r
+    downloader._get = get
+    self.assertTrue(downloader.get_html_from_doi('10.1039/c9cp00001x', BytesIO(), 'rsc'))
+    self.assertEqual(requested, ['https://pubs.rsc.org/en/content/articlehtml/2014/ta/c9cp00001x',
+                                 'https://doi.org/10.1039/c9cp00001x',
+                                 'https://pubs.rsc.org/en/content/articlehtml/2019/cp/c9cp00001x'])
+    self.assertIsNone(downloader.resolver.lookup('10.1039/c9ta00002y'))
+
+class MetadataForDOIsTester(TestCase):
+  def item(self, doi):
+    return {'DOI': doi, 'ISSN': ['1234-5678'], 'title': ['T'], 'prefix': '10.1', 'container-title': ['J'],
+            'publisher': 'P', 'references-count': 0, 'is-referenced-by-count': 0}
+
+  def setUp(self):
+    self.downloader = ArticleDownloader(sleep_sec=0)
+    self.requested = []
+    def get(url, **kwargs):
+      self.requested.append(url)
+      r = requests.Response()
+      if 'filter=' in url:
+        dois = [unquote(value[len('doi:'):]) for value in url.split('filter=')[1].split('&')[0].split(',')]
+        items = [self.item(doi) for doi in dois]
+      else:
+        dois = [unquote(url.split('/works/')[1])]
+        items = self.item(dois[0])
+      if any('bad' in doi for doi in dois):
+        r.status_code = 400
+        r._content = b'Resource not found.'
+      else:
+        r.status_code = 200
+        r._content = json.dumps({'message': {'items': items} if 'filter=' in url else items}).encode('utf-8')
+      return r
+    self.downloader._get = get
+
+  def test_batches_and_quotes(self):
+    dois = ['10.1/a', '10.1/b<1>', '10.1/c,d', '10.1/e', '10.1/f']
+    found = sorted(record['doi'] for record in self.downloader.get_metadata_for_dois(dois, batch_size=2, max_workers=1))
+    self.assertEqual(found, sorted(dois))
+    batch_urls = [url for url in self.requested if 'filter=' in url]
+    self.assertEqual(len(batch_urls), 3)
+    self.assertIn('filter=doi:10.1/a,doi:10.1/b%3C1%3E&', batch_urls[0])
+    self.assertTrue(any(url.endswith('/works/10.1/c,d') for url in self.requested))
+    self.assertNotIn('10.1/c', ''.join(batch_urls))
+
+  def test_failed_batch_falls_back_to_single_lookups(self):
+    dois = ['10.1/a', '10.1/bad', '10.1/c', '10.1/d']
+    found = sorted(record['doi'] for record in self.downloader.get_metadata_for_dois(dois, batch_size=3, max_workers=2))
+    self.assertEqual(found, ['10.1/a', '10.1/c', '10.1/d'])
+
+class CrawlManifestTester(TestCase):
+  def setUp(self):
+    self.manifest_path = path.join(mkdtemp(), 'manifest.sqlite')
+    self.manifest = CrawlManifest(self.manifest_path)
+
+  def test_resume_sweep(self):
+    key = 'https://api.crossref.org/works?query=battery'
+    self.assertEqual(self.manifest.start_sweep(key), '*')
+    self.manifest.checkpoint(key, [{'DOI': '10.1/a'}], 'cursor-2')
+    self.manifest.close()
+
+    self.manifest = CrawlManifest(self.manifest_path)
+    self.assertEqual(self.manifest.start_sweep(key), 'cursor-2')
+    self.assertEqual(list(self.manifest.iter_sweep_pages(key)), [[{'DOI': '10.1/a'}]])
+    self.manifest.finish_sweep(key)
+    self.assertEqual(self.manifest.start_sweep(key), '*')
+
+    #A sweep checkpointed without its pages resumes only if they won't be replayed
+    self.manifest.checkpoint(key, None, 'cursor-2')
+    self.assertEqual(self.manifest.start_sweep(key, replay=False), 'cursor-2')
+    self.assertEqual(self.manifest.swept_pages(key), 1)
+    self.assertEqual(self.manifest.start_sweep(key), '*')
+
+  def test_download_status(self):
+    self.manifest.record_download('10.1/a', 'pdf', 'elsevier', False, 'timeout')
+    self.assertFalse(self.manifest.is_done('10.1/a', 'pdf'))
+    self.manifest.record_download('10.1/a', 'pdf', 'elsevier', True)
+    self.assertTrue(self.manifest.is_done('10.1/a', 'pdf'))
+    self.assertEqual(self.manifest.download_status('10.1/a', 'pdf')['attempts'], 2)
+
+  def test_expired_cursor_restarts_sweep(self):
+    downloader = ArticleDownloader(sleep_sec=0, manifest=self.manifest, prefetch_pages=0)
+    pages = {'*': (['a', 'b'], 'c2'), 'c2': (['c', 'd'], 'c3'), 'c3': (['e'], 'c4'), 'c4': ([], 'c5')}
+    requested = []
+    def get(url, **kwargs):
+      cursor = url.split('cursor=')[1]
+      requested.append(cursor)
+      r = requests.Response()
+      if cursor not in pages: #CrossRef rejects cursors that have expired
+        r.status_code = 400
+        r._content = b'{"status": "failed"}'
+        return r
+      names, next_cursor = pages[cursor]
+      r.status_code = 200
+      r._content = json.dumps({'message': {'items': [{'DOI': '10.1/' + name} for name in names],
+                                           'next-cursor': next_cursor}}).encode('ascii')
+      return r
+    downloader._get = get
+
+    dois = downloader.iter_dois_from_search('battery', rows=None)
+    self.assertEqual([next(dois) for i in range(3)], ['10.1/a', '10.1/b', '10.1/c'])
+    dois.close()
+    #By the time the run resumes, its cursor has expired and CrossRef hands out new ones
+    pages = {'*': (['a', 'b'], 'n2'), 'n2': (['c', 'd'], 'n3'), 'n3': (['e'], 'n4'), 'n4': ([], 'n5')}
+    self.assertEqual(list(downloader.iter_dois_from_search('battery', rows=None)),
+                     ['10.1/' + name for name in 'abcde'])
+    self.assertEqual(requested[2:], ['c2', '*', 'n2', 'n3', 'n4'])
+    self.assertEqual(self.manifest.db.execute('SELECT done FROM sweeps').fetchall(), [(1,)])
+
+  def tearDown(self):
+    self.manifest.close()
+
+class PrefetchTester(TestCase):
+  def pages(self, n, fail_at=None):
+    self.produced = 0
+    self.closed = Event()
+    try:
+      for i in range(n):
+        if i == fail_at:
+          raise ValueError('bad page')
+        self.produced += 1
+        yield [i]
+    finally:
+      self.closed.set()
+
+  def test_order_and_errors(self):
+    self.assertEqual(list(_prefetch(self.pages(20), 3)), [[i] for i in range(20)])
+    pages = _prefetch(self.pages(5, fail_at=2), 1)
+    self.assertEqual([next(pages), next(pages)], [[0], [1]])
+    self.assertRaises(ValueError, next, pages)
+
+  def test_bounded_look_ahead_and_close(self):
+    pages = _prefetch(self.pages(100), 2)
+    self.assertEqual(next(pages), [0])
+    time.sleep(0.05)
+    self.assertEqual(self.produced, 3)
+    pages.close()
+    self.assertTrue(self.closed.wait(1))
+    self.assertEqual(self.produced, 3)
+
+  def test_checkpoints_follow_consumer(self):
+    manifest = CrawlManifest(path.join(mkdtemp(), 'manifest.sqlite'))
+    downloader = ArticleDownloader(sleep_sec=0, manifest=manifest, prefetch_pages=2)
+    pages = {'*': (['a', 'b'], 'c2'), 'c2': (['c', 'd'], 'c3'), 'c3': (['e', 'f'], 'c4'), 'c4': ([], 'c5')}
+    requested = []
+    def get(url, **kwargs):
+      cursor = url.split('cursor=')[1]
+      requested.append(cursor)
+      names, next_cursor = pages[cursor]
+      r = requests.Response()
+      r.status_code = 200
+      r._content = json.dumps({'message': {'items': [{'DOI': '10.1/' + name} for name in names],
+                                           'next-cursor': next_cursor}}).encode('ascii')
+      return r
+    downloader._get = get
+
+    dois = downloader.iter_dois_from_search('battery', rows=None)
+    self.assertEqual([next(dois) for i in range(3)], ['10.1/a', '10.1/b', '10.1/c'])
+    time.sleep(0.05)
+    dois.close()
+    #Two pages past the one being consumed were fetched, but only the finished page is checkpointed
+    self.assertEqual(requested, ['*', 'c2', 'c3', 'c4'])
+    self.assertEqual(manifest.db.execute('SELECT cursor, pages, done FROM sweeps').fetchall(), [('c2', 1, 0)])
+
+    self.assertEqual(list(downloader.iter_dois_from_search('battery', rows=None)),
+                     ['10.1/' + name for name in 'abcdef'])
+    self.assertEqual(requested[4:], ['c2', 'c3', 'c4'])
+    manifest.close()
+
+class MultiQueryTester(TestCase):
+  def setUp(self):
+    self.downloader = ArticleDownloader(sleep_sec=0)
+    self.started = []
+    self.found = {'q1': ['10.1/a', '10.1/b'], 'q2': ['10.1/b', '10.1/c'], 'q3': ['10.1/c']}
+    def search(query, rows=500, mailto=None):
+      self.started.append(query)
+      for doi in self.found.get(query, ['10.1/' + query, '10.1/' + query + 'x']):
+        if doi == 'error':
+          raise ValueError('bad page')
+        yield doi
+        time.sleep(0.1 if query not in self.found else 0)
+    self.downloader.iter_dois_from_search = search
+
+  def test_dedupes_across_queries(self):
+    results = list(self.downloader.iter_dois_from_queries(['q1', 'q2', 'q3'], max_workers=2))
+    self.assertEqual(len(results), 5)
+    self.assertEqual(sorted(doi for doi, _, first_seen in results if first_seen), ['10.1/a', '10.1/b', '10.1/c'])
+    found = self.downloader.get_dois_from_queries(['q1', 'q2', 'q3'])
+    self.assertEqual(sorted(found['10.1/b']), ['q1', 'q2'])
+    self.assertEqual(sorted(found['10.1/c']), ['q2', 'q3'])
+
+  def test_errors_propagate(self):
+    self.found['q2'] = ['10.1/b', 'error']
+    self.assertRaises(ValueError, list, self.downloader.iter_dois_from_queries(['q1', 'q2', 'q3']))
+
+  def test_stopping_early_skips_queued_queries(self):
+    results = self.downloader.iter_dois_from_queries(['slow' + str(i) for i in range(40)], max_workers=2)
+    next(results)
+    results.close()
+    self.assertLessEqual(len(self.started), 2)
+
+class IncrementalHarvestTester(TestCase):
+  def setUp(self):
+    self.manifest = CrawlManifest(path.join(mkdtemp(), 'manifest.sqlite'))
+    self.downloader = ArticleDownloader(sleep_sec=0, manifest=self.manifest, prefetch_pages=0)
+    self.requested = []
+    self.fail_page = False
+    def get(url, **kwargs):
+      self.requested.append(url)
+      if 'cursor=*' not in url and self.fail_page:
+        raise requests.ConnectionError('dropped')
+      items = [] if 'cursor=*' not in url else [
+        {'DOI': '10.1/' + name, 'ISSN': ['1234-5678'], 'title': ['T'], 'prefix': '10.1', 'container-title': ['J'],
+         'publisher': 'P', 'references-count': 0, 'is-referenced-by-count': 0} for name in ['a', 'b']]
+      r = requests.Response()
+      r.status_code = 200
+      r._content = json.dumps({'message': {'items': items, 'next-cursor': 'c2'}}).encode('ascii')
+      return r
+    self.downloader._get = get
+
+  def test_needs_manifest(self):
+    self.assertRaises(ValueError, ArticleDownloader(sleep_sec=0).iter_dois_from_journal_issn, '1234-5678',
+                      incremental=True)
+
+  def test_watermark_moves_after_complete_sweep(self):
+    self.assertEqual(self.downloader.get_dois_from_journal_issn('1234-5678', incremental=True), ['10.1/a', '10.1/b'])
+    self.assertNotIn('from-index-date', self.requested[0])
+
+    self.requested = []
+    self.downloader.get_dois_from_journal_issn('1234-5678', incremental=True)
+    today = datetime.now(timezone.utc).strftime('%Y-%m-%d')
+    self.assertIn('filter=from-pub-date:2000,from-index-date:' + today + '&', self.requested[0])
+
+  def test_interrupted_sweep_keeps_watermark(self):
+    self.fail_page = True
+    dois = self.downloader.iter_dois_from_journal_issn('1234-5678', incremental=True)
+    self.assertEqual(next(dois), '10.1/a')
+    dois.close()
+    self.assertRaises(requests.ConnectionError, self.downloader.get_dois_from_journal_issn, '1234-5678',
+                      incremental=True)
+
+    self.fail_page = False
+    self.requested = []
+    self.downloader.get_dois_from_journal_issn('1234-5678', incremental=True)
+    self.assertNotIn('from-index-date', self.requested[0])
+
+  def test_refresh_merges_into_store(self):
+    store = {'10.1/a': None, '10.1/z': 'kept'}
+    self.assertEqual(self.downloader.refresh_metadata_from_journal_issn('1234-5678', store), 2)
+    self.assertEqual(store['10.1/a']['title'], 'T')
+    self.assertEqual(store['10.1/z'], 'kept')
+
+  def tearDown(self):
+    self.manifest.close()
+
+class ScraperTester(TestCase):
+  def test_stops_at_link(self):
+    link = 'http://pubs.rsc.org/en/content/articlepdf/2015/ta/c5ta01234a'
+    page = [b'<html><head><meta name="citation_pdf_url" content="' + link.encode('ascii') + b'"/>', b'</head>']
+    read = []
+    def chunks():
+      for chunk in page + [b'<body>never read</body>'] * 100:
+        read.append(chunk)
+        yield chunk
+    self.assertEqual(scrapers.RSC().feed_chunks(chunks()), link)
+    self.assertEqual(len(read), 1)
+
+  def test_no_link(self):
+    self.assertIsNone(scrapers.Nature().feed_chunks([b'<html><body><a href="/x">', b'</a></body></html>']))
+
+  def test_fast_path_matches_parser(self):
+    fixtures = path.join(path.dirname(path.abspath(__file__)), 'fixtures')
+    for name, scraper in [('rsc', scrapers.RSC), ('ecs', scrapers.ECS), ('nature', scrapers.Nature)]:
+      with open(path.join(fixtures, name + '_landing.html'), 'rb') as f:
+        page = f.read()
+      chunks = [page[i:i + 8192] for i in range(0, len(page), 8192)]
+      parsed = scraper().feed_chunks(chunks, fast=False)
+      self.assertIsNotNone(parsed)
+      self.assertEqual(scraper().feed_chunks(chunks), parsed)
+
+class MetadataRecordTester(TestCase):
+  def setUp(self):
+    self.records = [{'doi': '10.1/' + str(i), 'issn': '1234-5678', 'title': 'Title ' + str(i), 'prefix': '10.1',
+                     'journal': 'J', 'publisher': 'P', 'volume': '1', 'issue': None, 'page': '1-2', 'year': 2000 + i,
+                     'num_references': i, 'times_cited': None} for i in range(5)]
+
+  def test_roundtrip(self):
+    record = MetadataRecord.from_dict(self.records[0])
+    self.assertEqual(record.to_dict(), self.records[0])
+    self.assertFalse(hasattr(record, '__dict__'))
+
+  def test_parquet_export(self):
+    try:
+      import pyarrow.parquet as pq
+    except ImportError:
+      self.skipTest('pyarrow is not installed')
+    parquet_path = path.join(mkdtemp(), 'metadata.parquet')
+    with ParquetMetadataWriter(parquet_path, row_group_size=2) as writer:
+      writer.write(self.records[:3])
+      writer.write(MetadataRecord.from_dict(record) for record in self.records[3:])
+    table = pq.read_table(parquet_path)
+    self.assertEqual(table.to_pylist(), self.records)
+    self.assertEqual(pq.ParquetFile(parquet_path).metadata.num_row_groups, 3)
+
+  def test_streaming_writers(self):
+    tmp = mkdtemp()
+    with JSONLMetadataWriter(path.join(tmp, 'metadata.jsonl')) as sink:
+      sink.write(self.records[:2])
+      sink.write([MetadataRecord.from_dict(record) for record in self.records[2:]])
+    with open(path.join(tmp, 'metadata.jsonl')) as f:
+      self.assertEqual([json.loads(line) for line in f], self.records)
+
+    with CSVMetadataWriter(path.join(tmp, 'metadata.csv')) as sink:
+      sink.write(self.records[:2])
+    with CSVMetadataWriter(path.join(tmp, 'metadata.csv'), append=True) as sink:
+      sink.write(self.records[2:])
+    with open(path.join(tmp, 'metadata.csv')) as f:
+      rows = list(csv.DictReader(f))
+    self.assertEqual([row['doi'] for row in rows], [record['doi'] for record in self.records])
+    self.assertEqual(rows[0]['issue'], '')
+
+class ResumedSinkTester(TestCase):
+  expire = False
+
+  def test_resume_writes_each_page_once(self):
+    tmp = mkdtemp()
+    manifest = CrawlManifest(path.join(tmp, 'manifest.sqlite'))
+    downloader = ArticleDownloader(sleep_sec=0, manifest=manifest, prefetch_pages=0)
+    pages = {'*': (['a', 'b'], 'c2'), 'c2': (['c', 'd'], 'c3'), 'c3': (['e', 'f'], 'c4'), 'c4': ([], 'c5')}
+    crash = [True]
+    def get(url, **kwargs):
+      cursor = url.split('cursor=')[1]
+      if cursor == 'c3' and crash[0]:
+        raise requests.ConnectionError('dropped')
+      r = requests.Response()
+      if cursor not in pages:
+        r.status_code = 400
+        return r
+      names, next_cursor = pages[cursor]
+      items = [{'DOI': '10.1/' + name, 'ISSN': ['1234-5678'], 'title': ['T'], 'prefix': '10.1',
+                'container-title': ['J'], 'publisher': 'P', 'references-count': 0, 'is-referenced-by-count': 0}
+               for name in names]
+      r.status_code = 200
+      r._content = json.dumps({'message': {'items': items, 'next-cursor': next_cursor}}).encode('ascii')
+      return r
+    downloader._get = get
+
+    jsonl_path = path.join(tmp, 'journal.jsonl')
+    with JSONLMetadataWriter(jsonl_path) as sink:
+      self.assertRaises(requests.ConnectionError, downloader.get_metadata_from_journal_issn, '1234-5678', rows=None,
+                        sink=sink)
+    #Nothing will replay the pages, so only the cursor and page count were kept
+    self.assertEqual(manifest.db.execute('SELECT cursor, pages FROM sweeps').fetchall(), [('c3', 2)])
+    self.assertEqual(manifest.db.execute('SELECT COUNT(*) FROM sweep_pages').fetchone(), (0,))
+    crash[0] = False
+    if self.expire:
+      #The cursor expired in the meantime: the sweep restarts and skips the two pages the sink already got
+      pages = {'*': (['a', 'b'], 'n2'), 'n2': (['c', 'd'], 'n3'), 'n3': (['e', 'f'], 'n4'), 'n4': ([], 'n5')}
+    with JSONLMetadataWriter(jsonl_path, append=True) as sink:
+      self.assertEqual(downloader.get_metadata_from_journal_issn('1234-5678', rows=None, sink=sink), 2)
+    manifest.close()
+
+    with open(jsonl_path) as f:
+      self.assertEqual([json.loads(line)['doi'] for line in f], ['10.1/' + name for name in 'abcdef'])
+
+  def test_resume_after_cursor_expired(self):
+    self.expire = True
+    self.test_resume_writes_each_page_once()
+
+class BodyWriterTester(TestCase):
+  def response(self, body, headers=None):
+    r = requests.Response()
+    r.status_code = 200
+    r.headers = requests.structures.CaseInsensitiveDict(headers or {})
+    r.raw = urllib3.HTTPResponse(body=BytesIO(body), headers=headers, preload_content=False)
+    return r
+
+  def test_path_is_written_atomically(self):
+    body = b'%PDF-1.4' + b'x' * 100000
+    tmp = mkdtemp()
+    target = path.join(tmp, 'article.pdf')
+    r = self.response(body, {'Content-Length': str(len(body))})
+    self.assertEqual(write_body(r, target, chunk_size=4096), len(body))
+    with open(target, 'rb') as f:
+      self.assertEqual(f.read(), body)
+    self.assertEqual(listdir(tmp), ['article.pdf'])
+
+  def test_compressed_body_is_decoded(self):
+    body = b'<html>' + b'y' * 50000 + b'</html>'
+    writefile = BytesIO()
+    copy_body(self.response(gzip.compress(body), {'Content-Encoding': 'gzip'}), writefile, chunk_size=1024)
+    self.assertEqual(writefile.getvalue(), body)
+
+  def test_commit_trims_and_abort_discards(self):
+    tmp = mkdtemp()
+    with AtomicFileWriter(path.join(tmp, 'short.pdf'), size_hint=1024) as writefile:
+      writefile.write(b'short')
+      writefile.commit()
+    self.assertEqual(path.getsize(path.join(tmp, 'short.pdf')), 5)
+    with AtomicFileWriter(path.join(tmp, 'article.pdf'), size_hint=1024) as writefile:
+      writefile.write(b'partial')
+    self.assertEqual(listdir(tmp), ['short.pdf'])
+
+class ArticleStoreTester(TestCase):
+  def setUp(self):
+    self.store = ArticleStore(mkdtemp())
+
+  def put(self, doi, fmt, body):
+    with self.store.writer(doi, fmt) as writer:
+      writer.write(body[:10])
+      writer.write(body[10:])
+      writer.commit()
+
+  def test_dedupes_and_compresses(self):
+    html = b'<html>' + b'article text ' * 1000 + b'</html>'
+    self.put('10.1/a', 'html', html)
+    self.put('10.1/b', 'html', html)
+    self.assertTrue(self.store.has('10.1/a', 'html'))
+    self.assertFalse(self.store.has('10.1/a', 'pdf'))
+    self.assertEqual(self.store.get('10.1/b', 'html'), html)
+    a, b = self.store.lookup('10.1/a', 'html'), self.store.lookup('10.1/b', 'html')
+    self.assertEqual(a['path'], b['path'])
+    self.assertLess(a['stored_size'], a['size'])
+
+  def test_pdf_is_stored_as_is_and_abort_discards(self):
+    self.put('10.1/a', 'pdf', b'%PDF-1.4 body')
+    self.assertIsNone(self.store.lookup('10.1/a', 'pdf')['codec'])
+    with self.store.writer('10.1/b', 'pdf') as writer:
+      writer.write(b'partial')
+    self.assertFalse(self.store.has('10.1/b', 'pdf'))
+    self.assertEqual(listdir(self.store.tmp_dir), [])
+
+  def tearDown(self):
+    self.store.close()
+
+class ShardTester(TestCase):
+  def test_roundtrip_across_shards(self):
+    tmp = mkdtemp()
+    bodies = dict((('10.1/' + str(i), 'html'), b'<html>' + str(i).encode('ascii') * 500 + b'</html>') for i in range(10))
+    with ShardWriter(tmp, max_bytes=2000) as shards:
+      for (doi, fmt), body in bodies.items():
+        with shards.writer(doi, fmt) as writer:
+          writer.write(body)
+          writer.commit()
+      with shards.writer('10.1/aborted', 'pdf') as writer:
+        writer.write(b'partial')
+    self.assertGreater(len([name for name in listdir(tmp) if name.endswith('.shard')]), 1)
+    self.assertTrue(ShardWriter(tmp).has('10.1/3', 'html'))
+
+    with ShardReader(tmp) as reader:
+      self.assertEqual(len(reader), 10)
+      self.assertNotIn(('10.1/aborted', 'pdf'), reader)
+      for (doi, fmt), body in bodies.items():
+        self.assertEqual(reader.get(doi, fmt), body)
+      view = reader.view('10.1/7', 'html')
+      self.assertEqual(view.tobytes(), bodies[('10.1/7', 'html')])
+      view.release()
+
+  def test_writers_sharing_a_directory_get_their_own_shards(self):
+    tmp = mkdtemp()
+    with ShardWriter(tmp) as first, ShardWriter(tmp) as second:
+      for i in range(6):
+        with (first if i % 2 else second).writer('10.1/' + str(i), 'xml') as writer:
+          writer.write(b'<xml>' + str(i).encode('ascii') * 100 + b'</xml>')
+          writer.commit()
+      self.assertNotEqual(first.shard.name, second.shard.name)
+    with ShardWriter(tmp) as third: #Starts after the shards already written
+      with third.writer('10.1/6', 'xml') as writer:
+        writer.write(b'<xml>6</xml>')
+        writer.commit()
+    self.assertEqual(len([name for name in listdir(tmp) if name.endswith('.shard')]), 3)
+
+    with ShardReader(tmp) as reader:
+      self.assertEqual(len(reader), 7)
+      for i in range(6):
+        self.assertEqual(reader.get('10.1/' + str(i), 'xml'), b'<xml>' + str(i).encode('ascii') * 100 + b'</xml>')
+
+class ValidationTester(TestCase):
+  def test_pdf_and_paywall(self):
+    validator_for('pdf', 'nature')(b'\n%PDF-1.7\n', True)
+    self.assertRaises(NotPDF, validator_for('pdf', 'acs'), b'<html><body>Error</body></html>', True)
+    self.assertRaises(PaywallPage, validator_for('pdf', 'nature'), b'<html>Access through your institution', False)
+    self.assertRaises(PaywallPage, validator_for('html', 'wiley'), b'<title>Access Denied</title>', True)
+
+  def test_xml_root(self):
+    validator_for('xml', 'elsevier')(b'<?xml version="1.0"?><!-- <article> -->\n<full-text-retrieval-response xmlns="x">',
+                                     False)
+    validator_for('xml', 'aps')(b'<?xml version="1.0"?><!DOCTYPE article SYSTEM "a.dtd"><article>', False)
+    self.assertRaises(UnexpectedXMLRoot, validator_for('xml', 'elsevier'), b'<service-error><status>', False)
+    self.assertRaises(UnexpectedXMLRoot, validator_for('xml', 'aps'), b'<?xml version="1.0"?>', True)
+
+  def test_rejected_body_is_not_written(self):
+    tmp = mkdtemp()
+    r = requests.Response()
+    r.headers = requests.structures.CaseInsensitiveDict()
+    r.raw = urllib3.HTTPResponse(body=BytesIO(b'<html>' + b'x' * 100000), preload_content=False)
+    self.assertRaises(NotPDF, write_body, r, path.join(tmp, 'article.pdf'), 4096, validator_for('pdf', 'acs'))
+    self.assertEqual(listdir(tmp), [])
+
+class ModeRouterTester(TestCase):
+  def test_prefix_table_then_learned_order(self):
+    router = ModeRouter(max_modes=3)
+    self.assertEqual(router.chain('10.1038/nmat1', 'pdf'), ['nature', 'crossref', 'elsevier'])
+    self.assertEqual(router.chain('10.1016/j.x', 'pdf', skip=('elsevier',))[0], 'crossref')
+    for i in range(3):
+      router.record('10.1038/nmat' + str(i), 'pdf', 'nature', False)
+      router.record('10.1038/nmat' + str(i), 'pdf', 'crossref', True)
+    self.assertEqual(router.chain('10.1038/nmat9', 'pdf')[0], 'crossref')
+
+  def test_persists_and_drops_failing_modes(self):
+    stats_path = path.join(mkdtemp(), 'routes.json')
+    router = ModeRouter(stats_path, max_failures=2)
+    router.record('10.9999/a', 'xml', 'aps', False)
+    router.record('10.9999/b', 'xml', 'aps', False)
+    router.save()
+    self.assertEqual(ModeRouter(stats_path, max_failures=2).chain('10.9999/c', 'xml'), ['elsevier'])
+
+  def test_auto_falls_back_and_rewinds(self):
+    downloader = ArticleDownloader(sleep_sec=0)
+    def get(url, **kwargs):
+      r = requests.Response()
+      r.status_code = 200
+      r.headers = requests.structures.CaseInsensitiveDict()
+      if 'springer' in url:
+        r.raw = urllib3.HTTPResponse(body=BytesIO(b'%PDF-1.4 springer'), preload_content=False)
+      else:
+        #The connection drops after the head has already been written
+        r.raw = urllib3.HTTPResponse(body=BytesIO(b'%PDF-1.4 ' + b'x' * 20000), headers={'Content-Length': '30000'},
+                                     preload_content=False)
+      return r
+    downloader._get = get
+    downloader.router.record('10.1021/a', 'pdf', 'springer', True)
+    self.assertEqual(downloader.router.chain('10.1021/b', 'pdf', skip=('elsevier',))[:2], ['acs', 'springer'])
+
+    writefile = BytesIO(b'header')
+    writefile.seek(6)
+    self.assertTrue(downloader.get_pdf_from_doi('10.1021/b', writefile, 'auto'))
+    self.assertEqual(writefile.getvalue(), b'header%PDF-1.4 springer')
+    self.assertEqual(downloader.router.stats['10.1021 pdf']['acs'][:2], [0, 1])
+
+  def test_dropped_modes_get_another_trial(self):
+    router = ModeRouter(max_failures=2, retry_dropped_sec=0.05)
+    for i in range(2):
+      router.record('10.1016/' + str(i), 'xml', 'elsevier', False)
+    self.assertEqual(router.chain('10.1016/x', 'xml'), ['aps'])
+    time.sleep(0.06)
+    self.assertEqual(router.chain('10.1016/x', 'xml'), ['elsevier', 'aps'])
+    router.record('10.1016/x', 'xml', 'elsevier', True)
+    self.assertEqual(router.stats['10.1016 xml']['elsevier'][:2], [1, 1])
+
+    #Statistics saved before the time of the last attempt was kept
+    router.stats['10.1039 xml'] = {'aps': [0, 5]}
+    self.assertEqual(router.chain('10.1039/x', 'xml'), ['elsevier', 'aps'])
+
+  def test_unreachable_modes_are_not_counted(self):
+    downloader = ArticleDownloader(sleep_sec=0, router=ModeRouter(max_modes=4), retry_policy=RetryPolicy(max_retries=0),
+                                   circuit_breaker=CircuitBreaker(failure_threshold=1))
+    downloader.circuit_breaker.failure('pubs.acs.org')
+    def get(url, **kwargs):
+      if 'springer' in url:
+        raise requests.ConnectionError('down')
+      r = requests.Response()
+      r.status_code = 404
+      r.raw = BytesIO()
+      return r
+    downloader.session.get = get
+    self.assertEqual(downloader.router.chain('10.1021/a', 'pdf', skip=('elsevier',)), ['acs', 'crossref', 'rsc', 'springer'])
+    self.assertFalse(downloader.get_pdf_from_doi('10.1021/a', BytesIO(), 'auto'))
+    self.assertIsInstance(downloader.last_error, requests.ConnectionError)
+    stats = downloader.router.stats['10.1021 pdf']
+    self.assertNotIn('acs', stats)
+    self.assertNotIn('springer', stats)
+    self.assertEqual(stats['crossref'][:2], [0, 1])
+    self.assertEqual(stats['rsc'][:2], [0, 1])
+
+class ResilienceTester(TestCase):
+  def response(self, status, headers=None):
+    r = requests.Response()
+    r.status_code = status
+    r.headers = requests.structures.CaseInsensitiveDict(headers or {})
+    r.raw = BytesIO()
+    return r
+
+  def test_retry_after_and_backoff(self):
+    policy = RetryPolicy(max_retries=2, backoff_sec=1, max_retry_after_sec=60)
+    self.assertEqual(policy.delay(0, self.response(429, {'Retry-After': '7'})), 7)
+    self.assertIsNone(policy.delay(0, self.response(503, {'Retry-After': '3600'})))
+    self.assertTrue(0 <= policy.delay(1, self.response(500)) <= 2)
+    self.assertIsNone(policy.delay(2))
+
+  def test_circuit_opens_and_half_opens(self):
+    breaker = CircuitBreaker(failure_threshold=2, cooldown_sec=0.05)
+    breaker.failure('example.org')
+    breaker.before('example.org')
+    breaker.failure('example.org')
+    self.assertRaises(CircuitOpenError, breaker.before, 'example.org')
+    breaker.before('other.org')
+    time.sleep(0.06)
+    breaker.before('example.org')
+    self.assertRaises(CircuitOpenError, breaker.before, 'example.org')
+    breaker.success('example.org')
+    breaker.before('example.org')
+
+  def test_get_retries_then_fails_fast(self):
+    downloader = ArticleDownloader(sleep_sec=0, retry_policy=RetryPolicy(max_retries=1, backoff_sec=0),
+                                   circuit_breaker=CircuitBreaker(failure_threshold=3))
+    responses = [self.response(503, {'Retry-After': '0'}), self.response(200)]
+    downloader.session.get = lambda url, **kwargs: responses.pop(0)
+    self.assertEqual(downloader._get('http://example.org/a').status_code, 200)
+
+    responses = [self.response(500)] * 3
+    self.assertEqual(downloader._get('http://example.org/b').status_code, 500)
+    self.assertRaises(CircuitOpenError, downloader._get, 'http://example.org/c')
+    self.assertEqual(len(responses), 0)
+    self.assertRaises(CircuitOpenError, downloader._get, 'http://example.org/d')
+
+  def test_only_transient_errors_count_against_host(self):
+    downloader = ArticleDownloader(sleep_sec=0, retry_policy=RetryPolicy(max_retries=0),
+                                   circuit_breaker=CircuitBreaker(failure_threshold=1, cooldown_sec=0.05))
+    def redirect_loop(url, **kwargs):
+      raise requests.TooManyRedirects('loop')
+    downloader.session.get = redirect_loop
+    for i in range(3):
+      self.assertRaises(requests.TooManyRedirects, downloader._get, 'http://example.org/a')
+    self.assertFalse(downloader.circuit_breaker.is_open('example.org'))
+
+    #A trial that ends in a redirect loop is released, not counted, and the next request is a trial again
+    downloader.circuit_breaker.failure('example.org')
+    time.sleep(0.06)
+    self.assertRaises(requests.TooManyRedirects, downloader._get, 'http://example.org/b')
+    def broken_transfer(url, **kwargs):
+      raise requests.exceptions.ChunkedEncodingError('cut off')
+    downloader.session.get = broken_transfer
+    self.assertRaises(requests.exceptions.ChunkedEncodingError, downloader._get, 'http://example.org/c')
+    self.assertRaises(CircuitOpenError, downloader._get, 'http://example.org/d')
+
+    time.sleep(0.11)
+    downloader.session.get = lambda url, **kwargs: self.response(200)
+    self.assertEqual(downloader._get('http://example.org/e').status_code, 200)
+    self.assertEqual(downloader._get('http://example.org/f').status_code, 200)
+
+class APIKeyPoolTester(TestCase):
+  def test_most_headroom_first(self):
+    pool = APIKeyPool(['a', 'b'])
+    self.assertEqual(pool.acquire(), 'a')
+    pool.update('a', 200, {'X-RateLimit-Limit': '100', 'X-RateLimit-Remaining': '10'})
+    self.assertEqual(pool.acquire(), 'b')
+    pool.update('b', 200, {'X-RateLimit-Limit': '100', 'X-RateLimit-Remaining': '50'})
+    self.assertEqual(pool.acquire(), 'b')
+    self.assertEqual(pool.headroom(), {'a': 10, 'b': 49})
+
+  def test_exhausted_keys_are_set_aside_until_reset(self):
+    pool = APIKeyPool(['a', 'b'])
+    pool.update('a', 429, {'X-ELS-Status': 'QUOTA_EXCEEDED - Quota Exceeded',
+                           'X-RateLimit-Reset': str(int(time.time()) + 3600)})
+    pool.update('b', 200, {'X-RateLimit-Remaining': '0', 'X-RateLimit-Reset': '1'})
+    self.assertRaises(QuotaExhaustedError, pool.acquire)
+    time.sleep(1.1)
+    self.assertEqual(pool.acquire(), 'b')
+
+  def test_throttled_keys_are_only_rested_briefly(self):
+    pool = APIKeyPool(['a', 'b'], throttle_sec=0.1)
+    pool.update('a', 429, {'X-RateLimit-Remaining': '500', 'X-RateLimit-Reset': str(int(time.time()) + 3600)})
+    pool.update('b', 429, {'Retry-After': '1'})
+    self.assertRaises(QuotaExhaustedError, pool.acquire)
+    time.sleep(0.15)
+    #The throttled key kept its quota
+    self.assertEqual(pool.acquire(), 'a')
+    self.assertEqual(pool.headroom(), {'a': 499, 'b': 0})
+
+  def test_downloader_rotates_on_429(self):
+    downloader = ArticleDownloader(['a', 'b'], sleep_sec=0)
+    sent = []
+    def get(url, **kwargs):
+      sent.append(kwargs['headers']['X-ELS-APIKEY'])
+      r = requests.Response()
+      r.status_code = 429 if sent[-1] == 'a' else 200
+      r.headers = requests.structures.CaseInsensitiveDict({'X-RateLimit-Remaining': '5'})
+      r.raw = BytesIO(b'%PDF-1.4')
+      return r
+    downloader._get = get
+    self.assertTrue(downloader.get_pdf_from_doi('10.1016/x', BytesIO(), 'elsevier'))
+    self.assertTrue(downloader.get_pdf_from_doi('10.1016/y', BytesIO(), 'elsevier'))
+    self.assertEqual(sent, ['a', 'b', 'b'])
+
+  def elsevier_downloader(self, keys, **kwargs):
+    downloader = ArticleDownloader(keys, sleep_sec=0, retry_policy=RetryPolicy(max_retries=3, backoff_sec=0),
+                                   circuit_breaker=CircuitBreaker(failure_threshold=2), **kwargs)
+    self.sent = []
+    def get(url, **kwargs):
+      key = kwargs['headers']['X-ELS-APIKEY']
+      self.sent.append(key)
+      r = requests.Response()
+      r.status_code = 429 if key in ('a', 'b') else 200
+      r.headers = requests.structures.CaseInsensitiveDict({'Content-Type': 'application/json'})
+      r._content = b'{"full-text-retrieval-response": {"coredata": {"dc:description": "abstract"}}}'
+      r.raw = BytesIO(b'%PDF-1.4')
+      return r
+    downloader.session.get = get
+    return downloader
+
+  def test_429_rotates_without_retrying_or_tripping_the_host(self):
+    downloader = self.elsevier_downloader(['a', 'b', 'c'])
+    self.assertTrue(downloader.get_pdf_from_doi('10.1016/x', BytesIO(), 'elsevier'))
+    self.assertEqual(self.sent, ['a', 'b', 'c'])
+    self.assertFalse(downloader.circuit_breaker.is_open('api.elsevier.com'))
+    self.assertTrue(downloader.get_pdf_from_doi('10.1016/y', BytesIO(), 'elsevier'))
+    self.assertEqual(self.sent, ['a', 'b', 'c', 'c'])
+
+  def test_cache_is_shared_by_keys(self):
+    cache = HTTPCache(path.join(mkdtemp(), 'cache.sqlite'))
+    downloader = self.elsevier_downloader(['c', 'd', 'e'], cache=cache)
+    for i in range(3):
+      downloader.get_abstract_from_doi('10.1016/x', 'elsevier')
+    self.assertEqual(self.sent, ['c'])
+    self.assertIsNotNone(cache.lookup('http://api.elsevier.com/content/article/doi/10.1016/x?view=FULL',
+                                      {'Accept': 'application/json'}))
+    cache.close()
+
+class WorkQueueTester(TestCase):
+  def setUp(self):
+    self.queue_path = path.join(mkdtemp(), 'jobs.sqlite')
+    self.queue = SQLiteJobQueue(self.queue_path, max_attempts=2)
+
+  def test_dedupe_and_lease_ownership(self):
+    self.assertEqual(self.queue.put_many('download', [{'doi': '10.1/a'}, {'doi': '10.1/b'}, {'doi': '10.1/a'}]), 2)
+    self.assertFalse(self.queue.put('download', {'doi': '10.1/b'}))
+    job = self.queue.lease('w1', 0.01)
+    self.assertEqual(job.payload, {'doi': '10.1/a'})
+    time.sleep(0.02)
+
+    #The expired lease goes to the next worker, and the first one can no longer complete the job
+    self.assertEqual(self.queue.lease('w2', 60).payload, {'doi': '10.1/a'})
+    self.assertFalse(self.queue.complete(job))
+    self.assertEqual(self.queue.counts(), {'queued': 1, 'leased': 1, 'done': 0, 'failed': 0})
+
+  def test_failed_jobs_run_out_of_attempts(self):
+    self.queue.put('download', {'doi': '10.1/a'}, key='a')
+    self.assertTrue(self.queue.fail(self.queue.lease('w1', 60), 'boom'))
+    self.assertTrue(self.queue.fail(self.queue.lease('w1', 60), 'boom'))
+    self.assertIsNone(self.queue.lease('w1', 60))
+    self.assertEqual(self.queue.result('a')['status'], 'failed')
+
+  def test_concurrent_workers_never_share_jobs(self):
+    self.queue.put_many('download', [{'doi': '10.1/' + str(i)} for i in range(200)])
+    leased = []
+    def work(name):
+      queue = SQLiteJobQueue(self.queue_path)
+      while True:
+        job = queue.lease(name, 60)
+        if job is None:
+          break
+        leased.append(job.id)
+        queue.complete(job, {'by': name})
+      queue.close()
+    threads = [Thread(target=work, args=('w' + str(i),)) for i in range(4)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    self.assertEqual(sorted(leased), list(range(1, 201)))
+    self.assertEqual(self.queue.counts()['done'], 200)
+
+  def test_worker_downloads(self):
+    downloader = ArticleDownloader(sleep_sec=0)
+    def get(url, **kwargs):
+      r = requests.Response()
+      r.status_code = 200 if 'missing' not in url else 404
+      r.headers = requests.structures.CaseInsensitiveDict()
+      r.raw = BytesIO(b'%PDF-1.4 ' + url.encode('ascii'))
+      return r
+    downloader._get = get
+    self.queue.put_many('download', [{'doi': doi, 'fmt': 'pdf', 'mode': 'acs'} for doi in ['10.1021/a', '10.1021/missing']])
+    out_dir = mkdtemp()
+    self.assertEqual(Worker(downloader, self.queue, out_dir, heartbeat_sec=0.01).run(), (1, 2))
+    self.assertEqual(listdir(out_dir), ['10.1021%2Fa.pdf'])
+    self.assertEqual(self.queue.counts()['failed'], 1)
+
+  def test_worker_counts_only_jobs_it_still_held(self):
+    self.assertRaises(TypeError, JobQueue)
+    self.queue.put('metadata', {'dois': []}, key='a')
+    worker = Worker(ArticleDownloader(sleep_sec=0), self.queue, mkdtemp(), lease_sec=0.01, heartbeat_sec=60)
+    taken = []
+    def run_job(job):
+      #The job stalls past its lease, and another worker takes it over
+      time.sleep(0.02)
+      taken.append(self.queue.lease('w2', 60))
+      return []
+    worker.run_job = run_job
+    self.assertEqual(worker.run(), (0, 0))
+    self.assertEqual(taken[0].payload, {'dois': []})
+    self.assertEqual(self.queue.counts(), {'queued': 0, 'leased': 1, 'done': 0, 'failed': 0})
+
+  def tearDown(self):
+    self.queue.close()
+
+class DownloadManyTester(TestCase):
+  def test_caps_each_publisher(self):
+    downloader = ArticleDownloader(sleep_sec=0)
+    lock = Lock()
+    active = {}
+    peak = {}
+    def get(url, **kwargs):
+      if 'api.crossref.org' in url:
+        r = requests.Response()
+        r.status_code = 200
+        r._content = json.dumps({'message': {'link': [{'URL': 'http://pdf.example.org/' + url.split('/works/')[1],
+                                                       'content-type': 'application/pdf'}]}}).encode('ascii')
+        return r
+      publisher = url.split('/')[3]
+      with lock:
+        for key in [publisher, 'all']:
+          active[key] = active.get(key, 0) + 1
+          peak[key] = max(peak.get(key, 0), active[key])
+      time.sleep(0.05)
+      with lock:
+        active[publisher] -= 1
+        active['all'] -= 1
+      r = requests.Response()
+      r.status_code = 200 if 'missing' not in url else 404
+      r.headers = requests.structures.CaseInsensitiveDict()
+      r.raw = BytesIO(b'%PDF-1.4 ' + url.encode('ascii'))
+      return r
+    downloader._get = get
+
+    dois = ['10.1021/' + str(i) for i in range(4)] + ['10.1039/' + str(i) for i in range(4)] + ['10.1039/missing']
+    out_dir = mkdtemp()
+    results = list(downloader.download_many(dois, 'crossref', out_dir, max_workers=8, max_per_host=2))
+    #Both publishers download at once, but neither gets more than max_per_host connections
+    self.assertEqual(peak, {'10.1021': 2, '10.1039': 2, 'all': 4})
+    self.assertEqual(sorted(doi for doi, _, success in results if not success), ['10.1039/missing'])
+    self.assertEqual(len(listdir(out_dir)), 8)
+
+class FakeAsyncResponse:
+  def __init__(self, status, body, url=None, history=()):
+    self.status = status
+    self.body = body
+    self.headers = {}
+    self.url = url
+    self.history = history
+
+  async def __aenter__(self):
+    return self
+
+  async def __aexit__(self, *exc_info):
+    pass
+
+  async def read(self):
+    return self.body
+
+  @property
+  def content(self):
+    return self
+
+  async def iter_chunked(self, n):
+    for i in range(0, len(self.body), n):
+      yield self.body[i:i + n]
+
+class AsyncArticleDownloaderTester(TestCase):
+  def setUp(self):
+    if AsyncArticleDownloader is None:
+      self.skipTest('aiohttp is not installed')
+
+  def downloader(self, respond, els_api_key=None):
+    downloader = AsyncArticleDownloader(els_api_key, sleep_sec=0, chunk_size=4096)
+    self.sent = []
+    class Session:
+      def get(session, url, headers=None):
+        self.sent.append((url, headers))
+        return FakeAsyncResponse(*respond(url))
+    async def get_session(url):
+      return Session()
+    downloader._get_session = get_session
+    return downloader
+
+  def test_elsevier_without_key(self):
+    downloader = self.downloader(lambda url: (401, b'<service-error/>'))
+    self.assertFalse(asyncio.run(downloader.get_pdf_from_doi('10.1016/x', BytesIO(), 'elsevier')))
+    self.assertEqual(self.sent[0][1], {'Accept': 'application/pdf'})
+
+    downloader = self.downloader(lambda url: (200, b'<full-text-retrieval-response>'), els_api_key='k')
+    writefile = BytesIO()
+    self.assertTrue(asyncio.run(downloader.get_xml_from_doi('10.1016/x', writefile, 'elsevier')))
+    self.assertEqual(self.sent[0][1]['X-ELS-APIKEY'], 'k')
+    self.assertEqual(writefile.getvalue(), b'<full-text-retrieval-response>')
+
+  def test_streams_checked_body_to_async_writer(self):
+    body = b'%PDF-1.4' + b'x' * 50000
+    downloader = self.downloader(lambda url: (200, body if 'acs' in url else b'<html>Error</html>'))
+    written = []
+    class AsyncFile:
+      async def write(self, data):
+        written.append(bytes(data))
+    self.assertTrue(asyncio.run(downloader.get_pdf_from_doi('10.1021/a', AsyncFile(), 'acs')))
+    self.assertEqual(b''.join(written), body)
+    self.assertFalse(asyncio.run(downloader.get_pdf_from_doi('10.1007/a', BytesIO(), 'springer')))
+
+  def test_resolves_again_after_dead_url(self):
+    def respond(url):
+      if url.startswith('https://doi.org/'):
+        return 200, b'', 'https://pubs.rsc.org/en/content/articlelanding/2019/cp/c9cp00001x', ('redirect',)
+      return (200, b'<html>article</html>') if '2019/cp' in url else (404, b'')
+    downloader = self.downloader(respond)
+    downloader.resolver = DOIResolver(min_template_hits=2)
+    for suffix in ['c4ta00001a', 'c4ta00002b']:
+      downloader.resolver.learn('10.1039/' + suffix, 'https://pubs.rsc.org/en/content/articlelanding/2014/ta/' + suffix)
+    writefile = BytesIO()
+    self.assertTrue(asyncio.run(downloader.get_html_from_doi('10.1039/c9cp00001x', writefile, 'rsc')))
+    self.assertEqual([url for url, _ in self.sent], ['https://pubs.rsc.org/en/content/articlehtml/2014/ta/c9cp00001x',
+                                                     'https://doi.org/10.1039/c9cp00001x',
+                                                     'https://pubs.rsc.org/en/content/articlehtml/2019/cp/c9cp00001x'])
+    self.assertEqual(writefile.getvalue(), b'<html>article</html>')
+    self.assertIsNone(downloader.resolver.lookup('10.1039/c9ta00002y'))
+
+  def test_searches(self):
+    items = {'message': {'items': [{'DOI': '10.1/a'}, {'DOI': '10.1/a'}, {'DOI': '10.1/b'}]}}
+    downloader = self.downloader(lambda url: (200, json.dumps(items).encode('ascii')))
+    self.assertEqual(sorted(asyncio.run(downloader.get_dois_from_search('battery', rows=10))), ['10.1/a', '10.1/b'])
+    self.assertIn('select=DOI&rows=10', self.sent[0][0])
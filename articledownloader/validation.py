@@ -0,0 +1,107 @@
+'''
+Checks on the first bytes of a download, so paywall pages and error pages are caught before
+the rest of the body is transferred
+'''
+
+import re
+
+#Root element of the full text returned by each XML mode
+XML_ROOTS = {
+  'elsevier': 'full-text-retrieval-response',
+  'aps': 'article'
+}
+
+#Text (lowercase) of bot checks and cookie walls put in front of any publisher
+GENERIC_MARKERS = [
+  b'checking your browser before accessing',
+  b'please enable cookies',
+  b'<title>access denied</title>',
+  b'cookieabsent'
+]
+
+#Text (lowercase) of each publisher's paywall or login pages
+PAYWALL_MARKERS = {
+  'springer': [b'buy article pdf', b'log in via an institution'],
+  'nature': [b'access through your institution', b'buy this article'],
+  'wiley': [b'get access to the full version of this article', b'request full-text pdf'],
+  'acs': [b'get access to this article', b'purchase this article'],
+  'aaas': [b'get full access to this article', b'log in to view full text'],
+  'rsc': [b'you do not have access to this article'],
+  'ecs': [b'purchase this article', b'sign in to access'],
+  'emerald': [b'access to this document requires a subscription']
+}
+
+_comment = re.compile(br'<!--.*?-->', re.S)
+_element = re.compile(br'<(?![?!/])([^\s/>]+)')
+
+class InvalidPayload(Exception):
+  '''
+  The response was a 200, but its body isn't the article that was asked for
+  '''
+
+class NotPDF(InvalidPayload):
+  '''
+  A PDF was requested, but the body doesn't start like one
+  '''
+
+class UnexpectedXMLRoot(InvalidPayload):
+  '''
+  The XML full text doesn't have the root element its API always returns
+  '''
+
+class PaywallPage(InvalidPayload):
+  '''
+  The body is a paywall, login or cookie wall page
+  '''
+
+def check_paywall(head, mode):
+  '''
+  Raises PaywallPage if the head of a body contains a known paywall marker for the mode
+  '''
+  lowered = head.lower()
+  for marker in GENERIC_MARKERS + PAYWALL_MARKERS.get(mode, []):
+    if marker in lowered:
+      raise PaywallPage('body contains ' + repr(marker.decode('ascii')))
+
+def check_pdf(head, mode, complete):
+  '''
+  Raises NotPDF unless the PDF header turns up in the first 1KB, where readers look for it
+  '''
+  if b'%PDF-' not in head[:1024]:
+    check_paywall(head, mode)
+    raise NotPDF('body starts with ' + repr(bytes(head[:32])))
+
+def check_xml(head, mode, complete):
+  '''
+  Raises UnexpectedXMLRoot if the root element isn't the one the mode's API returns
+  '''
+  check_paywall(head, mode)
+  expected = XML_ROOTS.get(mode)
+  match = _element.search(_comment.sub(b'', head))
+  if match is None:
+    if complete:
+      raise UnexpectedXMLRoot('body has no root element')
+    return
+  root = match.group(1).decode('utf-8', 'replace').split(':')[-1]
+  if expected is not None and root != expected:
+    raise UnexpectedXMLRoot('root element is <' + root + '>, expected <' + expected + '>')
+
+def check_html(head, mode, complete):
+  '''
+  Raises PaywallPage for known paywall pages
+  '''
+  check_paywall(head, mode)
+
+def validator_for(fmt, mode):
+  '''
+  Returns the check for downloads of a format in a mode, for writers.write_body
+
+  :returns: function(head, complete) that raises an InvalidPayload subclass for bad bodies
+  :rtype: function
+  '''
+  check = {'pdf': check_pdf, 'xml': check_xml, 'html': check_html}[fmt]
+  def validate(head, complete):
+    if complete and not head:
+      raise InvalidPayload('empty body')
+    check(bytes(head), mode, complete)
+  return validate
@@ -0,0 +1,378 @@
+'''
+Shared queue of download and metadata jobs, leased to workers in any number of processes
+'''
+
+import abc
+import json
+import os
+import socket
+import sqlite3
+import time
+from contextlib import contextmanager
+from requests.utils import quote
+from threading import Event, Lock, Thread
+
+class JobFailed(Exception):
+  '''
+  Raised by Worker.run_job when a download job didn't get its article
+  '''
+
+class Job:
+  '''
+  A job leased from a queue. attempt identifies the lease: completing or extending a job
+  only works while the lease taken with that attempt is still held.
+  '''
+
+  def __init__(self, id, kind, payload, attempt):
+    self.id = id
+    self.kind = kind
+    self.payload = payload
+    self.attempt = attempt
+
+  def __repr__(self):
+    return 'Job(id=%r, kind=%r, payload=%r, attempt=%r)' % (self.id, self.kind, self.payload, self.attempt)
+
+class JobQueue(abc.ABC):
+  '''
+  Interface of the queues Worker pulls jobs from. SQLiteJobQueue implements it for workers
+  sharing a machine; a broker shared by several machines (e.g. Redis or a database server)
+  can be plugged in by subclassing it and implementing every method.
+  '''
+
+  @abc.abstractmethod
+  def put(self, kind, payload, key=None):
+    '''
+    Adds a job, unless a job with the same key was ever added
+
+    :param kind: what the job does, e.g. 'download' or 'metadata'
+    :type kind: str
+
+    :param payload: JSON-serializable arguments of the job
+    :type payload: dict
+
+    :param key: identifies the job for de-duplication (default = kind plus payload)
+    :type key: str
+
+    :returns: True if the job was added
+    :rtype: bool
+    '''
+    raise NotImplementedError
+
+  @abc.abstractmethod
+  def lease(self, worker, lease_sec):
+    '''
+    Takes the oldest queued job (first re-queuing jobs whose leases expired) for lease_sec seconds
+
+    :returns: the job, or None if none is queued
+    :rtype: articledownloader.workqueue.Job
+    '''
+    raise NotImplementedError
+
+  @abc.abstractmethod
+  def heartbeat(self, job, lease_sec):
+    '''
+    Extends a job's lease by lease_sec seconds from now
+
+    :returns: False if the lease was already lost
+    :rtype: bool
+    '''
+    raise NotImplementedError
+
+  @abc.abstractmethod
+  def complete(self, job, result=None):
+    '''
+    Marks a job as done, storing its JSON-serializable result
+
+    :returns: False if the lease was already lost (the job is then left to its new holder)
+    :rtype: bool
+    '''
+    raise NotImplementedError
+
+  @abc.abstractmethod
+  def fail(self, job, error):
+    '''
+    Re-queues a failed job, or marks it as failed once it has used up its attempts
+
+    :returns: False if the lease was already lost
+    :rtype: bool
+    '''
+    raise NotImplementedError
+
+  @abc.abstractmethod
+  def counts(self):
+    '''
+    Returns the number of jobs in each status ('queued', 'leased', 'done', 'failed')
+
+    :rtype: dict
+    '''
+    raise NotImplementedError
+
+def job_key(kind, payload):
+  '''
+  Default de-duplication key of a job
+  '''
+  return kind + ':' + json.dumps(payload, sort_keys=True)
+
+class SQLiteJobQueue(JobQueue):
+  '''
+  Job queue in a SQLite file, safe to share between processes on one machine (SQLite's locking
+  isn't reliable over network filesystems). Leasing runs in an IMMEDIATE transaction, so two
+  processes never lease the same job.
+  '''
+
+  def __init__(self, path, max_attempts=3):
+    '''
+    :param path: SQLite file to keep the queue in (created if missing)
+    :type path: str
+
+    :param max_attempts: leases a job gets before it is marked as failed
+    :type max_attempts: int
+    '''
+    self.path = path
+    self.max_attempts = max_attempts
+    self.lock = Lock()
+    self.db = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+    self.db.execute('PRAGMA journal_mode=WAL')
+    self.db.execute('''
+      CREATE TABLE IF NOT EXISTS jobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        key TEXT UNIQUE,
+        kind TEXT,
+        payload TEXT,
+        status TEXT,
+        attempts INTEGER,
+        worker TEXT,
+        lease_until REAL,
+        error TEXT,
+        result TEXT,
+        updated REAL
+      )''')
+    self.db.execute('CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, id)')
+
+  @contextmanager
+  def _transaction(self):
+    #IMMEDIATE takes the write lock up front, so concurrent processes queue up instead of deadlocking
+    with self.lock:
+      self.db.execute('BEGIN IMMEDIATE')
+      try:
+        yield
+      except Exception:
+        self.db.execute('ROLLBACK')
+        raise
+      self.db.execute('COMMIT')
+
+  def put(self, kind, payload, key=None):
+    return self.put_many(kind, [payload], [key]) == 1
+
+  def put_many(self, kind, payloads, keys=None):
+    '''
+    Adds many jobs of one kind in a single transaction
+
+    :returns: the number of jobs added (duplicates are skipped)
+    :rtype: int
+    '''
+    payloads = list(payloads)
+    keys = keys if keys is not None else [None] * len(payloads)
+    now = time.time()
+    rows = [(key if key is not None else job_key(kind, payload), kind, json.dumps(payload), now)
+            for payload, key in zip(payloads, keys)]
+    with self._transaction():
+      before = self.db.total_changes
+      self.db.executemany('''INSERT OR IGNORE INTO jobs (key, kind, payload, status, attempts, updated)
+                             VALUES (?, ?, ?, 'queued', 0, ?)''', rows)
+      return self.db.total_changes - before
+
+  def _requeue_expired(self, now):
+    self.db.execute('''UPDATE jobs SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'queued' END,
+                       error = 'lease expired', updated = ? WHERE status = 'leased' AND lease_until < ?''',
+                    (self.max_attempts, now, now))
+
+  def lease(self, worker, lease_sec):
+    now = time.time()
+    with self._transaction():
+      self._requeue_expired(now)
+      row = self.db.execute('''SELECT id, kind, payload, attempts FROM jobs WHERE status = 'queued'
+                               ORDER BY id LIMIT 1''').fetchone()
+      if row is None:
+        return None
+      self.db.execute('''UPDATE jobs SET status = 'leased', attempts = ?, worker = ?, lease_until = ?, updated = ?
+                         WHERE id = ?''', (row[3] + 1, worker, now + lease_sec, now, row[0]))
+    return Job(row[0], row[1], json.loads(row[2]), row[3] + 1)
+
+  def _update_leased(self, job, assignments, values):
+    with self._transaction():
+      cursor = self.db.execute('UPDATE jobs SET ' + assignments + ', updated = ? ' +
+                               "WHERE id = ? AND status = 'leased' AND attempts = ?",
+                               tuple(values) + (time.time(), job.id, job.attempt))
+      return cursor.rowcount == 1
+
+  def heartbeat(self, job, lease_sec):
+    return self._update_leased(job, 'lease_until = ?', [time.time() + lease_sec])
+
+  def complete(self, job, result=None):
+    return self._update_leased(job, "status = 'done', error = NULL, result = ?", [json.dumps(result)])
+
+  def fail(self, job, error):
+    status = 'failed' if job.attempt >= self.max_attempts else 'queued'
+    return self._update_leased(job, 'status = ?, error = ?', [status, error])
+
+  def counts(self):
+    counts = {'queued': 0, 'leased': 0, 'done': 0, 'failed': 0}
+    with self.lock:
+      counts.update(self.db.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status').fetchall())
+    return counts
+
+  def result(self, key):
+    '''
+    Returns the status, error and result of the job with this key, or None if there is no such job
+
+    :rtype: dict
+    '''
+    with self.lock:
+      row = self.db.execute('SELECT status, error, result FROM jobs WHERE key = ?', (key,)).fetchone()
+    if row is None:
+      return None
+    return {'status': row[0], 'error': row[1], 'result': json.loads(row[2]) if row[2] is not None else None}
+
+  def close(self):
+    '''
+    Closes the underlying SQLite connection
+    '''
+    self.db.close()
+
+class Worker:
+  '''
+  Pulls jobs from a queue and runs them with an ArticleDownloader, extending each job's lease
+  from a heartbeat thread while it runs. Start one worker per process (each with its own
+  downloader and queue connection) to scale past a single process; a worker that dies stops
+  heartbeating, and its job is leased to another worker once the lease expires.
+
+  Jobs:
+
+    'download': {'doi': ..., 'fmt': 'pdf' | 'html' | 'xml', 'mode': ...}, written to target
+    'metadata': {'dois': [...]}, looked up with get_metadata_for_dois; the records are handed to
+                metadata_sink if there is one, and stored as the job's result otherwise
+
+  Workers in different processes can write to the same ShardWriter directory: each writer
+  locks the shards it appends to, so no two share a shard (on Windows, which has no such
+  lock, give each process its own prefix).
+  '''
+
+  def __init__(self, downloader, queue, target, worker_id=None, lease_sec=300, heartbeat_sec=60, metadata_sink=None):
+    '''
+    :param downloader: runs the jobs
+    :type downloader: articledownloader.articledownloader.ArticleDownloader
+
+    :param queue: queue to pull jobs from
+    :type queue: articledownloader.workqueue.JobQueue
+
+    :param target: directory, ArticleStore or ShardWriter that downloads are written to
+    :type target: str or articledownloader.store.ArticleStore
+
+    :param worker_id: name of this worker in the queue (default = host:pid)
+    :type worker_id: str
+
+    :param lease_sec: time a job is leased for without a heartbeat
+    :type lease_sec: float
+
+    :param heartbeat_sec: time between heartbeats; keep it well under lease_sec
+    :type heartbeat_sec: float
+
+    :param metadata_sink: writer for the records of metadata jobs, e.g. a JSONLMetadataWriter
+    :type metadata_sink: object with a write(records) method
+    '''
+    self.downloader = downloader
+    self.queue = queue
+    self.target = target
+    self.worker_id = worker_id if worker_id is not None else socket.gethostname() + ':' + str(os.getpid())
+    self.lease_sec = lease_sec
+    self.heartbeat_sec = heartbeat_sec
+    self.metadata_sink = metadata_sink
+    self.getters = {
+      'pdf': downloader.get_pdf_from_doi,
+      'html': downloader.get_html_from_doi,
+      'xml': downloader.get_xml_from_doi
+    }
+
+    if not hasattr(target, 'writer') and not os.path.isdir(target):
+      os.makedirs(target)
+
+  def _heartbeat(self, job, stop):
+    while not stop.wait(self.heartbeat_sec):
+      if not self.queue.heartbeat(job, self.lease_sec):
+        return
+
+  def run_job(self, job):
+    '''
+    Runs one job
+
+    :returns: the job's result
+    :raises JobFailed: if a download job didn't get its article
+    '''
+    if job.kind == 'download':
+      doi, fmt, mode = job.payload['doi'], job.payload['fmt'], job.payload['mode']
+      if hasattr(self.target, 'writer'):
+        target = self.target
+      else:
+        target = os.path.join(self.target, quote(doi, safe='') + '.' + fmt)
+      if not self.getters[fmt](doi, target, mode):
+        last_error = self.downloader.last_error
+        raise JobFailed(repr(last_error) if last_error is not None else 'download failed')
+      return {'doi': doi, 'fmt': fmt}
+
+    if job.kind == 'metadata':
+      records = list(self.downloader.get_metadata_for_dois(job.payload['dois']))
+      if self.metadata_sink is not None:
+        self.metadata_sink.write(records)
+        return {'records': len(records)}
+      return records
+
+    raise ValueError('unknown job kind ' + repr(job.kind))
+
+  def run(self, max_jobs=None, wait_sec=None, poll_sec=5):
+    '''
+    Leases and runs jobs until the queue is empty
+
+    :param max_jobs: stop after this many jobs (default = no limit)
+    :type max_jobs: int
+
+    :param wait_sec: keep polling an empty queue this long for new jobs, e.g. leases other workers
+                     may still let expire (default = return as soon as the queue is empty)
+    :type wait_sec: float
+
+    :param poll_sec: time between polls of an empty queue
+    :type poll_sec: float
+
+    :returns: number of jobs done and failed, not counting jobs whose lease was lost before they finished
+    :rtype: tuple
+    '''
+    done = failed = 0
+    idle_since = None
+    while max_jobs is None or done + failed < max_jobs:
+      job = self.queue.lease(self.worker_id, self.lease_sec)
+      if job is None:
+        now = time.time()
+        idle_since = idle_since if idle_since is not None else now
+        if wait_sec is None or now - idle_since >= wait_sec:
+          break
+        time.sleep(poll_sec)
+        continue
+      idle_since = None
+
+      stop = Event()
+      heartbeat = Thread(target=self._heartbeat, args=(job, stop))
+      heartbeat.daemon = True
+      heartbeat.start()
+      try:
+        result = self.run_job(job)
+      except Exception as e:
+        if self.queue.fail(job, str(e) if isinstance(e, JobFailed) else repr(e)):
+          failed += 1
+      else:
+        #A job whose lease was lost meanwhile belongs to another worker now, and isn't counted here
+        if self.queue.complete(job, result):
+          done += 1
+      finally:
+        stop.set()
+        heartbeat.join()
+    return done, failed
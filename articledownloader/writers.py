@@ -0,0 +1,203 @@
+'''
+Copies streamed response bodies into files, in large chunks and without per-chunk allocations
+'''
+
+import os
+import tempfile
+
+#Bytes copied per read; large enough that the copy loop runs a handful of times per article
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+
+#Bytes of each body held back for a check before anything is written
+HEAD_BYTES = 16384
+
+def _content_length(r):
+  try:
+    return int(r.headers.get('Content-Length'))
+  except (TypeError, ValueError):
+    return None
+
+def copy_body(r, writefile, chunk_size=DEFAULT_CHUNK_SIZE):
+  '''
+  Writes the body of a streamed response to a file object.
+
+  Bodies sent without a Content-Encoding are read straight from the socket into one reusable
+  buffer with readinto; compressed bodies go through requests' decoding iter_content.
+
+  :param r: response requested with stream=True
+  :type r: requests.Response
+
+  :param writefile: file object to write to
+  :type writefile: file
+
+  :param chunk_size: bytes copied per read
+  :type chunk_size: int
+
+  :returns: number of bytes written
+  :rtype: int
+  '''
+  encoding = r.headers.get('Content-Encoding', 'identity').strip().lower()
+  readinto = getattr(r.raw, 'readinto', None)
+  written = 0
+
+  if encoding == 'identity' and readinto is not None and r._content is False:
+    buf = bytearray(chunk_size)
+    view = memoryview(buf)
+    while True:
+      n = readinto(buf)
+      if not n:
+        break
+      writefile.write(view[:n])
+      written += n
+    r._content_consumed = True
+    return written
+
+  for chunk in r.iter_content(chunk_size):
+    writefile.write(chunk)
+    written += len(chunk)
+  return written
+
+class AtomicFileWriter:
+  '''
+  File that only appears at its final path once commit() is called. Data is written to a
+  temporary file in the same directory, which is renamed over the path on commit and
+  removed on abort, so readers never see a partial download.
+
+  Usage:
+
+    with AtomicFileWriter(path, size_hint=length) as f:
+      f.write(data)
+      f.commit()
+  '''
+
+  def __init__(self, path, size_hint=None):
+    '''
+    :param path: final location of the file
+    :type path: str
+
+    :param size_hint: expected size in bytes (e.g. the Content-Length), preallocated where the OS supports it
+    :type size_hint: int
+    '''
+    self.path = path
+    fd, self.tmp_path = tempfile.mkstemp(prefix=os.path.basename(path) + '.', suffix='.part',
+                                         dir=os.path.dirname(os.path.abspath(path)))
+    self.file = os.fdopen(fd, 'wb')
+    self.closed = False
+    if size_hint and hasattr(os, 'posix_fallocate'):
+      try:
+        os.posix_fallocate(fd, 0, size_hint)
+      except OSError:
+        pass
+
+  def write(self, data):
+    return self.file.write(data)
+
+  def tell(self):
+    return self.file.tell()
+
+  def seek(self, offset, whence=0):
+    return self.file.seek(offset, whence)
+
+  def truncate(self, size=None):
+    return self.file.truncate(size)
+
+  def seekable(self):
+    return True
+
+  def commit(self):
+    '''
+    Trims any unused preallocated space and moves the file into place
+    '''
+    if self.closed:
+      return
+    self.file.truncate(self.file.tell())
+    self.file.close()
+    self.closed = True
+    os.replace(self.tmp_path, self.path)
+
+  def abort(self):
+    '''
+    Discards everything written so far
+    '''
+    if self.closed:
+      return
+    self.file.close()
+    self.closed = True
+    os.remove(self.tmp_path)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.abort()
+
+class HeadCheckWriter:
+  '''
+  Holds back the first head_bytes of a body and runs check(head, complete) on them before
+  anything reaches the sink. check raises to reject the body, in which case nothing has
+  been written.
+  '''
+
+  def __init__(self, sink, check, head_bytes=HEAD_BYTES):
+    self.sink = sink
+    self.check = check
+    self.head_bytes = head_bytes
+    self.head = bytearray()
+
+  def write(self, data):
+    if self.head is None:
+      return self.sink.write(data)
+    self.head += data
+    if len(self.head) >= self.head_bytes:
+      self._release(False)
+    return len(data)
+
+  def _release(self, complete):
+    head, self.head = self.head, None
+    self.check(head, complete)
+    self.sink.write(head)
+
+  def finish(self):
+    '''
+    Checks and writes the head of a body shorter than head_bytes
+    '''
+    if self.head is not None:
+      self._release(True)
+
+def _copy_checked(r, sink, chunk_size, check):
+  if check is None:
+    return copy_body(r, sink, chunk_size)
+  checked = HeadCheckWriter(sink, check)
+  written = copy_body(r, checked, chunk_size)
+  checked.finish()
+  return written
+
+def write_body(r, sink, chunk_size=DEFAULT_CHUNK_SIZE, check=None):
+  '''
+  Writes the body of a streamed response to a sink: a file object; a path, which is written
+  atomically with its space preallocated from the Content-Length; or a writer with
+  commit()/abort() methods (e.g. from ArticleStore.writer), which is committed once the whole
+  body has arrived and aborted otherwise
+
+  :param check: function(head, complete) run on the first bytes before any are written, e.g.
+    from validation.validator_for; if it raises, the connection is dropped and the error re-raised
+  :type check: function
+
+  :returns: number of bytes written
+  :rtype: int
+  '''
+  if isinstance(sink, str):
+    sink = AtomicFileWriter(sink, size_hint=_content_length(r))
+
+  try:
+    if not hasattr(sink, 'commit'):
+      return _copy_checked(r, sink, chunk_size, check)
+
+    with sink:
+      written = _copy_checked(r, sink, chunk_size, check)
+      sink.commit()
+    return written
+  except Exception:
+    #Don't read the rest of a body that is being thrown away
+    r.close()
+    raise